@@ -0,0 +1,92 @@
+"""Бенчмарк: сколько байт уходит из MySQL на один клик админа
+
+Сравнивает чтение заказа, как его делали callback'и смены статуса раньше
+(SELECT * — с order_json и LONGBLOB-колонками PDF), с чтением заголовка
+через get_order_header() (только нужные колонки, PDF грузится лениво).
+
+Байты на проводе берутся из счётчика Bytes_sent сессии MySQL.
+Для строк, чьи PDF уже перенесены в blob store, дополнительно показывается
+оценка "до переноса": SELECT * плюс размер PDF, которые раньше лежали в строке.
+
+Только для DB_BACKEND=mysql: счётчика Bytes_sent в SQLite нет.
+
+Запуск (нужен тот же .env, что и для бота):
+    python bench_order_reads.py [кол-во_заказов]
+"""
+import sys
+import time
+
+from main import db_storage, get_db_connection, ORDER_HEADER_COLUMNS
+
+
+def bytes_sent(cursor) -> int:
+    cursor.execute("SHOW SESSION STATUS LIKE 'Bytes_sent'")
+    return int(cursor.fetchone()['Value'])
+
+
+def measure(cursor, query: str, params: tuple, overhead: int) -> tuple[int, float]:
+    """Возвращает (байт отправлено сервером, время в мс) для одного запроса"""
+    before = bytes_sent(cursor)
+    started = time.perf_counter()
+    cursor.execute(query, params)
+    cursor.fetchall()
+    elapsed = (time.perf_counter() - started) * 1000
+    after = bytes_sent(cursor)
+    return after - before - overhead, elapsed
+
+
+def main():
+    if db_storage.name != "mysql":
+        print("Бенчмарк считает байты по счётчику MySQL, нужен DB_BACKEND=mysql.")
+        return
+
+    sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT order_id, COALESCE(pdf_draft_size, 0) + COALESCE(pdf_final_size, 0) AS moved_pdf_bytes
+            FROM orders
+            ORDER BY created_at DESC
+            LIMIT %s
+        """, (sample_size,))
+        orders = cursor.fetchall()
+
+        if not orders:
+            print("В базе нет заказов.")
+            return
+
+        # Сколько байт стоит сам SHOW STATUS — вычитаем из каждого замера
+        first = bytes_sent(cursor)
+        second = bytes_sent(cursor)
+        overhead = second - first
+
+        full_bytes = full_ms = legacy_bytes = header_bytes = header_ms = 0
+        for order in orders:
+            b, ms = measure(cursor, "SELECT * FROM orders WHERE order_id = %s", (order['order_id'],), overhead)
+            full_bytes += b
+            full_ms += ms
+            legacy_bytes += b + order['moved_pdf_bytes']
+
+            b, ms = measure(
+                cursor,
+                f"SELECT {ORDER_HEADER_COLUMNS} FROM orders WHERE order_id = %s",
+                (order['order_id'],),
+                overhead
+            )
+            header_bytes += b
+            header_ms += ms
+
+    n = len(orders)
+    print(f"Заказов в выборке: {n}\n")
+    print(f"{'Чтение на один клик':<40}{'байт':>12}{'мс':>10}")
+    print(f"{'SELECT * (PDF в строке, до blob store)':<40}{legacy_bytes / n:>12.0f}{'—':>10}")
+    print(f"{'SELECT * (сейчас)':<40}{full_bytes / n:>12.0f}{full_ms / n:>10.2f}")
+    print(f"{'get_order_header()':<40}{header_bytes / n:>12.0f}{header_ms / n:>10.2f}")
+    if header_bytes:
+        print(f"\nЭкономия против SELECT * до blob store: x{legacy_bytes / header_bytes:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,13 +11,11 @@ REQUIRED_ENV = [
     "HOSTING_FTP_HOST",
     "HOSTING_FTP_USER",
     "HOSTING_FTP_PASS",
-    "DB_HOST",
-    "DB_PORT",
-    "DB_NAME",
-    "DB_USER",
-    "DB_PASS",
     "GOOGLE_SHEETS_URL",  # ✅ НОВОЕ: URL для получения товаров
 ]
+# Параметры MySQL нужны только для DB_BACKEND=mysql (по умолчанию)
+if os.getenv("DB_BACKEND", "mysql").lower() == "mysql":
+    REQUIRED_ENV += ["DB_HOST", "DB_PORT", "DB_NAME", "DB_USER", "DB_PASS"]
 for key in REQUIRED_ENV:
     if not os.getenv(key):
         raise RuntimeError(f"❌ Переменная окружения {key} не найдена (.env)")
@@ -25,24 +23,31 @@ for key in REQUIRED_ENV:
 import json
 import logging
 import asyncio
+import bisect
 import io
 import pymysql
 from pymysql.cursors import DictCursor
+import sqlite3
 import csv
+import functools
+import gzip
+import hashlib
+import random
 import re
-from datetime import datetime, timedelta
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from ftplib import FTP
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from contextlib import contextmanager
-from typing import Optional, Dict, Any, List
-from urllib.request import urlopen
-from urllib.error import URLError, HTTPError
+from typing import Awaitable, Callable, Optional, Dict, Any, List
+from urllib.parse import urlsplit
 import aiohttp  # ✅ НОВОЕ: для асинхронных запросов к Google Sheets
 from concurrent.futures import ThreadPoolExecutor
 
-# Создаем пул потоков для параллельной загрузки изображений
-image_download_executor = ThreadPoolExecutor(max_workers=10)
-
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command
 from aiogram.types import (
@@ -53,6 +58,7 @@ from aiogram.types import (
     ContentType,
     ReplyKeyboardRemove,
     BufferedInputFile,
+    FSInputFile,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
@@ -63,7 +69,6 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram import BaseMiddleware
-from typing import Callable, Awaitable
 
 # ==== PDF / QR ====
 import qrcode
@@ -77,52 +82,734 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from PIL import Image
 
+# ==================== HTTP-КЛИЕНТ ====================
+HTTP_POOL_LIMIT = 100  # всего открытых соединений
+HTTP_POOL_LIMIT_PER_HOST = 10  # соединений на один хост
+HTTP_DNS_TTL = 300  # кеш DNS, сек
+HTTP_TIMEOUT = 10  # таймаут запроса по умолчанию, сек
+HTTP_RETRIES = 2  # повторов после первой попытки
+HTTP_RETRY_BACKOFF = 0.5  # базовая пауза между повторами, сек
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_READ_CHUNK = 64 * 1024  # размер куска при потоковом чтении с лимитом
+
+
+def url_host(url: str) -> str:
+    return urlsplit(url).netloc or url
+
+
+class HttpError(Exception):
+    """Неуспешный HTTP-ответ"""
+
+    def __init__(self, status: int, url: str):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.url = url
+
+
+class HttpResponseTooLarge(Exception):
+    """Тело ответа больше допустимого (не повторяется)"""
+
+    def __init__(self, url: str, limit: int):
+        super().__init__(f"response larger than {limit} bytes")
+        self.url = url
+        self.limit = limit
+
+
+class HttpResponse:
+    """Прочитанный ответ: статус, заголовки и тело"""
+
+    __slots__ = ("status", "headers", "body", "url")
+
+    def __init__(self, status: int, headers, body: bytes, url: str):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.url = url
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HttpError(self.status, self.url)
+
+
+class HttpClient:
+    """Общий асинхронный HTTP-клиент приложения
+
+    Одна aiohttp-сессия на всё приложение: keep-alive пул соединений (TLS-сессии
+    переиспользуются), лимиты соединений всего и на хост, кеш DNS, таймауты.
+    Сетевые ошибки, таймауты и ответы 429/5xx повторяются с экспоненциальной
+    паузой и джиттером. Сессия открывается в on_startup и закрывается в on_shutdown.
+
+    Из рабочих потоков (генерация PDF) запросы выполняются через run_sync():
+    корутина уходит в цикл событий бота, поток ждёт результат.
+    """
+
+    def __init__(self, limit: int = HTTP_POOL_LIMIT, limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+                 dns_ttl: int = HTTP_DNS_TTL, timeout: float = HTTP_TIMEOUT,
+                 retries: int = HTTP_RETRIES, backoff: float = HTTP_RETRY_BACKOFF):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Счётчики (пишутся в лог при остановке)
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+        self.bytes_received = 0
+        self.by_host: Dict[str, int] = defaultdict(int)
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        self._loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_ttl,
+            enable_cleanup_closed=True,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            auto_decompress=True,
+        )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def request(self, method: str, url: str, *, headers: Optional[Dict[str, str]] = None,
+                      timeout: Optional[float] = None, retries: Optional[int] = None,
+                      max_bytes: Optional[int] = None) -> HttpResponse:
+        """Запрос с повторами; возвращает ответ с любым окончательным статусом
+
+        С max_bytes тело читается потоком и чтение обрывается (HttpResponseTooLarge),
+        как только ответ превысит лимит.
+        """
+        await self.start()
+        retries = self.retries if retries is None else retries
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        host = url_host(url)
+
+        attempt = 0
+        while True:
+            self.requests += 1
+            self.by_host[host] += 1
+            try:
+                async with self._session.request(method, url, headers=headers, timeout=client_timeout) as response:
+                    if max_bytes is None:
+                        body = await response.read()
+                    else:
+                        body = await self._read_limited(response, url, max_bytes)
+                    self.bytes_received += len(body)
+                    if response.status in HTTP_RETRY_STATUSES and attempt < retries:
+                        raise HttpError(response.status, url)
+                    return HttpResponse(response.status, response.headers, body, url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, HttpError) as e:
+                if attempt >= retries:
+                    self.failures += 1
+                    raise
+                attempt += 1
+                self.retried += 1
+                delay = self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                logger.debug(f"HTTP {method} {host} failed ({e or type(e).__name__}), retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def get(self, url: str, **kwargs) -> HttpResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def _read_limited(self, response, url: str, max_bytes: int) -> bytes:
+        if response.content_length is not None and response.content_length > max_bytes:
+            raise HttpResponseTooLarge(url, max_bytes)
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(HTTP_READ_CHUNK):
+            size += len(chunk)
+            if size > max_bytes:
+                self.bytes_received += size
+                raise HttpResponseTooLarge(url, max_bytes)
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def run_sync(self, coro, timeout: Optional[float] = None):
+        """Выполняет корутину клиента из рабочего потока (не из цикла событий)"""
+        if self._loop is None or self._loop.is_closed():
+            coro.close()
+            raise RuntimeError("HTTP client is not started")
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "retried": self.retried,
+            "failures": self.failures,
+            "bytes_received": self.bytes_received,
+            "by_host": dict(self.by_host),
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "open": self._session is not None and not self._session.closed,
+        }
+
+
+http_client = HttpClient()
+
+
 # ==================== GOOGLE SHEETS INTEGRATION ====================
 GOOGLE_SHEETS_URL = os.getenv("GOOGLE_SHEETS_URL")
-products_cache = {}  # Кеш товаров
-cache_timestamp = None
-CACHE_LIFETIME = 3600  # 5 минут
-
-# Кеш изображений товаров
-image_cache = {}  # {url: PIL.Image}
-image_cache_timestamp = {}  # {url: datetime}
+CACHE_LIFETIME = 3600  # через сколько секунд каталог считается устаревшим
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", "1800"))  # фоновое обновление, сек
+CATALOG_RETRY_AFTER = 30  # пауза после неудачного обновления, сек
+# Снимок последнего удачно загруженного каталога: с него бот стартует и работает, если Sheets недоступен
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.json")
+CATALOG_SNAPSHOT_VERSION = 1
+
+# Кеш изображений товаров (в памяти, LRU)
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "64")) * 1024 * 1024  # по декодированным пикселям
 IMAGE_CACHE_LIFETIME = 3600  # 1 час
+# Миниатюры для PDF: JPEG, уже уменьшенный до размера ячейки таблицы при нужном DPI
+PDF_IMAGE_SIZE_MM = 16
+PDF_IMAGE_DPI = int(os.getenv("PDF_IMAGE_DPI", "200"))
+PDF_IMAGE_JPEG_QUALITY = 85
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_MB", "16")) * 1024 * 1024
+# Исходные изображения на диске (под кешем в памяти): переживают перезапуск, перепроверяются раз в IMAGE_CACHE_LIFETIME
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_MB", "512")) * 1024 * 1024
+# Загрузка изображений: одновременных запросов на хост, лимит размера файла, повторы
+IMAGE_FETCH_PER_HOST = int(os.getenv("IMAGE_FETCH_PER_HOST", "4"))
+IMAGE_MAX_DOWNLOAD_BYTES = int(os.getenv("IMAGE_MAX_DOWNLOAD_MB", "10")) * 1024 * 1024
+IMAGE_FETCH_RETRIES = 2
+# Фоновая подгрузка изображений каталога: сколько загрузок одновременно (0 — выключена)
+IMAGE_PREWARM_CONCURRENCY = int(os.getenv("IMAGE_PREWARM_CONCURRENCY", "2"))
+
+
+# Категории по диапазонам ID товаров — запасной вариант, пока каталог не загружен
+# и для товаров, которых в каталоге уже нет (старые заказы)
+CATEGORY_ID_RANGES = [
+    (10000, 19999, "cleaning"),
+    (20000, 29999, "plasticpe"),
+    (30000, 39999, "plasticpet"),
+    (40000, 49999, "plasticpp"),
+    (50000, 59999, "plastictd"),
+    (60000, 69999, "cleaning2"),
+    (70000, 79999, "fragrances"),
+]
 
 
-async def fetch_products_from_sheets():
-    """Асинхронная загрузка товаров из Google Sheets"""
-    global products_cache, cache_timestamp
-    
-    # Проверяем кеш
-    if cache_timestamp and (datetime.now() - cache_timestamp).total_seconds() < CACHE_LIFETIME:
-        return products_cache
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(GOOGLE_SHEETS_URL, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Преобразуем в словарь {id: product}
-                    products_cache = {}
-                    for category_products in data.values():
-                        for product in category_products:
-                            product_id = int(product.get('id', 0))
-                            if product_id:
-                                products_cache[product_id] = product
-                    
-                    cache_timestamp = datetime.now()
-                    logger.info(f"✅ Loaded {len(products_cache)} products from Google Sheets")
-                    return products_cache
-                else:
-                    logger.error(f"❌ Failed to fetch products: HTTP {response.status}")
-                    return products_cache
-    except Exception as e:
-        logger.exception(f"❌ Error fetching products from Google Sheets: {e}")
-        return products_cache
+class CategoryRanges:
+    """Поиск категории по ID товара в отсортированных диапазонах [start, end] (bisect)
+
+    Диапазоны не должны пересекаться: bisect ищет только по началу диапазона.
+    """
+
+    __slots__ = ("starts", "ranges")
+
+    def __init__(self, ranges: List[tuple]):
+        self.ranges = sorted(ranges)
+        self.starts = [start for start, _, _ in self.ranges]
+        for (_, end, _), (start, _, _) in zip(self.ranges, self.ranges[1:]):
+            if start <= end:
+                raise ValueError(f"Overlapping category ranges at ID {start}")
+
+    @classmethod
+    def from_products(cls, products: Dict[int, "Product"]) -> "CategoryRanges":
+        """Диапазоны из каталога: подряд идущие (по ID) товары одной категории
+
+        Такие отрезки не пересекаются, даже если отдельный товар лежит вне
+        обычного блока ID своей категории; ID между отрезками разных категорий
+        не определяются (None), и срабатывает запасной вариант.
+        """
+        ranges = []
+        start = end = category = None
+        for product_id in sorted(products):
+            product_category = products[product_id].category
+            if product_category and product_category == category:
+                end = product_id
+                continue
+            if category:
+                ranges.append((start, end, category))
+            start = end = product_id
+            category = product_category
+        if category:
+            ranges.append((start, end, category))
+        return cls(ranges)
+
+    def lookup(self, item_id: int) -> Optional[str]:
+        i = bisect.bisect_right(self.starts, item_id) - 1
+        if i >= 0 and item_id <= self.ranges[i][1]:
+            return self.ranges[i][2]
+        return None
+
+    def __len__(self) -> int:
+        return len(self.ranges)
+
+
+STATIC_CATEGORY_RANGES = CategoryRanges(CATEGORY_ID_RANGES)
+
+PRODUCT_FIELDS = ("id", "name", "price", "category", "image", "weight", "cube")
+
+
+class Product:
+    """Товар каталога: поля из Sheets разобраны и приведены к типам один раз при загрузке"""
+
+    __slots__ = PRODUCT_FIELDS + ("extra",)
+
+    def __init__(self, id: int, name: str, price: int, category: str, image: str,
+                 weight: float, cube: float, extra: Optional[Dict] = None):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.category = category
+        self.image = image
+        self.weight = weight
+        self.cube = cube
+        self.extra = extra  # остальные колонки таблицы, если есть
+
+    @classmethod
+    def from_sheets(cls, data: Dict) -> "Product":
+        """Разбирает строку Sheets (числа там часто строками); ValueError, если поля не разбираются"""
+        return cls(
+            id=int(data.get("id") or 0),
+            name=str(data.get("name") or "Без названия"),
+            price=int(float(data.get("price") or 0)),
+            category=sys.intern(str(data.get("category") or "")),
+            image=str(data.get("image") or ""),
+            weight=float(data.get("weight") or 0),
+            cube=float(data.get("cube") or 0),
+            extra={key: value for key, value in data.items() if key not in PRODUCT_FIELDS} or None,
+        )
+
+    def to_dict(self) -> Dict:
+        data = {field: getattr(self, field) for field in PRODUCT_FIELDS}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def order_item(self, qty: int) -> Dict:
+        """Позиция заказа в формате order_json"""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "price": self.price,
+            "qty": qty,
+            "image": self.image,
+            "category": self.category or "unknown",
+            "weight": self.weight,
+            "cube": self.cube,
+        }
+
+    def __repr__(self) -> str:
+        return f"<Product {self.id} {self.name!r} {self.price}>"
+
+
+class CatalogChange:
+    """Изменение одного товара в каталоге: added, changed или removed"""
+
+    __slots__ = ("kind", "product_id", "old", "new", "fields")
+
+    def __init__(self, kind: str, product_id: int, old: Optional[Product], new: Optional[Product]):
+        self.kind = kind
+        self.product_id = product_id
+        self.old = old
+        self.new = new
+        # Для changed — {поле: (было, стало)}, например {"price": (1000, 1200)}
+        self.fields: Dict[str, tuple] = {}
+        if old is not None and new is not None:
+            old_data, new_data = old.to_dict(), new.to_dict()
+            for key in old_data.keys() | new_data.keys():
+                if old_data.get(key) != new_data.get(key):
+                    self.fields[key] = (old_data.get(key), new_data.get(key))
 
+    def __repr__(self) -> str:
+        if self.kind == "changed":
+            details = ", ".join(f"{key}: {old!r} → {new!r}" for key, (old, new) in sorted(self.fields.items()))
+            return f"<CatalogChange changed {self.product_id}: {details}>"
+        return f"<CatalogChange {self.kind} {self.product_id}>"
 
-async def get_product_info(product_id: int) -> Optional[Dict]:
+
+def content_hash(value: Any) -> str:
+    """Хеш содержимого JSON-значения (не зависит от порядка ключей)"""
+    return hashlib.sha1(
+        json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+class CatalogCache:
+    """Кеш каталога товаров из Google Sheets (stale-while-revalidate)
+
+    get() сразу отдаёт текущий снимок {id: товар}. Если снимок устарел, в фоне
+    запускается обновление — одно на всех: параллельные вызовы к нему присоединяются,
+    а не шлют свои запросы. Новый словарь собирается целиком и подменяет старый одним
+    присваиванием, поэтому читатели никогда не видят наполовину заполненный каталог.
+    Ждать приходится только до самой первой загрузки.
+
+    Каждая удачная загрузка сохраняется в снимок на диске (компактный JSON с версией
+    формата и временем загрузки); при старте каталог сразу поднимается из снимка.
+
+    Обновление инкрементальное: запрос условный (If-None-Match / If-Modified-Since),
+    неизменившийся ответ (тот же хеш) не разбирается; в изменившемся пропускаются
+    категории с прежним хешем, а из остальных в индекс попадают только добавленные,
+    изменённые и удалённые товары. Эти изменения рассылаются подписчикам (subscribe()).
+
+    Товары хранятся как Product; по ним ведётся индекс по категориям и диапазоны ID
+    категорий (category_of() для товаров, которых в каталоге нет).
+    """
+
+    def __init__(self, url: str, ttl: int, timeout: int = 10, retry_after: int = CATALOG_RETRY_AFTER,
+                 snapshot_path: Optional[str] = None):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.snapshot_path = snapshot_path
+
+        self._products: Dict[int, Product] = {}
+        self._by_category: Dict[str, frozenset] = {}
+        self._category_ranges = CategoryRanges([])
+        self._loaded_at: Optional[float] = None  # time.monotonic() последней удачной загрузки
+
+        # Состояние для инкрементального обновления
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.payload_hash: Optional[str] = None
+        self._category_hashes: Dict[str, str] = {}
+        self._category_ids: Dict[str, set] = {}
+        self._product_hashes: Dict[int, str] = {}
+
+        self._subscribers: List[Callable] = []
+        self.change_log = deque(maxlen=500)  # последние изменения каталога
+        self._next_attempt = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+
+        # Статистика
+        self.loaded_at: Optional[datetime] = None
+        self.source: Optional[str] = None  # "sheets" или "snapshot"
+        self.refreshes = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.last_duration_ms = 0.0
+        self.stale_served = 0
+        self.unchanged = 0  # обновлений без изменений (304 или тот же хеш)
+        self.last_bytes = 0
+        self.last_changes: Dict[str, int] = {}
+
+    @property
+    def products(self) -> Dict[int, Product]:
+        return self._products
+
+    def age(self) -> Optional[float]:
+        """Возраст снимка в секундах (None — ещё не загружался)"""
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def is_stale(self) -> bool:
+        age = self.age()
+        return age is None or age >= self.ttl
+
+    def outdated_since(self) -> Optional[datetime]:
+        """Время загрузки снимка, если он устарел (например, Sheets недоступен), иначе None"""
+        if self._loaded_at is not None and self.is_stale():
+            return self.loaded_at
+        return None
+
+    async def get(self) -> Dict[int, Product]:
+        """Текущий снимок каталога; устаревший обновляется в фоне"""
+        if self._loaded_at is None:
+            # После неудачной первой загрузки не ждём сеть на каждом запросе
+            if time.monotonic() < self._next_attempt:
+                return self._products
+            return await self.refresh()
+        if self.is_stale():
+            self.stale_served += 1
+            if time.monotonic() >= self._next_attempt:
+                self.start_refresh()
+        return self._products
+
+    async def refresh(self) -> Dict[int, Product]:
+        """Обновляет каталог сейчас (или дожидается уже идущего обновления)"""
+        await asyncio.shield(self.start_refresh())
+        return self._products
+
+    def start_refresh(self) -> asyncio.Task:
+        """Запускает обновление в фоне, если оно ещё не идёт"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    def subscribe(self, callback: Callable[[List[CatalogChange]], Any]):
+        """Подписка на изменения каталога (callback или корутина, получает список CatalogChange)"""
+        self._subscribers.append(callback)
+
+    def _publish(self, changes: List[CatalogChange]):
+        self.change_log.extend(changes)
+        for callback in self._subscribers:
+            try:
+                result = callback(changes)
+                if asyncio.iscoroutine(result):
+                    asyncio.create_task(result)
+            except Exception:
+                logger.exception(f"Catalog change subscriber {callback!r} failed")
+
+    async def _download(self) -> tuple:
+        """(тело, ETag, Last-Modified) ответа Sheets; тело None, если сервер ответил 304 Not Modified
+
+        Валидаторы сохраняет вызывающий — только после того, как ответ разобран и применён,
+        иначе следующий условный запрос получит 304 на версию, которой нет в кеше.
+        """
+        headers = {"Accept-Encoding": "gzip"}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        response = await http_client.get(self.url, headers=headers, timeout=self.timeout)
+        if response.status == 304:
+            return None, self.etag, self.last_modified
+        if response.status != 200:
+            raise HttpError(response.status, self.url)
+        return response.body, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+    def _apply(self, data: Dict[str, list]) -> List[CatalogChange]:
+        """Применяет новый ответ Sheets к индексу; возвращает список изменений
+
+        Индекс копируется и меняется только в изменившихся местах, затем подменяется целиком.
+        """
+        products = dict(self._products)
+        product_hashes = dict(self._product_hashes)
+        category_hashes: Dict[str, str] = {}
+        category_ids: Dict[str, set] = {}
+        changes: List[CatalogChange] = []
+
+        for category, category_products in data.items():
+            category_hash = content_hash(category_products)
+            category_hashes[category] = category_hash
+            if self._category_hashes.get(category) == category_hash:
+                category_ids[category] = self._category_ids[category]
+                continue
+
+            ids = set()
+            for row in category_products:
+                try:
+                    product = Product.from_sheets(row)
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"⚠️ Skipping malformed catalog row {row.get('id')!r}: {e}")
+                    continue
+                product_id = product.id
+                if not product_id:
+                    continue
+                ids.add(product_id)
+                product_hash = content_hash(product.to_dict())
+                if product_hashes.get(product_id) == product_hash:
+                    continue
+                old = products.get(product_id)
+                products[product_id] = product
+                product_hashes[product_id] = product_hash
+                changes.append(CatalogChange("added" if old is None else "changed", product_id, old, product))
+            category_ids[category] = ids
+
+        present = set().union(*category_ids.values()) if category_ids else set()
+        for product_id in [product_id for product_id in products if product_id not in present]:
+            changes.append(CatalogChange("removed", product_id, products.pop(product_id), None))
+            product_hashes.pop(product_id, None)
+
+        self._products = products
+        self._product_hashes = product_hashes
+        self._category_hashes = category_hashes
+        self._category_ids = category_ids
+        if changes:
+            self._update_category_index(changes)
+        return changes
+
+    def _update_category_index(self, changes: List[CatalogChange]):
+        """Переносит изменившиеся товары в индексе категорий и пересчитывает диапазоны ID
+
+        Вызывается после подмены self._products.
+        """
+        by_category = dict(self._by_category)
+        touched: Dict[str, set] = {}
+
+        def members(category: str) -> set:
+            if category not in touched:
+                touched[category] = set(by_category.get(category, ()))
+            return touched[category]
+
+        for change in changes:
+            if change.old is not None:
+                members(change.old.category).discard(change.product_id)
+            if change.new is not None:
+                members(change.new.category).add(change.product_id)
+
+        for category, ids in touched.items():
+            if ids:
+                by_category[category] = frozenset(ids)
+            else:
+                by_category.pop(category, None)
+
+        self._by_category = by_category
+        self._category_ranges = CategoryRanges.from_products(self._products)
+
+    def category_of(self, product_id: int) -> Optional[str]:
+        """Категория товара: из каталога, для отсутствующих — по диапазонам ID категорий каталога"""
+        product = self._products.get(product_id)
+        if product is not None:
+            return product.category or None
+        return self._category_ranges.lookup(product_id)
+
+    def in_category(self, category: str) -> frozenset:
+        """ID товаров категории"""
+        return self._by_category.get(category, frozenset())
+
+    async def _refresh(self):
+        started = time.monotonic()
+        try:
+            body, etag, last_modified = await self._download()
+            self.last_bytes = len(body) if body is not None else 0
+
+            payload_hash = hashlib.sha1(body).hexdigest() if body is not None else self.payload_hash
+            if body is None or payload_hash == self.payload_hash:
+                changes = []
+                self.unchanged += 1
+            else:
+                changes = self._apply(json.loads(body))
+                self.payload_hash = payload_hash
+            self.etag = etag
+            self.last_modified = last_modified
+
+            self._loaded_at = time.monotonic()
+            self.loaded_at = datetime.now()
+            self.source = "sheets"
+            self.refreshes += 1
+            self.last_error = None
+            self.last_changes = {
+                kind: sum(1 for change in changes if change.kind == kind)
+                for kind in ("added", "changed", "removed")
+            }
+            if changes:
+                logger.info(
+                    f"✅ Catalog updated from Google Sheets: {len(self._products)} products "
+                    f"(+{self.last_changes['added']} ~{self.last_changes['changed']} -{self.last_changes['removed']})"
+                )
+            else:
+                logger.info(f"✅ Catalog unchanged in Google Sheets: {len(self._products)} products")
+
+            if self.snapshot_path:
+                try:
+                    await asyncio.to_thread(self._save_snapshot, self._products, self.loaded_at)
+                except Exception as e:
+                    logger.warning(f"⚠️ Failed to save catalog snapshot: {e}")
+
+            if changes:
+                self._publish(changes)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e) or type(e).__name__
+            self._next_attempt = time.monotonic() + self.retry_after
+            logger.error(f"❌ Failed to refresh products from Google Sheets: {self.last_error}")
+        finally:
+            self.last_duration_ms = (time.monotonic() - started) * 1000
+
+    def load_snapshot(self) -> bool:
+        """Поднимает каталог из снимка на диске; возраст снимка учитывается при проверке устаревания"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = json.loads(f.read())
+            if snapshot.get("version") != CATALOG_SNAPSHOT_VERSION:
+                logger.warning(f"⚠️ Catalog snapshot version {snapshot.get('version')!r} is not supported, ignoring")
+                return False
+            saved_at = datetime.fromisoformat(snapshot["saved_at"])
+            products = {}
+            for row in snapshot["products"]:
+                product = Product.from_sheets(row)
+                products[product.id] = product
+            product_hashes = {product_id: content_hash(product.to_dict()) for product_id, product in products.items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"⚠️ Catalog snapshot {self.snapshot_path} is unreadable: {e}")
+            return False
+
+        if self._loaded_at is not None:
+            return False  # каталог уже загружен из Sheets — он свежее
+
+        age = max(0.0, (datetime.now() - saved_at).total_seconds())
+        self._products = products
+        self._product_hashes = product_hashes
+        self._by_category = {}
+        self._update_category_index([
+            CatalogChange("added", product_id, None, product) for product_id, product in products.items()
+        ])
+        self._loaded_at = time.monotonic() - age
+        self.loaded_at = saved_at
+        self.source = "snapshot"
+        # С валидаторами снимка Sheets может ответить 304, если каталог не менялся
+        self.etag = snapshot.get("etag")
+        self.last_modified = snapshot.get("last_modified")
+        self.payload_hash = snapshot.get("payload_hash")
+        logger.info(f"✅ Loaded {len(products)} products from snapshot of {saved_at:%Y-%m-%d %H:%M}")
+        return True
+
+    def _save_snapshot(self, products: Dict[int, Product], loaded_at: datetime):
+        """Атомарно записывает снимок каталога (временный файл + os.replace)"""
+        snapshot = {
+            "version": CATALOG_SNAPSHOT_VERSION,
+            "saved_at": loaded_at.isoformat(timespec="seconds"),
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "payload_hash": self.payload_hash,
+            "products": [product.to_dict() for product in products.values()],
+        }
+        data = json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".catalog_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.snapshot_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._products),
+            "categories": len(self._by_category),
+            "age": self.age(),
+            "loaded_at": self.loaded_at,
+            "source": self.source,
+            "stale": self.is_stale(),
+            "refreshing": self._refresh_task is not None and not self._refresh_task.done(),
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_duration_ms": self.last_duration_ms,
+            "stale_served": self.stale_served,
+            "unchanged": self.unchanged,
+            "last_bytes": self.last_bytes,
+            "last_changes": dict(self.last_changes),
+            "change_log": len(self.change_log),
+        }
+
+
+catalog_cache = CatalogCache(GOOGLE_SHEETS_URL, CACHE_LIFETIME, snapshot_path=CATALOG_SNAPSHOT_PATH)
+
+
+async def fetch_products_from_sheets() -> Dict[int, Product]:
+    """Каталог товаров {id: товар} (из кеша, см. CatalogCache)"""
+    return await catalog_cache.get()
+
+
+async def get_product_info(product_id: int) -> Optional[Product]:
     """Получить информацию о товаре по ID"""
     products = await fetch_products_from_sheets()
     return products.get(product_id)
@@ -175,7 +862,7 @@ async def refresh_main_menu(user_id: int, state: FSMContext):
     data = await state.get_data()
     old_message_id = data.get("menu_message_id")
 
-    lang = get_user_lang(user_id)
+    lang = await users_repo.get_lang(user_id)
     kb = get_main_menu_keyboard(user_id, lang)
 
     try:
@@ -310,45 +997,12 @@ def get_order_category(order_items: list) -> str:
     if not order_items:
         return None
 
-    # Получаем ID первого товара
-    first_item_id = order_items[0].get("id", 0)
-
-    # Определяем категорию по диапазону ID
-    if 10000 <= first_item_id < 20000:
-        return "cleaning"
-    elif 20000 <= first_item_id < 30000:
-        return "plasticpe"
-    elif 30000 <= first_item_id < 40000:
-        return "plasticpet"
-    elif 40000 <= first_item_id < 50000:
-        return "plasticpp"
-    elif 50000 <= first_item_id < 60000:
-        return "plastictd"
-    elif 60000 <= first_item_id < 70000:
-        return "cleaning2"
-    elif 70000 <= first_item_id < 80000:
-        return "fragrances"
-
-    return None
+    return get_category_by_item_id(order_items[0].get("id", 0))
 
 
 def get_category_by_item_id(item_id: int) -> str:
-    """Определяет категорию по ID товара"""
-    if 10000 <= item_id < 20000:
-        return "cleaning"
-    elif 20000 <= item_id < 30000:
-        return "plasticpe"
-    elif 30000 <= item_id < 40000:
-        return "plasticpet"
-    elif 40000 <= item_id < 50000:
-        return "plasticpp"
-    elif 50000 <= item_id < 60000:
-        return "plastictd"
-    elif 60000 <= item_id < 70000:
-        return "cleaning2"
-    elif 70000 <= item_id < 80000:
-        return "fragrances"
-    return None
+    """Определяет категорию по ID товара: по каталогу, иначе по известным диапазонам ID"""
+    return catalog_cache.category_of(item_id) or STATIC_CATEGORY_RANGES.lookup(item_id)
 
 
 def group_items_by_category(order_items: list) -> dict:
@@ -479,6 +1133,25 @@ STATUS_NAMES_UZ = {
     OrderStatus.REJECTED: "❌ Rad etildi"
 }
 
+# Допустимые переходы: новый статус -> статус, из которого в него можно перейти
+ORDER_STATUS_TRANSITIONS = {
+    OrderStatus.APPROVED: OrderStatus.PENDING,
+    OrderStatus.REJECTED: OrderStatus.PENDING,
+    OrderStatus.PRODUCTION_RECEIVED: OrderStatus.APPROVED,
+    OrderStatus.PRODUCTION_STARTED: OrderStatus.PRODUCTION_RECEIVED,
+    OrderStatus.SENT_TO_WAREHOUSE: OrderStatus.PRODUCTION_STARTED,
+    OrderStatus.WAREHOUSE_RECEIVED: OrderStatus.SENT_TO_WAREHOUSE,
+}
+
+# Колонка, в которую пишется ID администратора, выполнившего переход
+ORDER_STATUS_BY_COLUMNS = {
+    OrderStatus.APPROVED: "approved_by",
+    OrderStatus.PRODUCTION_RECEIVED: "production_received_by",
+    OrderStatus.PRODUCTION_STARTED: "production_started_by",
+    OrderStatus.SENT_TO_WAREHOUSE: "sent_to_warehouse_by",
+    OrderStatus.WAREHOUSE_RECEIVED: "warehouse_received_by"
+}
+
 # ==================== НАСТРОЙКИ ====================
 GOOGLE_SCRIPT_URL = os.getenv("GOOGLE_SCRIPT_URL", "")
 DEALER_CHECK_INTERVAL = 10  # 10 сек
@@ -508,6 +1181,21 @@ DB_CONFIG = {
     'autocommit': False
 }
 
+# Хранилище: mysql (по умолчанию) или sqlite — встроенная БД в файле,
+# чтобы гонять нагрузочные тесты и бенчмарки без сервера MySQL
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "kafolat.sqlite3")
+
+# Настройки пула соединений БД
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))  # закрывать простаивающие дольше
+DB_POOL_PING_AFTER_SECONDS = int(os.getenv("DB_POOL_PING_AFTER_SECONDS", "5"))  # ping, если простаивало дольше
+DB_POOL_BORROW_TIMEOUT = int(os.getenv("DB_POOL_BORROW_TIMEOUT", "30"))
+
+# Запросы дольше порога пишутся в лог (параметры — только типы и длины), мс
+DB_SLOW_QUERY_MS = int(os.getenv("DB_SLOW_QUERY_MS", "200"))
+
 
 # FTP настройки
 HOSTING_BASE_URL = os.getenv("HOSTING_BASE_URL", "")
@@ -516,6 +1204,18 @@ HOSTING_FTP_USER = os.getenv("HOSTING_FTP_USER")
 HOSTING_FTP_PASS = os.getenv("HOSTING_FTP_PASS")
 HOSTING_FTP_DIR = os.getenv("HOSTING_FTP_DIR", "")
 
+# Буфер активности пользователей (/start): как часто сбрасывать в БД, сек
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))
+# Сколько неудачных сбросов подряд переживает активность пользователя, прежде чем её выбросят
+ACTIVITY_FLUSH_MAX_ATTEMPTS = int(os.getenv("ACTIVITY_FLUSH_MAX_ATTEMPTS", "5"))
+
+# Кеш контекста пользователя (язык, профиль)
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+
+# Хранилище PDF заказов (content-addressed, ключ = sha256 содержимого)
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "blobs")
+
 # Новые настройки
 ORDER_COOLDOWN_SECONDS = int(os.getenv("ORDER_COOLDOWN_SECONDS", "60"))
 PDF_MAX_SIZE_MB = int(os.getenv("PDF_MAX_SIZE_MB", "10"))
@@ -562,181 +1262,918 @@ for handler in logging.root.handlers:
 logger = logging.getLogger(__name__)
 
 
-# ==================== MYSQL CONNECTION POOL ====================
+# ==================== ХРАНИЛИЩЕ (MySQL / SQLite) ====================
 
-from contextlib import contextmanager
+class StorageBackend:
+    """Интерфейс хранилища: соединения и диалект SQL
 
-@contextmanager
-def get_db_connection():
-    """Контекстный менеджер для MySQL соединения"""
-    connection = None
-    try:
-        connection = pymysql.connect(**DB_CONFIG)
-        yield connection
-        connection.commit()
-    except Exception as e:
-        if connection:
-            connection.rollback()
-        logger.exception(f"Database error: {e}")
-        raise
-    finally:
-        if connection:
-            connection.close()
+    Запросы к users, orders, client_notifications и остальным таблицам написаны один раз
+    в стиле pymysql (параметры %s, строки — словари). Всё, что различается между СУБД,
+    берётся из бэкенда: соединение, upsert, INSERT IGNORE, блокировка строки,
+    проверка схемы и потоковый курсор.
+    """
 
+    name = "sql"
+    table_options = ""
+    insert_ignore = "INSERT IGNORE"
+    for_update = " FOR UPDATE"
+    # Ошибки, после которых соединение нельзя возвращать в пул
+    disconnect_errors: tuple = ()
 
+    def connect(self):
+        raise NotImplementedError
 
+    def begin_write(self, cursor):
+        """Начать пишущую транзакцию до чтения, от которого зависит запись
 
-# ==================== RATE LIMITING MIDDLEWARE ====================
+        В MySQL достаточно SELECT ... FOR UPDATE внутри обычной транзакции.
+        """
 
-class RateLimitMiddleware(BaseMiddleware):
-    """Middleware для ограничения частоты запросов"""
+    def describe(self) -> str:
+        return self.name
 
-    def __init__(
-            self,
-            message_limit: int = 20,
-            message_window: int = 60,
-            order_cooldown: int = 60,
-            admin_ids: List[int] = None
-    ):
-        super().__init__()
-        self.message_limit = message_limit
-        self.message_window = timedelta(seconds=message_window)
-        self.order_cooldown = timedelta(seconds=order_cooldown)
-        self.admin_ids = admin_ids or []
+    def excluded(self, column: str) -> str:
+        """Значение колонки из вставляемой строки внутри on_conflict()"""
+        raise NotImplementedError
 
-        self.message_timestamps: Dict[int, list] = defaultdict(list)
-        self.last_order_time: Dict[int, datetime] = {}
+    def on_conflict(self, keys: List[str], updates=()) -> str:
+        """Хвост upsert'а: что делать при конфликте по ключу keys
 
-    async def __call__(
-            self,
-            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
-            event: TelegramObject,
-            data: Dict[str, Any]
-    ) -> Any:
-        if not isinstance(event, Message):
-            return await handler(event, data)
+        updates — список колонок (взять значение из вставляемой строки) или словарь
+        {колонка: выражение}, где выражение может ссылаться на excluded(). Пустой
+        updates — оставить существующую строку как есть.
+        """
+        if not isinstance(updates, dict):
+            updates = {column: self.excluded(column) for column in updates}
+        return self._upsert_clause(keys, updates)
 
-        message: Message = event
-        user_id = message.from_user.id
+    def _upsert_clause(self, keys: List[str], updates: Dict[str, str]) -> str:
+        raise NotImplementedError
 
-        # Админы пропускаются
-        if user_id in self.admin_ids:
-            return await handler(event, data)
+    def column_exists(self, cursor, table: str, column: str) -> bool:
+        raise NotImplementedError
 
-        now = datetime.now()
+    def index_exists(self, cursor, table: str, index_name: str) -> bool:
+        raise NotImplementedError
 
-        # Очистка старых меток
-        self._cleanup_old_timestamps(user_id, now)
+    def create_index(self, cursor, table: str, index_name: str, columns: str):
+        cursor.execute(f"CREATE INDEX {index_name} ON {table} ({columns})")
 
-        # Проверка лимита
-        if not self._check_message_rate(user_id, now):
-            logger.warning(f"Rate limit exceeded for user {user_id}")
-            await message.answer("⚠️ Слишком много запросов. Пожалуйста, подождите немного.")
-            return
+    def stream_cursor(self, connection):
+        """Курсор для потокового чтения больших выборок (строки — кортежи)"""
+        raise NotImplementedError
 
-        self.message_timestamps[user_id].append(now)
-        return await handler(event, data)
 
-    def _cleanup_old_timestamps(self, user_id: int, now: datetime):
-        cutoff = now - self.message_window
-        self.message_timestamps[user_id] = [
-            ts for ts in self.message_timestamps[user_id] if ts > cutoff
-        ]
+class MySQLStorage(StorageBackend):
+    """MySQL через pymysql"""
 
-    def _check_message_rate(self, user_id: int, now: datetime) -> bool:
-        return len(self.message_timestamps[user_id]) < self.message_limit
+    name = "mysql"
+    table_options = "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci"
+    disconnect_errors = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
 
-    def check_order_cooldown(self, user_id: int) -> tuple[bool, int]:
-        """Проверяет, можно ли пользователю создать заказ"""
-        now = datetime.now()
-        last_order = self.last_order_time.get(user_id)
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
 
-        if last_order is None:
-            return True, 0
+    def connect(self):
+        return pymysql.connect(**self.config)
 
-        time_passed = now - last_order
-        if time_passed >= self.order_cooldown:
-            return True, 0
+    def describe(self) -> str:
+        return f"MySQL at {self.config['host']}:{self.config['port']}"
 
-        remaining = (self.order_cooldown - time_passed).total_seconds()
-        return False, int(remaining)
+    def excluded(self, column: str) -> str:
+        return f"VALUES({column})"
 
-    def register_order(self, user_id: int):
-        """Регистрирует новый заказ"""
-        self.last_order_time[user_id] = datetime.now()
+    def _upsert_clause(self, keys: List[str], updates: Dict[str, str]) -> str:
+        if not updates:
+            updates = {keys[0]: keys[0]}
+        return "ON DUPLICATE KEY UPDATE " + ", ".join(f"{column} = {expr}" for column, expr in updates.items())
 
+    def column_exists(self, cursor, table: str, column: str) -> bool:
+        cursor.execute("""
+            SELECT COUNT(*) AS cnt
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (table, column))
+        return bool(cursor.fetchone()['cnt'])
 
-# Глобальный экземпляр rate limiter
-rate_limiter = RateLimitMiddleware(
-    message_limit=20,
-    message_window=60,
-    order_cooldown=ORDER_COOLDOWN_SECONDS,
-    admin_ids=ALL_ADMIN_IDS
-)
+    def index_exists(self, cursor, table: str, index_name: str) -> bool:
+        cursor.execute("""
+            SELECT COUNT(*) AS cnt
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """, (table, index_name))
+        return bool(cursor.fetchone()['cnt'])
 
-# ==================== WEBAPP TIMER MIDDLEWARE ====================
+    def stream_cursor(self, connection):
+        return connection.cursor(pymysql.cursors.SSCursor)
 
-class WebAppTimerMiddleware(BaseMiddleware):
-    """Middleware для проверки активности кнопки WebApp"""
 
-    async def __call__(
-            self,
-            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
-            event: TelegramObject,
-            data: Dict[str, Any]
-    ) -> Any:
-        # Проверяем, является ли событие сообщением с web_app_data
-        if isinstance(event, Message) and event.web_app_data:
-            user_id = event.from_user.id
-            logger.info(f"[TIMER MIDDLEWARE] WebApp data received from user {user_id}")
+class SQLiteCursor:
+    """Курсор sqlite3 с интерфейсом pymysql: параметры %s, строки-словари"""
 
-            # Проверяем, активна ли кнопка
-            if not is_webapp_button_active(user_id):
-                logger.warning(f"[TIMER MIDDLEWARE] BLOCKING WebApp for user {user_id} - timer expired!")
+    _PARAM_RE = re.compile(r"%([s%])")
 
-                # Отправляем сообщение без определения языка (или используем русский по умолчанию)
-                await event.answer(
-                    "⏰ Время действия кнопки истекло.\n"
-                    "Пожалуйста, нажмите /start для создания нового заказа.\n\n"
-                    "⏰ Tugma faolligi tugadi.\n"
-                    "Iltimos, yangi buyurtma yaratish uchun /start ni bosing.",
-                    reply_markup=ReplyKeyboardRemove()
-                )
+    def __init__(self, cursor: sqlite3.Cursor, as_dict: bool = True):
+        self._cursor = cursor
+        self._as_dict = as_dict
 
-                return  # Прерываем обработку
+    @classmethod
+    def _translate(cls, query: str) -> str:
+        return cls._PARAM_RE.sub(lambda m: "?" if m.group(1) == "s" else "%", query)
 
-            logger.info(f"[TIMER MIDDLEWARE] ALLOWING WebApp for user {user_id} - timer active")
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
 
-        # Продолжаем обработку
-        return await handler(event, data)
+    @property
+    def description(self):
+        return self._cursor.description
 
+    def execute(self, query: str, params=None) -> int:
+        # Как и pymysql, %-подстановку делаем только при наличии параметров
+        if params is None:
+            self._cursor.execute(query)
+        else:
+            self._cursor.execute(self._translate(query), tuple(params))
+        return self._cursor.rowcount
 
+    def executemany(self, query: str, rows) -> int:
+        self._cursor.executemany(self._translate(query), rows)
+        return self._cursor.rowcount
 
-# ==================== ВАЛИДАЦИЯ ДАННЫХ ====================
+    def _row(self, values):
+        if values is None or not self._as_dict:
+            return values
+        return {column[0]: value for column, value in zip(self._cursor.description, values)}
 
-class ValidationError(Exception):
-    """Ошибка валидации"""
-    pass
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
 
+    def fetchmany(self, size: int):
+        return [self._row(values) for values in self._cursor.fetchmany(size)]
 
-class OrderDataValidator:
-    """Валидатор данных заказа от WebApp"""
+    def fetchall(self):
+        return [self._row(values) for values in self._cursor.fetchall()]
 
-    @staticmethod
-    def validate_order_data(data: Any) -> Dict[str, Any]:
-        """Валидирует данные заказа"""
-        if not isinstance(data, dict):
-            raise ValidationError("Данные должны быть объектом")
+    def close(self):
+        self._cursor.close()
 
-        if "items" not in data:
-            raise ValidationError("Отсутствует поле items")
 
-        if "total" not in data:
-            raise ValidationError("Отсутствует поле total")
+class SQLiteConnection:
+    """Соединение sqlite3 с тем подмножеством интерфейса pymysql, которым пользуются пул и запросы"""
 
-        items = data["items"]
-        if not isinstance(items, list):
-            raise ValidationError("items должен быть массивом")
+    def __init__(self, connection: sqlite3.Connection):
+        self._connection = connection
+        self.open = True
+
+    def cursor(self, as_dict: bool = True) -> SQLiteCursor:
+        return SQLiteCursor(self._connection.cursor(), as_dict=as_dict)
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def ping(self, reconnect: bool = False):
+        self._connection.execute("SELECT 1")
+
+    def close(self):
+        self.open = False
+        self._connection.close()
+
+
+class SQLiteStorage(StorageBackend):
+    """Встроенная SQLite в одном файле (локальные бенчмарки и нагрузочные тесты)
+
+    DATETIME и DATE хранятся ISO-строками и читаются обратно в datetime/date, так что
+    код запросов получает те же типы, что и от MySQL. Имена индексов в SQLite общие
+    для всей базы, поэтому к ним добавляется имя таблицы.
+    """
+
+    name = "sqlite"
+    insert_ignore = "INSERT OR IGNORE"
+    # Блокировок строк нет: чтение под запись защищает begin_write() (BEGIN IMMEDIATE)
+    for_update = ""
+    disconnect_errors = (sqlite3.ProgrammingError,)
+
+    def __init__(self, path: str):
+        self.path = path
+        sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+        sqlite3.register_adapter(date, lambda value: value.isoformat())
+        sqlite3.register_adapter(Decimal, float)
+        sqlite3.register_converter("DATETIME", lambda raw: datetime.fromisoformat(raw.decode()))
+        sqlite3.register_converter("DATE", lambda raw: date.fromisoformat(raw.decode()))
+
+    def connect(self):
+        connection = sqlite3.connect(
+            self.path,
+            timeout=DB_POOL_BORROW_TIMEOUT,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False  # соединение переходит между потоками db_executor через пул
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return SQLiteConnection(connection)
+
+    def begin_write(self, cursor):
+        # sqlite3 сам открывает транзакцию только перед INSERT/UPDATE, так что SELECT перед ними
+        # читает без блокировки; BEGIN IMMEDIATE сразу берёт блокировку записи
+        cursor.execute("BEGIN IMMEDIATE")
+
+    def describe(self) -> str:
+        return f"SQLite at {os.path.abspath(self.path)}"
+
+    def excluded(self, column: str) -> str:
+        return f"excluded.{column}"
+
+    def _upsert_clause(self, keys: List[str], updates: Dict[str, str]) -> str:
+        target = f"ON CONFLICT ({', '.join(keys)})"
+        if not updates:
+            return f"{target} DO NOTHING"
+        return f"{target} DO UPDATE SET " + ", ".join(f"{column} = {expr}" for column, expr in updates.items())
+
+    def column_exists(self, cursor, table: str, column: str) -> bool:
+        cursor.execute(f"PRAGMA table_info({table})")
+        return any(row['name'] == column for row in cursor.fetchall())
+
+    def index_exists(self, cursor, table: str, index_name: str) -> bool:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = %s",
+            (f"{table}_{index_name}",)
+        )
+        return cursor.fetchone() is not None
+
+    def create_index(self, cursor, table: str, index_name: str, columns: str):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_{index_name} ON {table} ({columns})")
+
+    def stream_cursor(self, connection):
+        return connection.cursor(as_dict=False)
+
+
+def create_storage() -> StorageBackend:
+    """Бэкенд хранилища по DB_BACKEND"""
+    if DB_BACKEND == "mysql":
+        return MySQLStorage(DB_CONFIG)
+    if DB_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    raise RuntimeError(f"❌ Неизвестный DB_BACKEND={DB_BACKEND!r} (ожидается mysql или sqlite)")
+
+
+db_storage = create_storage()
+
+
+# ==================== ПУЛ СОЕДИНЕНИЙ ====================
+
+class PoolExhaustedError(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+    pass
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений БД
+
+    - держит от min_size до max_size соединений
+    - закрывает соединения, простаивавшие дольше recycle_seconds
+    - проверяет соединение ping'ом при выдаче, если оно простаивало дольше ping_after_seconds
+    - собирает статистику (ожидание выдачи, занятые соединения, сэкономленные handshake'и)
+    """
+
+    def __init__(
+            self,
+            connect: Callable[[], Any],
+            min_size: int = 2,
+            max_size: int = 10,
+            recycle_seconds: int = 1800,
+            ping_after_seconds: int = 5,
+            borrow_timeout: int = 30
+    ):
+        self.connect = connect
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.recycle_seconds = recycle_seconds
+        self.ping_after_seconds = ping_after_seconds
+        self.borrow_timeout = borrow_timeout
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # [(connection, released_at)] — справа самые "тёплые"
+        self._size = 0  # всего открытых соединений (свободные + занятые)
+        self._in_use = 0
+        self._closed = False
+
+        # Статистика
+        self._borrows = 0
+        self._handshakes = 0
+        self._recycled = 0
+        self._failed_pings = 0
+        self._discarded = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        connection = self.connect()
+        with self._cond:
+            self._handshakes += 1
+        return connection
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def warm_up(self):
+        """Открывает min_size соединений заранее"""
+        created = []
+        with self._cond:
+            need = max(0, self.min_size - self._size)
+            self._size += need
+        try:
+            for _ in range(need):
+                created.append(self._connect())
+        finally:
+            now = time.monotonic()
+            with self._cond:
+                self._size -= need - len(created)
+                for connection in created:
+                    self._idle.append((connection, now))
+                self._cond.notify_all()
+        logger.info(f"DB pool warmed up: {len(created)} connections")
+
+    def acquire(self):
+        """Выдаёт соединение из пула (или открывает новое, если есть место)"""
+        started = time.monotonic()
+        deadline = started + self.borrow_timeout
+        stale = []
+        connection = None
+        released_at = None
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolExhaustedError("DB pool is closed")
+
+                # Выбрасываем слишком долго простаивавшие соединения (самые старые — слева)
+                now = time.monotonic()
+                while self._idle and now - self._idle[0][1] > self.recycle_seconds:
+                    stale.append(self._idle.popleft()[0])
+                    self._size -= 1
+                    self._recycled += 1
+
+                if self._idle:
+                    connection, released_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolExhaustedError(
+                        f"No free DB connection after {self.borrow_timeout}s (max_size={self.max_size})"
+                    )
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+
+        for old in stale:
+            self._close_quietly(old)
+
+        try:
+            if connection is None:
+                connection = self._connect()
+            elif time.monotonic() - released_at > self.ping_after_seconds:
+                connection = self._ping_or_reconnect(connection)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._borrows += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        return connection
+
+    def _ping_or_reconnect(self, connection):
+        """Health-check соединения перед выдачей"""
+        try:
+            connection.ping(reconnect=False)
+            return connection
+        except Exception:
+            with self._cond:
+                self._failed_pings += 1
+            self._close_quietly(connection)
+            return self._connect()
+
+    def release(self, connection, discard: bool = False):
+        """Возвращает соединение в пул (или закрывает его, если оно сломано)"""
+        if not discard and not getattr(connection, "open", False):
+            discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._size -= 1
+                if discard:
+                    self._discarded += 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+                connection = None
+            self._cond.notify()
+
+        if connection is not None:
+            self._close_quietly(connection)
+
+    def close(self):
+        """Закрывает все свободные соединения; занятые закроются при возврате"""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for connection in idle:
+            self._close_quietly(connection)
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика пула"""
+        with self._cond:
+            borrows = self._borrows
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "borrows": borrows,
+                "handshakes": self._handshakes,
+                "handshakes_saved": max(0, borrows - self._handshakes),
+                "recycled": self._recycled,
+                "failed_pings": self._failed_pings,
+                "discarded": self._discarded,
+                "timeouts": self._timeouts,
+                "wait_avg_ms": (self._wait_total / borrows * 1000) if borrows else 0.0,
+                "wait_max_ms": self._wait_max * 1000,
+            }
+
+
+db_pool = ConnectionPool(
+    db_storage.connect,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    recycle_seconds=DB_POOL_RECYCLE_SECONDS,
+    ping_after_seconds=DB_POOL_PING_AFTER_SECONDS,
+    borrow_timeout=DB_POOL_BORROW_TIMEOUT
+)
+
+
+# ==================== ИНСТРУМЕНТАЦИЯ ЗАПРОСОВ ====================
+
+# Верхние границы корзин гистограммы задержек, мс (последняя корзина — всё, что дольше)
+QUERY_LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_TEXT_LIMIT = 300
+
+
+def redact_params(params) -> str:
+    """Параметры запроса для лога: только типы и длины, без значений"""
+    if params is None:
+        return "()"
+
+    def shape(value) -> str:
+        if value is None:
+            return "NULL"
+        if isinstance(value, (bytes, bytearray, str)):
+            return f"<{type(value).__name__}:{len(value)}>"
+        return f"<{type(value).__name__}>"
+
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {shape(value)}" for key, value in params.items()) + "}"
+    return "(" + ", ".join(shape(value) for value in params) + ")"
+
+
+def estimate_row_bytes(row) -> int:
+    """Примерный объём строки результата: длина строк/байтов, 8 байт на прочие значения"""
+    if row is None:
+        return 0
+    size = 0
+    for value in (row.values() if isinstance(row, dict) else row):
+        if isinstance(value, (bytes, bytearray, str)):
+            size += len(value)
+        elif value is not None:
+            size += 8
+    return size
+
+
+class QueryStats:
+    """Статистика запросов по (место вызова, текст запроса) с момента запуска
+
+    Для каждого запроса: число вызовов и ошибок, суммарное и максимальное время,
+    гистограмма задержек, строк прочитано/затронуто и примерный объём результата.
+    """
+
+    def __init__(self, slow_ms: int):
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._entries: Dict[tuple, Dict[str, Any]] = {}
+        self.slow_logged = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.split())[:QUERY_TEXT_LIMIT]
+
+    def _entry(self, key: tuple) -> Dict[str, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {
+                "site": key[0],
+                "query": key[1],
+                "calls": 0,
+                "errors": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "rows": 0,
+                "bytes": 0,
+                "histogram": [0] * (len(QUERY_LATENCY_BUCKETS_MS) + 1),
+            }
+        return entry
+
+    def record(self, site: str, query: str, elapsed_ms: float, params_text: str, error: bool = False) -> tuple:
+        """Учитывает выполнение запроса; возвращает ключ для add_rows()"""
+        key = (site, self.normalize(query))
+        bucket = len(QUERY_LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(QUERY_LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            entry = self._entry(key)
+            entry["calls"] += 1
+            entry["errors"] += int(error)
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            entry["histogram"][bucket] += 1
+            slow = elapsed_ms >= self.slow_ms
+            if slow:
+                self.slow_logged += 1
+
+        if slow:
+            logger.warning(f"Slow query {elapsed_ms:.1f} ms [{site}] {key[1]} params={params_text}")
+        return key
+
+    def add_rows(self, key: tuple, rows: int, size: int = 0):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["rows"] += rows
+                entry["bytes"] += size
+
+    @staticmethod
+    def percentile_ms(entry: Dict[str, Any], fraction: float) -> float:
+        """Оценка перцентиля по гистограмме (верхняя граница корзины)"""
+        threshold = entry["calls"] * fraction
+        seen = 0
+        for i, count in enumerate(entry["histogram"]):
+            seen += count
+            if count and seen >= threshold:
+                return QUERY_LATENCY_BUCKETS_MS[i] if i < len(QUERY_LATENCY_BUCKETS_MS) else entry["max_ms"]
+        return entry["max_ms"]
+
+    def top(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Самые медленные запросы (по максимальному времени)"""
+        with self._lock:
+            entries = [dict(entry, histogram=list(entry["histogram"])) for entry in self._entries.values()]
+        entries.sort(key=lambda entry: entry["max_ms"], reverse=True)
+        for entry in entries[:limit]:
+            entry["avg_ms"] = entry["total_ms"] / entry["calls"] if entry["calls"] else 0.0
+            entry["p95_ms"] = self.percentile_ms(entry, 0.95)
+        return entries[:limit]
+
+    def totals(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "statements": len(self._entries),
+                "calls": sum(entry["calls"] for entry in self._entries.values()),
+                "errors": sum(entry["errors"] for entry in self._entries.values()),
+                "slow": self.slow_logged,
+            }
+
+
+query_stats = QueryStats(DB_SLOW_QUERY_MS)
+
+
+def query_call_site(depth: int = 2) -> str:
+    """Место вызова запроса: функция, которая открыла соединение и вызвала execute
+
+    Вспомогательные функции, получающие готовый cursor (bump_order_rollup,
+    insert_order_items, column_exists, is_migration_done, ...), пропускаются:
+    запрос приписывается вызвавшему их коду — "save_base_order/bump_order_rollup".
+    """
+    frame = sys._getframe(depth)
+    helper = None
+    while frame.f_back is not None and "cursor" in frame.f_code.co_varnames[:frame.f_code.co_argcount]:
+        if helper is None:
+            helper = frame.f_code.co_name
+        frame = frame.f_back
+    site = frame.f_code.co_name
+    return f"{site}/{helper}" if helper else site
+
+
+class InstrumentedCursor:
+    """Курсор, который замеряет каждый запрос и помечает его местом вызова
+
+    Место вызова — функция, вызвавшая execute (get_order_raw, save_base_order, ...),
+    см. query_call_site().
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._key = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _run(self, method, query: str, params, params_text: str, site: str):
+        started = time.perf_counter()
+        error = False
+        try:
+            return method(query, params)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._key = query_stats.record(site, query, elapsed_ms, params_text, error)
+            if not error and self._cursor.description is None:
+                query_stats.add_rows(self._key, max(self._cursor.rowcount, 0))
+
+    def execute(self, query: str, params=None):
+        return self._run(self._cursor.execute, query, params, redact_params(params), query_call_site())
+
+    def executemany(self, query: str, rows):
+        rows = list(rows)
+        return self._run(self._cursor.executemany, query, rows, f"<{len(rows)} rows>", query_call_site())
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None and self._key:
+            query_stats.add_rows(self._key, 1, estimate_row_bytes(row))
+        return row
+
+    def fetchmany(self, size: int):
+        rows = self._cursor.fetchmany(size)
+        if rows and self._key:
+            query_stats.add_rows(self._key, len(rows), sum(estimate_row_bytes(row) for row in rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        if rows and self._key:
+            query_stats.add_rows(self._key, len(rows), sum(estimate_row_bytes(row) for row in rows))
+        return rows
+
+
+class InstrumentedConnection:
+    """Соединение из пула, чьи курсоры учитываются в query_stats"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs) -> InstrumentedCursor:
+        return InstrumentedCursor(self._connection.cursor(*args, **kwargs))
+
+
+@contextmanager
+def get_db_connection():
+    """Контекстный менеджер для соединения с БД из пула (запросы учитываются в query_stats)"""
+    connection = None
+    broken = False
+    try:
+        connection = db_pool.acquire()
+        yield InstrumentedConnection(connection)
+        connection.commit()
+    except Exception as e:
+        if connection:
+            try:
+                connection.rollback()
+            except Exception:
+                broken = True
+            if isinstance(e, db_storage.disconnect_errors):
+                broken = True
+        logger.exception(f"Database error: {e}")
+        raise
+    finally:
+        if connection:
+            db_pool.release(connection, discard=broken)
+
+
+# ==================== RATE LIMITING MIDDLEWARE ====================
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Middleware для ограничения частоты запросов"""
+
+    def __init__(
+            self,
+            message_limit: int = 20,
+            message_window: int = 60,
+            order_cooldown: int = 60,
+            admin_ids: List[int] = None
+    ):
+        super().__init__()
+        self.message_limit = message_limit
+        self.message_window = timedelta(seconds=message_window)
+        self.order_cooldown = timedelta(seconds=order_cooldown)
+        self.admin_ids = admin_ids or []
+
+        self.message_timestamps: Dict[int, list] = defaultdict(list)
+        self.last_order_time: Dict[int, datetime] = {}
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        if not isinstance(event, Message):
+            return await handler(event, data)
+
+        message: Message = event
+        user_id = message.from_user.id
+
+        # Админы пропускаются
+        if user_id in self.admin_ids:
+            return await handler(event, data)
+
+        now = datetime.now()
+
+        # Очистка старых меток
+        self._cleanup_old_timestamps(user_id, now)
+
+        # Проверка лимита
+        if not self._check_message_rate(user_id, now):
+            logger.warning(f"Rate limit exceeded for user {user_id}")
+            await message.answer("⚠️ Слишком много запросов. Пожалуйста, подождите немного.")
+            return
+
+        self.message_timestamps[user_id].append(now)
+        return await handler(event, data)
+
+    def _cleanup_old_timestamps(self, user_id: int, now: datetime):
+        cutoff = now - self.message_window
+        self.message_timestamps[user_id] = [
+            ts for ts in self.message_timestamps[user_id] if ts > cutoff
+        ]
+
+    def _check_message_rate(self, user_id: int, now: datetime) -> bool:
+        return len(self.message_timestamps[user_id]) < self.message_limit
+
+    def check_order_cooldown(self, user_id: int) -> tuple[bool, int]:
+        """Проверяет, можно ли пользователю создать заказ"""
+        now = datetime.now()
+        last_order = self.last_order_time.get(user_id)
+
+        if last_order is None:
+            return True, 0
+
+        time_passed = now - last_order
+        if time_passed >= self.order_cooldown:
+            return True, 0
+
+        remaining = (self.order_cooldown - time_passed).total_seconds()
+        return False, int(remaining)
+
+    def register_order(self, user_id: int):
+        """Регистрирует новый заказ"""
+        self.last_order_time[user_id] = datetime.now()
+
+
+# Глобальный экземпляр rate limiter
+rate_limiter = RateLimitMiddleware(
+    message_limit=20,
+    message_window=60,
+    order_cooldown=ORDER_COOLDOWN_SECONDS,
+    admin_ids=ALL_ADMIN_IDS
+)
+
+# ==================== WEBAPP TIMER MIDDLEWARE ====================
+
+class WebAppTimerMiddleware(BaseMiddleware):
+    """Middleware для проверки активности кнопки WebApp"""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        # Проверяем, является ли событие сообщением с web_app_data
+        if isinstance(event, Message) and event.web_app_data:
+            user_id = event.from_user.id
+            logger.info(f"[TIMER MIDDLEWARE] WebApp data received from user {user_id}")
+
+            # Проверяем, активна ли кнопка
+            if not is_webapp_button_active(user_id):
+                logger.warning(f"[TIMER MIDDLEWARE] BLOCKING WebApp for user {user_id} - timer expired!")
+
+                # Отправляем сообщение без определения языка (или используем русский по умолчанию)
+                await event.answer(
+                    "⏰ Время действия кнопки истекло.\n"
+                    "Пожалуйста, нажмите /start для создания нового заказа.\n\n"
+                    "⏰ Tugma faolligi tugadi.\n"
+                    "Iltimos, yangi buyurtma yaratish uchun /start ni bosing.",
+                    reply_markup=ReplyKeyboardRemove()
+                )
+
+                return  # Прерываем обработку
+
+            logger.info(f"[TIMER MIDDLEWARE] ALLOWING WebApp for user {user_id} - timer active")
+
+        # Продолжаем обработку
+        return await handler(event, data)
+
+
+
+# ==================== КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ ====================
+
+class UserContext:
+    """Контекст пользователя (язык, профиль, статус дилера), собранный один раз на апдейт"""
+
+    __slots__ = ("user_id", "lang", "profile")
+
+    def __init__(self, user_id: int, lang: str, profile: Dict[str, Any]):
+        self.user_id = user_id
+        self.lang = lang
+        self.profile = profile
+
+    @property
+    def full_name(self) -> Optional[str]:
+        return self.profile.get("full_name")
+
+    @property
+    def is_registered(self) -> bool:
+        return all(k in self.profile for k in ["phone", "city", "full_name"])
+
+    @property
+    def dealer_status(self) -> Optional[dict]:
+        """Последний известный статус дилера (без запроса в Google Sheets)"""
+        return dealer_cache.get(self.user_id)
+
+    @property
+    def is_dealer_active(self) -> bool:
+        return is_dealer_active(self.user_id)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Middleware, передающее хендлерам user_ctx: UserContext"""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is not None:
+            data["user_ctx"] = await users_repo.get_context(user.id)
+        return await handler(event, data)
+
+
+# ==================== ВАЛИДАЦИЯ ДАННЫХ ====================
+
+class ValidationError(Exception):
+    """Ошибка валидации"""
+    pass
+
+
+class OrderDataValidator:
+    """Валидатор данных заказа от WebApp"""
+
+    @staticmethod
+    def validate_order_data(data: Any) -> Dict[str, Any]:
+        """Валидирует данные заказа"""
+        if not isinstance(data, dict):
+            raise ValidationError("Данные должны быть объектом")
+
+        if "items" not in data:
+            raise ValidationError("Отсутствует поле items")
+
+        if "total" not in data:
+            raise ValidationError("Отсутствует поле total")
+
+        items = data["items"]
+        if not isinstance(items, list):
+            raise ValidationError("items должен быть массивом")
 
         if len(items) == 0:
             raise ValidationError("Заказ не может быть пустым")
@@ -793,15 +2230,136 @@ class OrderDataValidator:
         return data
 
 
+# ==================== ХРАНИЛИЩЕ PDF (BLOB STORE) ====================
+
+class BlobBackend:
+    """Интерфейс бэкенда для BlobStore (локальный диск, S3, FTP, ...)"""
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def put(self, key: str, data: bytes):
+        raise NotImplementedError
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+
+class LocalDiskBlobBackend(BlobBackend):
+    """Хранение блобов на локальном диске: <root>/<ab>/<cd>/<key>"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Пишем во временный файл и атомарно переименовываем — читатель никогда не увидит половину файла
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class BlobStore:
+    """Content-addressed хранилище: одинаковое содержимое хранится один раз"""
+
+    def __init__(self, backend: BlobBackend):
+        self.backend = backend
+
+    @staticmethod
+    def make_key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data: bytes) -> tuple[str, int]:
+        """Сохраняет данные и возвращает (hash, size)"""
+        key = self.make_key(data)
+        if not self.backend.exists(key):
+            self.backend.put(key, data)
+        return key, len(data)
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not key:
+            return None
+        return self.backend.get(key)
+
+
+blob_store = BlobStore(LocalDiskBlobBackend(BLOB_STORE_DIR))
+
+
 # ==================== БАЗА ДАННЫХ ====================
 
+def ensure_column(cursor, table: str, column: str, definition: str):
+    """Добавляет колонку в существующую таблицу, если её ещё нет"""
+    if not db_storage.column_exists(cursor, table, column):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        logger.info(f"Added column {table}.{column}")
+
+
+def ensure_index(cursor, table: str, index_name: str, columns: str):
+    """Создаёт индекс в существующей таблице, если его ещё нет"""
+    if not db_storage.index_exists(cursor, table, index_name):
+        db_storage.create_index(cursor, table, index_name, columns)
+        logger.info(f"Added index {table}.{index_name}")
+
+
+# Вторичные индексы: (таблица, имя, колонки). Создаются отдельно от CREATE TABLE,
+# чтобы DDL таблиц был общим для MySQL и SQLite.
+TABLE_INDEXES = [
+    ("users", "idx_phone", "phone"),
+    ("users", "idx_created_at", "created_at"),
+    # Подсчёт активных пользователей диапазоном, без полного скана users
+    ("users", "idx_last_activity", "last_activity"),
+    ("orders", "idx_user_id", "user_id"),
+    ("orders", "idx_status", "status"),
+    ("orders", "idx_created_at", "created_at"),
+    ("orders", "idx_base_order_id", "base_order_id"),
+    # Постраничный просмотр заказов пользователя (keyset pagination)
+    ("orders", "idx_user_created", "user_id, created_at, order_id"),
+    ("order_items", "idx_product_id", "product_id"),
+    ("order_items", "idx_category", "category"),
+    ("client_notifications", "idx_user_id", "user_id"),
+]
+
+
 def init_db():
-    """Инициализация базы данных MySQL с новыми статусами"""
+    """Инициализация базы данных с новыми статусами"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
         # Создаем таблицу пользователей
-        cursor.execute("""
+        cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
                 username VARCHAR(255),
@@ -814,14 +2372,12 @@ def init_db():
                 latitude DECIMAL(10, 7),
                 longitude DECIMAL(10, 7),
                 created_at DATETIME NOT NULL,
-                last_activity DATETIME,
-                INDEX idx_phone (phone),
-                INDEX idx_created_at (created_at)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                last_activity DATETIME
+            ) {db_storage.table_options}
         """)
         
         # Создаем таблицу заказов
-        cursor.execute("""
+        cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS orders (
                 order_id VARCHAR(50) PRIMARY KEY,
                 client_name VARCHAR(255) NOT NULL,
@@ -831,6 +2387,10 @@ def init_db():
                 status VARCHAR(50) DEFAULT 'pending',
                 pdf_draft LONGBLOB,
                 pdf_final LONGBLOB,
+                pdf_draft_hash CHAR(64),
+                pdf_draft_size INT,
+                pdf_final_hash CHAR(64),
+                pdf_final_size INT,
                 order_json TEXT,
                 approved_by BIGINT,
                 production_received_by BIGINT,
@@ -838,182 +2398,529 @@ def init_db():
                 sent_to_warehouse_by BIGINT,
                 warehouse_received_by BIGINT,
                 category VARCHAR(50),
-                base_order_id VARCHAR(50),
-                INDEX idx_user_id (user_id),
-                INDEX idx_status (status),
-                INDEX idx_created_at (created_at),
-                INDEX idx_base_order_id (base_order_id)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                base_order_id VARCHAR(50)
+            ) {db_storage.table_options}
+        """)
+
+        # Ссылки на PDF в blob store (для таблиц, созданных до его появления)
+        ensure_column(cursor, "orders", "pdf_draft_hash", "CHAR(64)")
+        ensure_column(cursor, "orders", "pdf_draft_size", "INT")
+        ensure_column(cursor, "orders", "pdf_final_hash", "CHAR(64)")
+        ensure_column(cursor, "orders", "pdf_final_size", "INT")
+
+        # Позиции заказов (нормализованная копия order_json["items"] для подсчётов и отчётов)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS order_items (
+                order_id VARCHAR(50) NOT NULL,
+                line_no SMALLINT NOT NULL,
+                product_id INT NOT NULL,
+                qty INT NOT NULL,
+                price DECIMAL(15, 2) NOT NULL DEFAULT 0,
+                weight DECIMAL(12, 3) NOT NULL DEFAULT 0,
+                cube DECIMAL(12, 4) NOT NULL DEFAULT 0,
+                category VARCHAR(50),
+                PRIMARY KEY (order_id, line_no)
+            ) {db_storage.table_options}
+        """)
+
+        # Дневные сводки статистики (обновляются инкрементально, см. bump_*_rollup)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS stats_daily_users (
+                day DATE PRIMARY KEY,
+                new_users INT NOT NULL DEFAULT 0,
+                active_users INT NOT NULL DEFAULT 0
+            ) {db_storage.table_options}
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS stats_daily_orders (
+                day DATE NOT NULL,
+                category VARCHAR(50) NOT NULL DEFAULT '',
+                status VARCHAR(50) NOT NULL,
+                order_count INT NOT NULL DEFAULT 0,
+                revenue DECIMAL(18, 2) NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, category, status)
+            ) {db_storage.table_options}
+        """)
+
+        # Выполненные одноразовые миграции данных
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS app_migrations (
+                name VARCHAR(100) PRIMARY KEY,
+                completed_at DATETIME NOT NULL
+            ) {db_storage.table_options}
         """)
 
         # Создаем таблицу уведомлений клиентов
-        cursor.execute("""
+        cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS client_notifications (
                 base_order_id VARCHAR(50) PRIMARY KEY,
                 user_id BIGINT NOT NULL,
                 message_id BIGINT NOT NULL,
-                created_at DATETIME NOT NULL,
-                INDEX idx_user_id (user_id)
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                created_at DATETIME NOT NULL
+            ) {db_storage.table_options}
         """)
 
+        # Вторичные индексы всех таблиц
+        for table, index_name, columns in TABLE_INDEXES:
+            ensure_index(cursor, table, index_name, columns)
+
         conn.commit()
         logger.info("✅ Database tables created/verified")
 
 
+MIGRATION_BATCH_SIZE = 1000
+
+# Колонки профиля, которые перезаписывает upsert профиля пользователя
+USER_PROFILE_COLUMNS = ["phone", "city", "full_name", "latitude", "longitude"]
+
+
+def is_migration_done(cursor, name: str) -> bool:
+    """Проверяет отметку о выполненной миграции"""
+    cursor.execute("SELECT 1 FROM app_migrations WHERE name = %s", (name,))
+    return cursor.fetchone() is not None
+
+
+def mark_migration_done(cursor, name: str):
+    """Ставит отметку о выполненной миграции"""
+    cursor.execute(f"""
+        INSERT INTO app_migrations (name, completed_at) VALUES (%s, %s)
+        {db_storage.on_conflict(["name"], ["completed_at"])}
+    """, (name, datetime.now()))
+
+
+def iter_chunks(iterable, size: int):
+    """Разбивает поток на списки по size элементов"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def migrate_users_from_files():
-    """Миграция данных пользователей из локальных файлов в базу данных"""
+    """Разовый перенос пользователей из локальных файлов в базу данных
+
+    Все файлы импортируются одной транзакцией пачками executemany-upsert'ов;
+    после успеха ставится отметка в app_migrations и следующие запуски миграцию пропускают.
+    """
+    migration_name = "users_from_files"
+
+    if not any(os.path.exists(path) for path in (USERS_FILE, LANG_FILE, PROFILE_FILE)):
+        return
+
     try:
-        migrated_count = 0
-        
-        # Миграция user IDs из users.txt
-        if os.path.exists(USERS_FILE):
-            logger.info("Migrating users from users.txt...")
-            with open(USERS_FILE, "r", encoding="utf-8") as f:
-                user_ids = [int(line.strip()) for line in f if line.strip()]
-            
-            for user_id in user_ids:
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT user_id FROM users WHERE user_id = %s", (user_id,))
-                    if not cursor.fetchone():
-                        cursor.execute("""
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            if is_migration_done(cursor, migration_name):
+                logger.info("User files migration already done, skipping")
+                return
+
+            now = datetime.now()
+
+            # Миграция user IDs из users.txt (читаем построчно)
+            if os.path.exists(USERS_FILE):
+                logger.info("Migrating users from users.txt...")
+                count = 0
+                with open(USERS_FILE, "r", encoding="utf-8") as f:
+                    rows = (
+                        (int(line.strip()), now, now, 'ru')
+                        for line in f if line.strip().isdigit()
+                    )
+                    for chunk in iter_chunks(rows, MIGRATION_BATCH_SIZE):
+                        cursor.executemany(f"""
                             INSERT INTO users (user_id, created_at, last_activity, language)
                             VALUES (%s, %s, %s, %s)
-                        """, (user_id, datetime.now(), datetime.now(), 'ru'))
-                        conn.commit()
-                        migrated_count += 1
-            
-            logger.info(f"Migrated {migrated_count} users from users.txt")
-        
-        # Миграция языков из user_lang.json
-        if os.path.exists(LANG_FILE):
-            logger.info("Migrating languages from user_lang.json...")
-            with open(LANG_FILE, "r", encoding="utf-8") as f:
-                lang_data = json.load(f)
-            
-            for user_id_str, lang in lang_data.items():
-                user_id = int(user_id_str)
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        UPDATE users SET language = %s WHERE user_id = %s
-                    """, (lang, user_id))
-                    conn.commit()
-            
-            logger.info(f"Migrated languages for {len(lang_data)} users")
-        
-        # Миграция профилей из user_profile.json
-        if os.path.exists(PROFILE_FILE):
-            logger.info("Migrating profiles from user_profile.json...")
-            with open(PROFILE_FILE, "r", encoding="utf-8") as f:
-                profile_data = json.load(f)
-            
-            for user_id_str, profile in profile_data.items():
-                user_id = int(user_id_str)
-                with get_db_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        UPDATE users 
-                        SET phone = %s, city = %s, full_name = %s, latitude = %s, longitude = %s
-                        WHERE user_id = %s
-                    """, (
+                            {db_storage.on_conflict(["user_id"])}
+                        """, chunk)
+                        count += len(chunk)
+                logger.info(f"Migrated {count} users from users.txt")
+
+            # Миграция языков из user_lang.json
+            if os.path.exists(LANG_FILE):
+                logger.info("Migrating languages from user_lang.json...")
+                with open(LANG_FILE, "r", encoding="utf-8") as f:
+                    lang_data = json.load(f)
+
+                rows = ((int(user_id_str), now, now, lang) for user_id_str, lang in lang_data.items())
+                for chunk in iter_chunks(rows, MIGRATION_BATCH_SIZE):
+                    cursor.executemany(f"""
+                        INSERT INTO users (user_id, created_at, last_activity, language)
+                        VALUES (%s, %s, %s, %s)
+                        {db_storage.on_conflict(["user_id"], ["language"])}
+                    """, chunk)
+                logger.info(f"Migrated languages for {len(lang_data)} users")
+                del lang_data
+
+            # Миграция профилей из user_profile.json
+            if os.path.exists(PROFILE_FILE):
+                logger.info("Migrating profiles from user_profile.json...")
+                with open(PROFILE_FILE, "r", encoding="utf-8") as f:
+                    profile_data = json.load(f)
+
+                rows = (
+                    (
+                        int(user_id_str),
                         profile.get('phone'),
                         profile.get('city'),
                         profile.get('full_name'),
                         profile.get('latitude'),
                         profile.get('longitude'),
-                        user_id
-                    ))
-                    conn.commit()
-            
-            logger.info(f"Migrated profiles for {len(profile_data)} users")
-        
+                        now,
+                        now,
+                        'ru'
+                    )
+                    for user_id_str, profile in profile_data.items()
+                )
+                for chunk in iter_chunks(rows, MIGRATION_BATCH_SIZE):
+                    cursor.executemany(f"""
+                        INSERT INTO users (user_id, phone, city, full_name, latitude, longitude,
+                                           created_at, last_activity, language)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        {db_storage.on_conflict(["user_id"], USER_PROFILE_COLUMNS)}
+                    """, chunk)
+                logger.info(f"Migrated profiles for {len(profile_data)} users")
+                del profile_data
+
+            mark_migration_done(cursor, migration_name)
+            conn.commit()
+
         logger.info("✅ User data migration completed successfully")
-        
+
     except Exception as e:
         logger.exception("❌ Error during user data migration")
 
 
+def order_item_rows(order_id: str, items: list) -> List[tuple]:
+    """Строки order_items для позиций заказа (line_no — порядок позиции в заказе)"""
+    rows = []
+    for line_no, item in enumerate(items):
+        rows.append((
+            order_id,
+            line_no,
+            int(item.get("id", 0) or 0),
+            int(item.get("qty", 0) or 0),
+            item.get("price", 0) or 0,
+            float(item.get("weight", 0) or 0),
+            float(item.get("cube", 0) or 0),
+            item.get("category"),
+        ))
+    return rows
+
+
+def insert_order_items(cursor, rows: List[tuple]):
+    """Пишет позиции заказов одним executemany (повторная запись тех же строк игнорируется)"""
+    if not rows:
+        return
+    cursor.executemany(f"""
+        {db_storage.insert_ignore} INTO order_items (order_id, line_no, product_id, qty, price, weight, cube, category)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, rows)
+
+
 def save_order(order_id: str, client_name: str, user_id: int, total: float,
                pdf_draft: bytes, order_json: dict, category: str = None, base_order_id: str = None):
-    """Сохранение нового заказа"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO orders 
-            (order_id, client_name, user_id, total, created_at, status, pdf_draft, order_json, category, base_order_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            order_id,
+    """Сохранение нового заказа (PDF уходит в blob store, в строке — только ссылка)"""
+    save_base_order(base_order_id, client_name, user_id, [{
+        "order_id": order_id,
+        "total": total,
+        "pdf_draft": pdf_draft,
+        "order_json": order_json,
+        "category": category,
+    }])
+
+
+def save_base_order(base_order_id: str, client_name: str, user_id: int, sub_orders: List[Dict[str, Any]]):
+    """Сохранение всех частей (подзаказов по категориям) базового заказа одной транзакцией
+
+    sub_orders — список {"order_id", "total", "pdf_draft", "order_json", "category"}.
+    PDF записываются в blob store заранее (повторная запись того же содержимого безопасна),
+    затем строки orders, позиции order_items и сводка статистики пишутся на одном соединении
+    одним коммитом: частично сохранённого заказа не бывает.
+    """
+    now = datetime.now()
+    order_rows = []
+    item_rows = []
+    for sub_order in sub_orders:
+        pdf_draft = sub_order.get("pdf_draft")
+        pdf_draft_hash, pdf_draft_size = blob_store.put(pdf_draft) if pdf_draft else (None, None)
+        order_rows.append((
+            sub_order["order_id"],
             client_name,
             user_id,
-            total,
-            datetime.now(),
+            sub_order["total"],
+            now,
             OrderStatus.PENDING,
-            pdf_draft,
-            json.dumps(order_json, ensure_ascii=False),
-            category,
+            pdf_draft_hash,
+            pdf_draft_size,
+            json.dumps(sub_order["order_json"], ensure_ascii=False),
+            sub_order.get("category"),
             base_order_id
         ))
+        item_rows.extend(order_item_rows(sub_order["order_id"], sub_order["order_json"].get("items", [])))
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO orders 
+            (order_id, client_name, user_id, total, created_at, status, pdf_draft_hash, pdf_draft_size,
+             order_json, category, base_order_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, order_rows)
+        insert_order_items(cursor, item_rows)
+        for sub_order in sub_orders:
+            bump_order_rollup(cursor, sub_order["order_id"], OrderStatus.PENDING, 1)
         conn.commit()
 
 
 def update_order_status(order_id: str, new_status: str, pdf_final: bytes = None, updated_by: int = None):
-    """Обновление статуса заказа"""
+    """Безусловное обновление статуса заказа одним UPDATE (для переходов из хендлеров — transition_order_status)"""
+    set_parts = ["status = %s"]
+    params = [new_status]
+
+    if pdf_final:
+        pdf_final_hash, pdf_final_size = blob_store.put(pdf_final)
+        set_parts.append("pdf_final_hash = %s, pdf_final_size = %s")
+        params += [pdf_final_hash, pdf_final_size]
+
+    # Имя колонки берётся только из белого списка ORDER_STATUS_BY_COLUMNS
+    if updated_by and new_status in ORDER_STATUS_BY_COLUMNS:
+        set_parts.append(f"{ORDER_STATUS_BY_COLUMNS[new_status]} = %s")
+        params.append(updated_by)
+
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        # Старый статус нужен, чтобы перенести заказ в сводке stats_daily_orders; читаем его
+        # уже внутри пишущей транзакции, иначе параллельные обновления сдвинут сводку дважды
+        db_storage.begin_write(cursor)
+        cursor.execute(f"SELECT status FROM orders WHERE order_id = %s{db_storage.for_update}", (order_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return
+        cursor.execute(f"UPDATE orders SET {', '.join(set_parts)} WHERE order_id = %s", (*params, order_id))
+        old_status = row['status'] or OrderStatus.PENDING
+        if old_status != new_status:
+            bump_order_rollup(cursor, order_id, old_status, -1)
+            bump_order_rollup(cursor, order_id, new_status, 1)
+        conn.commit()
 
-        # Определяем, какое поле обновлять
-        field_map = {
-            OrderStatus.APPROVED: "approved_by",
-            OrderStatus.PRODUCTION_RECEIVED: "production_received_by",
-            OrderStatus.PRODUCTION_STARTED: "production_started_by",
-            OrderStatus.SENT_TO_WAREHOUSE: "sent_to_warehouse_by",
-            OrderStatus.WAREHOUSE_RECEIVED: "warehouse_received_by"
-        }
 
-        if pdf_final:
-            cursor.execute("""
-                UPDATE orders 
-                SET status = %s, pdf_final = %s
-                WHERE order_id = %s
-            """, (new_status, pdf_final, order_id))
-        else:
-            cursor.execute("""
-                UPDATE orders 
-                SET status = %s
-                WHERE order_id = %s
-            """, (new_status, order_id))
-
-        # Обновляем поле с ID администратора
-        if updated_by and new_status in field_map:
-            field_name = field_map[new_status]
-            cursor.execute(f"""
-                UPDATE orders 
-                SET {field_name} = %s
-                WHERE order_id = %s
-            """, (updated_by, order_id))
+def transition_order_status(order_id: str, new_status: str, updated_by: int = None,
+                            expected_status: Optional[str] = None) -> bool:
+    """Атомарный переход статуса (compare-and-set)
+
+    Один UPDATE ... WHERE order_id = %s AND status = <ожидаемый>. Возвращает True,
+    только если переход выполнил именно этот вызов: повторное нажатие кнопки или
+    параллельный админ получат False и не повторят обработку.
+
+    expected_status задаёт исходный статус явно — для отката неудавшегося перехода
+    (например, approved -> pending); при откате колонка "кем выполнен" очищается.
+    """
+    if expected_status is None:
+        expected_status = ORDER_STATUS_TRANSITIONS.get(new_status)
+    if expected_status is None:
+        raise ValueError(f"Unknown status transition to {new_status!r}")
+
+    set_parts = ["status = %s"]
+    params = [new_status]
+    if updated_by and new_status in ORDER_STATUS_BY_COLUMNS:
+        set_parts.append(f"{ORDER_STATUS_BY_COLUMNS[new_status]} = %s")
+        params.append(updated_by)
+    if ORDER_STATUS_TRANSITIONS.get(expected_status) == new_status and expected_status in ORDER_STATUS_BY_COLUMNS:
+        set_parts.append(f"{ORDER_STATUS_BY_COLUMNS[expected_status]} = NULL")
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"UPDATE orders SET {', '.join(set_parts)} WHERE order_id = %s AND status = %s",
+            (*params, order_id, expected_status)
+        )
+        won = cursor.rowcount == 1
+        if won:
+            # Сводка меняется в той же транзакции, что и статус
+            bump_order_rollup(cursor, order_id, expected_status, -1)
+            bump_order_rollup(cursor, order_id, new_status, 1)
+        conn.commit()
+
+    if not won:
+        logger.info(f"Order {order_id}: transition to {new_status} skipped (status is not {expected_status})")
+    return won
 
+
+def attach_order_final_pdf(order_id: str, pdf_final: bytes):
+    """Сохраняет финальный PDF заказа в blob store и ссылку на него в заказе"""
+    pdf_final_hash, pdf_final_size = blob_store.put(pdf_final)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE orders 
+            SET pdf_final_hash = %s, pdf_final_size = %s
+            WHERE order_id = %s
+        """, (pdf_final_hash, pdf_final_size, order_id))
         conn.commit()
 
 
+# Колонки "заголовка" заказа — всё, что нужно для смены статуса и уведомлений, без PDF и order_json.
+# Количество товаров — подсчёт по первичному ключу order_items, без разбора order_json.
+ORDER_HEADER_COLUMNS = """
+    order_id, client_name, user_id, total, created_at, status, category, base_order_id,
+    approved_by, production_received_by, production_started_by, sent_to_warehouse_by, warehouse_received_by,
+    pdf_draft_hash, pdf_draft_size, pdf_final_hash, pdf_final_size,
+    (SELECT COUNT(*) FROM order_items WHERE order_items.order_id = orders.order_id) AS item_count
+"""
+
+
+def get_order_header(order_id: str) -> Optional[Dict[str, Any]]:
+    """Заголовок заказа (без PDF и order_json)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {ORDER_HEADER_COLUMNS} FROM orders WHERE order_id = %s", (order_id,))
+        row = cursor.fetchone()
+        if row:
+            return dict(row)
+        return None
+
+
 def get_order_raw(order_id: str) -> Optional[Dict[str, Any]]:
-    """Получение сырых данных заказа"""
+    """Получение данных заказа вместе с order_json (PDF — только через get_order_pdf)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM orders WHERE order_id = %s", (order_id,))
+        cursor.execute(f"SELECT {ORDER_HEADER_COLUMNS}, order_json FROM orders WHERE order_id = %s", (order_id,))
         row = cursor.fetchone()
         if row:
             return dict(row)
         return None
 
 
+def get_order_pdf(order_id: str) -> Optional[bytes]:
+    """Ленивая загрузка PDF заказа (финальный, иначе черновик)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pdf_draft_hash, pdf_final_hash FROM orders WHERE order_id = %s", (order_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        refs = dict(row)
+
+        # Строка ещё не перенесена в blob store — дочитываем старые колонки
+        if not refs['pdf_draft_hash'] and not refs['pdf_final_hash']:
+            cursor.execute("SELECT pdf_draft, pdf_final FROM orders WHERE order_id = %s", (order_id,))
+            refs.update(cursor.fetchone() or {})
+
+    return load_order_pdf(refs)
+
+
+def load_order_pdf(order: Dict[str, Any]) -> Optional[bytes]:
+    """PDF заказа: финальный, иначе черновик (из blob store или старых LONGBLOB-колонок)"""
+    for kind in ("pdf_final", "pdf_draft"):
+        pdf_bytes = blob_store.get(order.get(f"{kind}_hash"))
+        if not pdf_bytes:
+            pdf_bytes = order.get(kind)  # строки, ещё не перенесённые миграцией
+        if pdf_bytes:
+            return pdf_bytes
+    return None
+
+
+def migrate_order_pdfs_to_blob_store(batch_size: int = 20, stop_event: threading.Event = None) -> int:
+    """Переносит PDF из LONGBLOB-колонок orders в blob store пачками
+
+    Сначала блоб записывается в хранилище, и только потом колонка обнуляется,
+    поэтому прерванная миграция безопасно продолжается при следующем запуске.
+    stop_event прерывает перенос между пачками (остановка бота).
+    """
+    migrated = 0
+    while stop_event is None or not stop_event.is_set():
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT order_id, pdf_draft, pdf_final
+                FROM orders
+                WHERE pdf_draft IS NOT NULL OR pdf_final IS NOT NULL
+                LIMIT %s
+            """, (batch_size,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            for row in rows:
+                draft_hash, draft_size = blob_store.put(row['pdf_draft']) if row['pdf_draft'] else (None, None)
+                final_hash, final_size = blob_store.put(row['pdf_final']) if row['pdf_final'] else (None, None)
+                cursor.execute("""
+                    UPDATE orders
+                    SET pdf_draft_hash = COALESCE(%s, pdf_draft_hash),
+                        pdf_draft_size = COALESCE(%s, pdf_draft_size),
+                        pdf_final_hash = COALESCE(%s, pdf_final_hash),
+                        pdf_final_size = COALESCE(%s, pdf_final_size),
+                        pdf_draft = NULL,
+                        pdf_final = NULL
+                    WHERE order_id = %s
+                """, (draft_hash, draft_size, final_hash, final_size, row['order_id']))
+
+            conn.commit()
+            migrated += len(rows)
+
+    if migrated:
+        logger.info(f"✅ Moved PDFs of {migrated} orders to blob store (run OPTIMIZE TABLE orders to reclaim space)")
+    return migrated
+
+
+def migrate_order_items(batch_size: int = 500) -> int:
+    """Разовое заполнение order_items по order_json уже существующих заказов
+
+    Заказы читаются пачками по order_id; каждая пачка пишется своим коммитом через
+    INSERT IGNORE, поэтому прерванная миграция безопасно продолжается при следующем запуске.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if is_migration_done(cursor, "order_items"):
+            return 0
+
+    migrated = 0
+    last_order_id = ""
+    while True:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT order_id, order_json
+                FROM orders
+                WHERE order_id > %s
+                ORDER BY order_id
+                LIMIT %s
+            """, (last_order_id, batch_size))
+            orders = cursor.fetchall()
+            if not orders:
+                mark_migration_done(cursor, "order_items")
+                conn.commit()
+                break
+
+            rows = []
+            for order in orders:
+                try:
+                    items = json.loads(order['order_json'] or "{}").get("items", [])
+                    rows.extend(order_item_rows(order['order_id'], items))
+                except (ValueError, TypeError, AttributeError):
+                    logger.warning(f"Order {order['order_id']}: invalid order_json, items skipped")
+            insert_order_items(cursor, rows)
+            conn.commit()
+
+            migrated += len(orders)
+            last_order_id = orders[-1]['order_id']
+
+    if migrated:
+        logger.info(f"✅ Backfilled order_items for {migrated} orders")
+    return migrated
+
+
 def get_order_for_user(order_id: str, user_id: int) -> Optional[Dict[str, Any]]:
     """Получение заказа для конкретного пользователя"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM orders WHERE order_id = %s AND user_id = %s", (order_id, user_id))
+        cursor.execute(
+            f"SELECT {ORDER_HEADER_COLUMNS} FROM orders WHERE order_id = %s AND user_id = %s",
+            (order_id, user_id)
+        )
         row = cursor.fetchone()
         if row:
             return dict(row)
@@ -1024,29 +2931,121 @@ def get_all_orders(limit: int = 100) -> List[Dict[str, Any]]:
     """Получение всех заказов"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM orders ORDER BY created_at DESC LIMIT %s", (limit,))
+        cursor.execute(f"SELECT {ORDER_HEADER_COLUMNS} FROM orders ORDER BY created_at DESC LIMIT %s", (limit,))
         return [dict(row) for row in cursor.fetchall()]
 
 
-def get_user_orders(user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
-    """Получение заказов пользователя"""
+# Колонки CSV-выгрузки заказов
+EXPORT_COLUMNS = ["order_id", "client_name", "user_id", "total", "created_at", "status"]
+EXPORT_CHUNK_ROWS = 1000
+
+
+def export_orders_csv(date_from: datetime = None, date_to: datetime = None,
+                      status: str = None, compress: bool = False) -> tuple[str, int]:
+    """Потоковая выгрузка заказов в CSV-файл (опционально gzip)
+
+    Строки читаются server-side курсором и пишутся на диск пачками,
+    поэтому расход памяти не зависит от количества заказов.
+    Возвращает (путь к временному файлу, количество строк); файл удаляет вызывающий.
+    """
+    where = []
+    params = []
+    if date_from:
+        where.append("created_at >= %s")
+        params.append(date_from)
+    if date_to:
+        where.append("created_at < %s")
+        params.append(date_to + timedelta(days=1))
+    if status:
+        where.append("status = %s")
+        params.append(status)
+
+    query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM orders"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY created_at DESC"
+
+    fd, path = tempfile.mkstemp(prefix="orders_export_", suffix=".csv.gz" if compress else ".csv")
+    raw = os.fdopen(fd, "wb")
+    count = 0
+    try:
+        stream = gzip.GzipFile(fileobj=raw, mode="wb") if compress else raw
+        with io.TextIOWrapper(stream, encoding="utf-8-sig", newline="") as out:
+            writer = csv.writer(out, delimiter=";")
+            writer.writerow(EXPORT_COLUMNS)
+
+            with get_db_connection() as conn:
+                cursor = db_storage.stream_cursor(conn)
+                try:
+                    cursor.execute(query, params)
+                    while True:
+                        rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+                        if not rows:
+                            break
+                        writer.writerows(
+                            (order_id, client_name, user_id, total, created_at, status or "")
+                            for order_id, client_name, user_id, total, created_at, status in rows
+                        )
+                        count += len(rows)
+                finally:
+                    cursor.close()
+    except Exception:
+        raw.close()
+        os.remove(path)
+        raise
+
+    raw.close()
+    return path, count
+
+
+def get_user_orders(user_id: int, limit: int = 50, before: tuple = None,
+                    columns: str = ORDER_HEADER_COLUMNS) -> List[Dict[str, Any]]:
+    """Заказы пользователя от новых к старым (keyset pagination)
+
+    before — ключ (created_at, order_id) последнего заказа предыдущей страницы.
+    Запрос идёт по индексу idx_user_created, поэтому стоимость страницы не зависит
+    от того, насколько глубоко пользователь пролистал историю.
+    """
+    query = f"SELECT {columns} FROM orders WHERE user_id = %s"
+    params = [user_id]
+    if before:
+        created_at, order_id = before
+        query += " AND (created_at < %s OR (created_at = %s AND order_id < %s))"
+        params += [created_at, created_at, order_id]
+    query += " ORDER BY created_at DESC, order_id DESC LIMIT %s"
+    params.append(limit)
+
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM orders 
-            WHERE user_id = %s 
-            ORDER BY created_at DESC 
-            LIMIT %s
-        """, (user_id, limit))
+        cursor.execute(query, params)
         return [dict(row) for row in cursor.fetchall()]
 
 
+MY_ORDERS_PAGE_SIZE = 10
+
+
+def get_user_orders_page(user_id: int, before: tuple = None,
+                         page_size: int = MY_ORDERS_PAGE_SIZE) -> tuple[List[Dict[str, Any]], Optional[tuple]]:
+    """Страница «Мои заказы» (без PDF): (заказы, ключ следующей страницы или None)"""
+    orders = get_user_orders(
+        user_id,
+        limit=page_size + 1,
+        before=before,
+        columns="order_id, total, status, created_at"
+    )
+    if len(orders) > page_size:
+        orders = orders[:page_size]
+        last = orders[-1]
+        return orders, (last["created_at"], last["order_id"])
+    return orders, None
+
+
 def get_orders_by_base_id(base_order_id: str) -> List[Dict[str, Any]]:
     """Получение всех под-заказов по базовому ID"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM orders 
+        cursor.execute(f"""
+            SELECT {ORDER_HEADER_COLUMNS} FROM orders 
             WHERE base_order_id = %s OR order_id = %s
             ORDER BY order_id
         """, (base_order_id, base_order_id))
@@ -1057,13 +3056,11 @@ def save_client_notification(base_order_id: str, user_id: int, message_id: int):
     """Сохранение ID сообщения клиенту"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
+        cursor.execute(f"""
             INSERT INTO client_notifications 
             (base_order_id, user_id, message_id, created_at)
             VALUES (%s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE 
-                message_id = VALUES(message_id),
-                created_at = VALUES(created_at)
+            {db_storage.on_conflict(["base_order_id"], ["message_id", "created_at"])}
         """, (base_order_id, user_id, message_id, datetime.now()))
         conn.commit()
 
@@ -1101,15 +3098,8 @@ def build_grouped_status_message(base_order_id: str, lang: str = "ru") -> str:
         status = order.get("status", OrderStatus.PENDING)
         total_sum += order.get("total", 0)
 
-        # Получаем количество товаров из order_json
-        order_json_str = order.get("order_json", "{}")
-        try:
-            order_json = json.loads(order_json_str)
-            items = order_json.get("items", [])
-            item_count = len(items)
-            total_items += item_count
-        except:
-            item_count = 0
+        item_count = order.get("item_count") or 0
+        total_items += item_count
 
         if category:
             categories_info[category] = {
@@ -1159,13 +3149,13 @@ async def send_or_update_client_notification(base_order_id: str, user_id: int, l
     """Отправляет или обновляет сводное сообщение клиенту"""
 
     # Получаем текст сообщения
-    message_text = build_grouped_status_message(base_order_id, lang)
+    message_text = await orders_repo.build_grouped_status_message(base_order_id, lang)
 
     if not message_text:
         return
 
     # Проверяем, есть ли уже сообщение
-    notification = get_client_notification(base_order_id)
+    notification = await notifications_repo.get(base_order_id)
 
     try:
         if notification:
@@ -1183,7 +3173,7 @@ async def send_or_update_client_notification(base_order_id: str, user_id: int, l
                 text=message_text
             )
             # Сохраняем message_id
-            save_client_notification(base_order_id, user_id, sent_message.message_id)
+            await notifications_repo.save(base_order_id, user_id, sent_message.message_id)
             logger.info(f"Sent new client notification for order {base_order_id}")
 
     except Exception as e:
@@ -1193,21 +3183,15 @@ async def send_or_update_client_notification(base_order_id: str, user_id: int, l
 async def send_category_completion_notification(order_id: str, category: str, user_id: int, lang: str = "ru"):
     """Отправляет отдельное уведомление о готовности конкретной категории"""
 
-    order_data = get_order_raw(order_id)
+    order_data = await orders_repo.get_header(order_id)
     if not order_data:
         return
 
     emoji = get_category_emoji(category)
     cat_name = get_category_name(category)
 
-    # Получаем информацию о товарах
-    order_json_str = order_data.get("order_json", "{}")
-    try:
-        order_json = json.loads(order_json_str)
-        items = order_json.get("items", [])
-        item_count = len(items)
-    except:
-        item_count = 0
+    # Количество товаров (считается в запросе заголовка)
+    item_count = order_data.get("item_count") or 0
 
     if lang == "ru":
         text = (
@@ -1243,34 +3227,188 @@ async def send_category_completion_notification(order_id: str, category: str, us
 
 # ==================== ПОЛЬЗОВАТЕЛИ ====================
 
-def add_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
-    """Добавление/обновление пользователя в базе данных"""
-    try:
+class UserActivityBuffer:
+    """Write-behind буфер активности пользователей
+
+    /start только запоминает последнюю активность в памяти; в БД она уходит
+    пачкой (один executemany-upsert на окно ACTIVITY_FLUSH_INTERVAL).
+    Повторные /start одного пользователя в пределах окна схлопываются в одну запись.
+    Вместе с пачкой обновляется дневная сводка stats_daily_users (новые и активные).
+    Если пачка падает, она дописывается по одной строке; строка, упавшая сама по себе,
+    возвращается в буфер, но не больше ACTIVITY_FLUSH_MAX_ATTEMPTS раз — иначе она навсегда
+    блокирует сброс и буфер растёт без предела.
+    """
+
+    def __init__(self):
+        self._pending: Dict[int, tuple] = {}
+        # Сколько сбросов подряд не удалось для активности пользователя
+        self._attempts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        # Сбросы идут по одному, иначе два параллельных сброса посчитают одного пользователя дважды
+        self._flush_lock = threading.Lock()
+        self.recorded = 0
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    def record(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        with self._lock:
+            self._pending[user_id] = (username, first_name, last_name, datetime.now())
+            self.recorded += 1
+
+    def flush(self) -> int:
+        """Записывает накопленную активность в БД одной пачкой"""
+        with self._flush_lock:
+            return self._flush()
+
+    @staticmethod
+    def _rollup_deltas(cursor, batch: Dict[int, tuple]) -> Dict[Any, List[int]]:
+        """Считает по пачке, сколько пользователей новые и сколько впервые активны за день
+
+        Возвращает {день: [новых, активных]}; читает users одним запросом до upsert'а.
+        """
+        user_ids = list(batch)
+        placeholders = ", ".join(["%s"] * len(user_ids))
+        cursor.execute(
+            f"SELECT user_id, last_activity FROM users WHERE user_id IN ({placeholders})",
+            user_ids
+        )
+        last_seen = {row['user_id']: row['last_activity'] for row in cursor.fetchall()}
+
+        deltas: Dict[Any, List[int]] = defaultdict(lambda: [0, 0])
+        for user_id, (_, _, _, ts) in batch.items():
+            day = ts.date()
+            if user_id not in last_seen:
+                deltas[day][0] += 1
+                deltas[day][1] += 1
+            elif last_seen[user_id] is None or last_seen[user_id].date() < day:
+                deltas[day][1] += 1
+        return deltas
+
+    def _write(self, batch: Dict[int, tuple]):
+        """Один upsert пачки в users вместе со сдвигом stats_daily_users (одна транзакция)"""
+        rows = [
+            (user_id, username, first_name, last_name, ts, ts, 'ru')
+            for user_id, (username, first_name, last_name, ts) in batch.items()
+        ]
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            # Проверяем, существует ли пользователь
-            cursor.execute("SELECT user_id FROM users WHERE user_id = %s", (user_id,))
-            exists = cursor.fetchone()
-            
-            if exists:
-                # Обновляем last_activity
-                cursor.execute("""
-                    UPDATE users 
-                    SET last_activity = %s, username = %s, first_name = %s, last_name = %s
-                    WHERE user_id = %s
-                """, (datetime.now(), username, first_name, last_name, user_id))
-            else:
-                # Создаем нового пользователя
-                cursor.execute("""
-                    INSERT INTO users (user_id, username, first_name, last_name, created_at, last_activity, language)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, (user_id, username, first_name, last_name, datetime.now(), datetime.now(), 'ru'))
-            
+            deltas = self._rollup_deltas(cursor, batch)
+            cursor.executemany(f"""
+                INSERT INTO users (user_id, username, first_name, last_name, created_at, last_activity, language)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                {db_storage.on_conflict(["user_id"], ["username", "first_name", "last_name", "last_activity"])}
+            """, rows)
+            for day, (new_users, active_users) in deltas.items():
+                bump_users_rollup(cursor, day, new_users, active_users)
             conn.commit()
-            logger.info(f"User {user_id} added/updated in database")
-    except Exception as e:
-        logger.exception(f"Error adding user {user_id} to database")
+
+    def _flush(self) -> int:
+        with self._lock:
+            batch = self._pending
+            self._pending = {}
+        if not batch:
+            return 0
+
+        failed: Dict[int, tuple] = {}
+        error = None
+        try:
+            self._write(batch)
+        except Exception as e:
+            error = e
+            if len(batch) == 1 or isinstance(e, PoolExhaustedError):
+                failed = batch
+            else:
+                # Пачка упала целиком: пишем по одной строке, чтобы «плохая» строка не тянула за собой остальные
+                logger.warning(f"Activity batch of {len(batch)} users failed, retrying row by row: {e}")
+                for user_id, values in batch.items():
+                    if isinstance(error, PoolExhaustedError):
+                        failed[user_id] = values  # БД недоступна — дальше по строкам не пробуем
+                        continue
+                    try:
+                        self._write({user_id: values})
+                    except Exception as row_error:
+                        failed[user_id] = values
+                        error = row_error
+
+        written = len(batch) - len(failed)
+        dropped = []
+        with self._lock:
+            for user_id in batch:
+                if user_id not in failed:
+                    self._attempts.pop(user_id, None)
+            # Возвращаем в буфер только строки, упавшие сами по себе, не затирая более свежую активность
+            for user_id, values in failed.items():
+                attempts = self._attempts.get(user_id, 0) + 1
+                if attempts >= ACTIVITY_FLUSH_MAX_ATTEMPTS:
+                    self._attempts.pop(user_id, None)
+                    dropped.append(user_id)
+                    continue
+                self._attempts[user_id] = attempts
+                self._pending.setdefault(user_id, values)
+            self.dropped += len(dropped)
+            self.written += written
+            if written:
+                self.flushes += 1
+        if dropped:
+            logger.error(
+                f"Dropped activity of {len(dropped)} users after "
+                f"{ACTIVITY_FLUSH_MAX_ATTEMPTS} failed flushes: {dropped[:20]}"
+            )
+        if failed:
+            raise error
+
+        logger.debug(f"Flushed activity of {written} users")
+        return written
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "recorded": self.recorded,
+                "written": self.written,
+                "flushes": self.flushes,
+                "dropped": self.dropped,
+            }
+
+
+activity_buffer = UserActivityBuffer()
+
+
+def insert_user_if_missing(cursor, user_id: int, values: Dict[str, Any]) -> bool:
+    """Вставляет пользователя, если его ещё нет в users (новый может ещё лежать в activity_buffer)
+
+    Вставка сразу учитывает пользователя в stats_daily_users как нового и активного;
+    последующий сброс буфера увидит его в users и не посчитает второй раз.
+    Возвращает False, если пользователь уже был — тогда вызывающий делает UPDATE.
+    """
+    now = datetime.now()
+    row = {"created_at": now, "last_activity": now, "language": "ru", **values}
+    columns = ", ".join(row)
+    placeholders = ", ".join(["%s"] * (len(row) + 1))
+    cursor.execute(
+        f"{db_storage.insert_ignore} INTO users (user_id, {columns}) VALUES ({placeholders})",
+        (user_id, *row.values())
+    )
+    if cursor.rowcount != 1:
+        return False
+    bump_users_rollup(cursor, now.date(), 1, 1)
+    return True
+
+
+def add_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+    """Добавление/обновление пользователя (запись в БД откладывается в activity_buffer)"""
+    activity_buffer.record(user_id, username, first_name, last_name)
+
+
+async def activity_flush_loop():
+    """Фоновый сброс буфера активности в БД"""
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            await run_db(activity_buffer.flush)
+        except Exception as e:
+            logger.warning(f"Activity flush failed, will retry: {e}")
 
 
 def get_all_user_ids() -> List[int]:
@@ -1287,16 +3425,114 @@ def get_all_user_ids() -> List[int]:
 
 # ==================== ЯЗЫК ====================
 
+class UserContextCache:
+    """Потокобезопасный LRU-кеш языка и профиля пользователей с TTL
+
+    Записи с истёкшим TTL перечитываются из БД; при переполнении вытесняются
+    давно не использованные. set_user_lang / set_user_profile инвалидируют запись.
+    """
+
+    def __init__(self, ttl: int = 300, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[int, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Растёт при каждой инвалидации: загрузка, начатая до неё, не попадёт в кеш
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return item[1]
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def put(self, user_id: int, entry: Dict[str, Any], generation: int):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._data[user_id] = (time.monotonic() + self.ttl, entry)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+
+user_context_cache = UserContextCache(ttl=USER_CACHE_TTL, max_size=USER_CACHE_MAX_SIZE)
+
+
+def load_user_context(user_id: int) -> Dict[str, Any]:
+    """Язык и профиль пользователя одним запросом (через кеш)
+
+    Возвращает {"lang": str, "profile": dict}. Запись из кеша нельзя изменять.
+    """
+    entry = user_context_cache.get(user_id)
+    if entry is not None:
+        return entry
+
+    generation = user_context_cache.generation()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT language, phone, city, full_name, latitude, longitude 
+            FROM users 
+            WHERE user_id = %s
+        """, (user_id,))
+        row = cursor.fetchone()
+
+    profile = {}
+    lang = 'ru'
+    if row:
+        lang = row['language'] or 'ru'
+        if row['phone']:
+            profile['phone'] = row['phone']
+        if row['city']:
+            profile['city'] = row['city']
+        if row['full_name']:
+            profile['full_name'] = row['full_name']
+        if row['latitude']:
+            profile['latitude'] = float(row['latitude'])
+        if row['longitude']:
+            profile['longitude'] = float(row['longitude'])
+
+    entry = {"lang": lang, "profile": profile}
+    user_context_cache.put(user_id, entry, generation)
+    return entry
+
+
 def get_user_lang(user_id: int) -> str:
-    """Получение языка пользователя из базы данных"""
+    """Получение языка пользователя (кеш, затем база данных)"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT language FROM users WHERE user_id = %s", (user_id,))
-            row = cursor.fetchone()
-            if row:
-                return row['language'] or 'ru'
-            return 'ru'
+        return load_user_context(user_id)["lang"]
     except Exception as e:
         logger.exception(f"Error getting language for user {user_id}")
         return 'ru'
@@ -1307,13 +3543,11 @@ def set_user_lang(user_id: int, lang: str):
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                UPDATE users 
-                SET language = %s 
-                WHERE user_id = %s
-            """, (lang, user_id))
+            if not insert_user_if_missing(cursor, user_id, {"language": lang}):
+                cursor.execute("UPDATE users SET language = %s WHERE user_id = %s", (lang, user_id))
             conn.commit()
-            logger.info(f"Language for user {user_id} set to {lang}")
+        user_context_cache.invalidate(user_id)
+        logger.info(f"Language for user {user_id} set to {lang}")
     except Exception as e:
         logger.exception(f"Error saving language for user {user_id}")
 
@@ -1332,8 +3566,9 @@ async def check_dealer_status(user_id: int, phone: str, force_check: bool = Fals
     url = f"{GOOGLE_SCRIPT_URL}?telegram_id={user_id}&phone={clean_phone}"
 
     try:
-        response = await asyncio.to_thread(urlopen, url, timeout=10)
-        result = json.loads(response.read().decode())
+        response = await http_client.get(url, timeout=10)
+        response.raise_for_status()
+        result = response.json()
 
         info = {
             "is_dealer": result.get("found", False),
@@ -1401,31 +3636,9 @@ def get_main_menu_keyboard(user_id: int, lang: str):
 
 
 def get_user_profile(user_id: int) -> Dict[str, str]:
-    """Получение профиля пользователя из базы данных"""
+    """Получение профиля пользователя (кеш, затем база данных)"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT phone, city, full_name, latitude, longitude 
-                FROM users 
-                WHERE user_id = %s
-            """, (user_id,))
-            row = cursor.fetchone()
-            
-            if row:
-                profile = {}
-                if row['phone']:
-                    profile['phone'] = row['phone']
-                if row['city']:
-                    profile['city'] = row['city']
-                if row['full_name']:
-                    profile['full_name'] = row['full_name']
-                if row['latitude']:
-                    profile['latitude'] = float(row['latitude'])
-                if row['longitude']:
-                    profile['longitude'] = float(row['longitude'])
-                return profile
-            return {}
+        return dict(load_user_context(user_id)["profile"])
     except Exception as e:
         logger.exception(f"Error getting profile for user {user_id}")
         return {}
@@ -1444,15 +3657,18 @@ def set_user_profile(user_id: int, profile: Dict[str, str]):
             latitude = profile.get('latitude')
             longitude = profile.get('longitude')
             
-            # Обновляем профиль пользователя
-            cursor.execute("""
-                UPDATE users 
-                SET phone = %s, city = %s, full_name = %s, latitude = %s, longitude = %s
-                WHERE user_id = %s
-            """, (phone, city, full_name, latitude, longitude, user_id))
+            # Обновляем профиль пользователя (или вставляем, если он ещё лежит в activity_buffer)
+            values = dict(zip(USER_PROFILE_COLUMNS, (phone, city, full_name, latitude, longitude)))
+            if not insert_user_if_missing(cursor, user_id, values):
+                cursor.execute(f"""
+                    UPDATE users
+                    SET {", ".join(f"{column} = %s" for column in USER_PROFILE_COLUMNS)}
+                    WHERE user_id = %s
+                """, (*values.values(), user_id))
             
             conn.commit()
-            logger.info(f"Profile for user {user_id} updated in database")
+        user_context_cache.invalidate(user_id)
+        logger.info(f"Profile for user {user_id} updated in database")
     except Exception as e:
         logger.exception(f"Error saving profile for user {user_id}")
 
@@ -1484,42 +3700,357 @@ def get_user_info(user_id: int) -> Optional[Dict[str, Any]]:
         return None
 
 
+# ==================== СВОДНАЯ СТАТИСТИКА ====================
+
+# Дневные сводки stats_daily_users / stats_daily_orders обновляются в тех же транзакциях,
+# что и сами данные, поэтому отчёты читают O(дней) строк, а не сканируют users и orders.
+
+def bump_users_rollup(cursor, day, new_users: int, active_users: int):
+    """Прибавляет новых и активных пользователей к сводке за день"""
+    upsert = db_storage.on_conflict(["day"], {
+        "new_users": f"new_users + {db_storage.excluded('new_users')}",
+        "active_users": f"active_users + {db_storage.excluded('active_users')}",
+    })
+    cursor.execute(f"""
+        INSERT INTO stats_daily_users (day, new_users, active_users)
+        VALUES (%s, %s, %s)
+        {upsert}
+    """, (day, new_users, active_users))
+
+
+def bump_order_rollup(cursor, order_id: str, status: str, sign: int):
+    """Добавляет (sign=1) или убирает (sign=-1) заказ из сводки за день его создания"""
+    upsert = db_storage.on_conflict(["day", "category", "status"], {
+        "order_count": f"order_count + {db_storage.excluded('order_count')}",
+        "revenue": f"revenue + {db_storage.excluded('revenue')}",
+    })
+    cursor.execute(f"""
+        INSERT INTO stats_daily_orders (day, category, status, order_count, revenue)
+        SELECT DATE(created_at), COALESCE(category, ''), %s, %s, %s * total
+        FROM orders
+        WHERE order_id = %s
+        {upsert}
+    """, (status, sign, sign, order_id))
+
+
+def rebuild_stats_rollups():
+    """Разовое заполнение сводок по уже накопленным данным
+
+    Дальше сводки поддерживаются инкрементально. Историю активности восстановить
+    нельзя (в users хранится только last_activity), поэтому для прошлых дней
+    активные считаются по дате последней активности.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if is_migration_done(cursor, "stats_rollups"):
+            return
+
+        cursor.execute("DELETE FROM stats_daily_orders")
+        cursor.execute("""
+            INSERT INTO stats_daily_orders (day, category, status, order_count, revenue)
+            SELECT DATE(created_at), COALESCE(category, ''), COALESCE(status, %s), COUNT(*), SUM(total)
+            FROM orders
+            GROUP BY DATE(created_at), COALESCE(category, ''), COALESCE(status, %s)
+        """, (OrderStatus.PENDING, OrderStatus.PENDING))
+
+        cursor.execute("DELETE FROM stats_daily_users")
+        cursor.execute("""
+            INSERT INTO stats_daily_users (day, new_users, active_users)
+            SELECT DATE(created_at), COUNT(*), 0
+            FROM users
+            GROUP BY DATE(created_at)
+        """)
+        cursor.execute(f"""
+            INSERT INTO stats_daily_users (day, new_users, active_users)
+            SELECT DATE(last_activity), 0, COUNT(*)
+            FROM users
+            WHERE last_activity IS NOT NULL
+            GROUP BY DATE(last_activity)
+            {db_storage.on_conflict(["day"], ["active_users"])}
+        """)
+
+        mark_migration_done(cursor, "stats_rollups")
+        conn.commit()
+    logger.info("✅ Statistics rollups rebuilt")
+
+
 def get_users_stats() -> Dict[str, Any]:
-    """Получение статистики пользователей"""
+    """Получение статистики пользователей
+
+    Всего и новые — из сводки stats_daily_users; активные за 30 дней — один
+    диапазонный подсчёт по индексу idx_last_activity (уникальных пользователей
+    за период из дневных сводок не сложить).
+    """
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            # Общее количество пользователей
-            cursor.execute("SELECT COUNT(*) as total FROM users")
-            total = cursor.fetchone()['total']
-            
-            # Активные пользователи (за последние 30 дней)
+
+            now = datetime.now()
+            cursor.execute("""
+                SELECT COALESCE(SUM(new_users), 0) AS total,
+                       COALESCE(SUM(CASE WHEN day >= %s THEN new_users END), 0) AS new_7d
+                FROM stats_daily_users
+            """, ((now - timedelta(days=6)).date(),))
+            row = cursor.fetchone()
+
             cursor.execute("""
                 SELECT COUNT(*) as active 
                 FROM users 
-                WHERE last_activity >= DATE_SUB(NOW(), INTERVAL 30 DAY)
-            """)
+                WHERE last_activity >= %s
+            """, (now - timedelta(days=30),))
             active = cursor.fetchone()['active']
-            
-            # Новые пользователи (за последние 7 дней)
-            cursor.execute("""
-                SELECT COUNT(*) as new_users 
-                FROM users 
-                WHERE created_at >= DATE_SUB(NOW(), INTERVAL 7 DAY)
-            """)
-            new_users = cursor.fetchone()['new_users']
-            
+
             return {
-                'total': total,
+                'total': int(row['total']),
                 'active_30d': active,
-                'new_7d': new_users
+                'new_7d': int(row['new_7d'])
             }
     except Exception as e:
         logger.exception("Error getting users stats")
         return {'total': 0, 'active_30d': 0, 'new_7d': 0}
 
 
+def get_orders_stats(days: int = 30) -> Dict[str, Any]:
+    """Статистика заказов и пользователей за последние days дней (только из сводок)
+
+    Выручка считается без отклонённых заказов.
+    """
+    since = (datetime.now() - timedelta(days=days - 1)).date()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT status, SUM(order_count) AS orders, SUM(revenue) AS revenue
+            FROM stats_daily_orders
+            WHERE day >= %s
+            GROUP BY status
+            HAVING SUM(order_count) > 0
+        """, (since,))
+        by_status = cursor.fetchall()
+
+        cursor.execute("""
+            SELECT category, SUM(order_count) AS orders, SUM(revenue) AS revenue
+            FROM stats_daily_orders
+            WHERE day >= %s AND status <> %s
+            GROUP BY category
+            HAVING SUM(order_count) > 0
+            ORDER BY revenue DESC
+        """, (since, OrderStatus.REJECTED))
+        by_category = cursor.fetchall()
+
+        cursor.execute("""
+            SELECT day,
+                   SUM(CASE WHEN status <> %s THEN order_count ELSE 0 END) AS orders,
+                   SUM(CASE WHEN status <> %s THEN revenue ELSE 0 END) AS revenue
+            FROM stats_daily_orders
+            WHERE day >= %s
+            GROUP BY day
+        """, (OrderStatus.REJECTED, OrderStatus.REJECTED, since))
+        orders_by_day = {row['day']: row for row in cursor.fetchall()}
+
+        cursor.execute("""
+            SELECT day, new_users, active_users
+            FROM stats_daily_users
+            WHERE day >= %s
+        """, (since,))
+        users_by_day = {row['day']: row for row in cursor.fetchall()}
+
+    by_day = []
+    for day in sorted(set(orders_by_day) | set(users_by_day), reverse=True):
+        orders_row = orders_by_day.get(day) or {}
+        users_row = users_by_day.get(day) or {}
+        by_day.append({
+            'day': day,
+            'orders': int(orders_row.get('orders') or 0),
+            'revenue': orders_row.get('revenue') or 0,
+            'new_users': users_row.get('new_users', 0),
+            'active_users': users_row.get('active_users', 0),
+        })
+
+    return {
+        'days': days,
+        'by_status': by_status,
+        'by_category': by_category,
+        'by_day': by_day,
+    }
+
+
+def get_product_sales(days: int = 30, limit: int = 20) -> List[Dict[str, Any]]:
+    """Продажи по товарам за последние days дней (без отклонённых заказов)"""
+    since = (datetime.now() - timedelta(days=days - 1)).date()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT oi.product_id,
+                   SUM(oi.qty) AS qty,
+                   SUM(oi.qty * oi.price) AS revenue,
+                   SUM(oi.qty * oi.weight) AS weight,
+                   COUNT(DISTINCT oi.order_id) AS orders
+            FROM orders o
+            JOIN order_items oi ON oi.order_id = o.order_id
+            WHERE o.created_at >= %s AND o.status <> %s
+            GROUP BY oi.product_id
+            ORDER BY revenue DESC
+            LIMIT %s
+        """, (since, OrderStatus.REJECTED, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_order_weight_totals(order_id: str) -> Dict[str, Any]:
+    """Количество позиций, штук, общий вес и объём заказа"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COUNT(*) AS item_count,
+                   COALESCE(SUM(qty), 0) AS qty,
+                   COALESCE(SUM(qty * weight), 0) AS weight,
+                   COALESCE(SUM(qty * cube), 0) AS cube
+            FROM order_items
+            WHERE order_id = %s
+        """, (order_id,))
+        return dict(cursor.fetchone())
+
+
+# ==================== АСИНХРОННЫЙ ДОСТУП К БД ====================
+
+# Отдельный ограниченный пул потоков для запросов к БД: хендлеры ждут результат через await,
+# а event loop в это время обслуживает другие апдейты. Потоков не больше, чем соединений в пуле,
+# поэтому поток никогда не простаивает в ожидании свободного соединения.
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix="db")
+
+
+async def run_db(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Выполняет синхронную функцию работы с БД в db_executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+
+class UsersRepository:
+    """Асинхронный доступ к пользователям (таблица users)"""
+
+    async def add(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        # Только запись в буфер — без похода в БД
+        add_user(user_id, username, first_name, last_name)
+
+    async def get_all_ids(self) -> List[int]:
+        return await run_db(get_all_user_ids)
+
+    async def get_lang(self, user_id: int) -> str:
+        entry = user_context_cache.get(user_id)
+        if entry is not None:
+            return entry["lang"]
+        return await run_db(get_user_lang, user_id)
+
+    async def set_lang(self, user_id: int, lang: str):
+        return await run_db(set_user_lang, user_id, lang)
+
+    async def get_profile(self, user_id: int) -> Dict[str, str]:
+        entry = user_context_cache.get(user_id)
+        if entry is not None:
+            return dict(entry["profile"])
+        return await run_db(get_user_profile, user_id)
+
+    async def set_profile(self, user_id: int, profile: Dict[str, str]):
+        return await run_db(set_user_profile, user_id, profile)
+
+    async def get_full_name(self, user_id: int) -> Optional[str]:
+        return (await self.get_profile(user_id)).get("full_name")
+
+    async def get_context(self, user_id: int) -> "UserContext":
+        """Контекст пользователя для одного апдейта (из кеша без похода в пул потоков)"""
+        entry = user_context_cache.get(user_id)
+        if entry is None:
+            try:
+                entry = await run_db(load_user_context, user_id)
+            except Exception:
+                logger.exception(f"Error loading context for user {user_id}")
+                entry = {"lang": "ru", "profile": {}}
+        return UserContext(user_id, entry["lang"], dict(entry["profile"]))
+
+    async def get_info(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return await run_db(get_user_info, user_id)
+
+    async def get_stats(self) -> Dict[str, Any]:
+        return await run_db(get_users_stats)
+
+
+class OrdersRepository:
+    """Асинхронный доступ к заказам (таблица orders)"""
+
+    async def save(self, order_id: str, client_name: str, user_id: int, total: float,
+                   pdf_draft: bytes, order_json: dict, category: str = None, base_order_id: str = None):
+        return await run_db(
+            save_order, order_id, client_name, user_id, total, pdf_draft, order_json,
+            category=category, base_order_id=base_order_id
+        )
+
+    async def save_base(self, base_order_id: str, client_name: str, user_id: int,
+                        sub_orders: List[Dict[str, Any]]):
+        return await run_db(save_base_order, base_order_id, client_name, user_id, sub_orders)
+
+    async def update_status(self, order_id: str, new_status: str, pdf_final: bytes = None, updated_by: int = None):
+        return await run_db(update_order_status, order_id, new_status, pdf_final=pdf_final, updated_by=updated_by)
+
+    async def transition(self, order_id: str, new_status: str, updated_by: int = None,
+                         expected_status: Optional[str] = None) -> bool:
+        return await run_db(transition_order_status, order_id, new_status, updated_by, expected_status)
+
+    async def attach_final_pdf(self, order_id: str, pdf_final: bytes):
+        return await run_db(attach_order_final_pdf, order_id, pdf_final)
+
+    async def get_raw(self, order_id: str) -> Optional[Dict[str, Any]]:
+        return await run_db(get_order_raw, order_id)
+
+    async def get_header(self, order_id: str) -> Optional[Dict[str, Any]]:
+        return await run_db(get_order_header, order_id)
+
+    async def get_pdf(self, order_id: str) -> Optional[bytes]:
+        return await run_db(get_order_pdf, order_id)
+
+    async def get_for_user(self, order_id: str, user_id: int) -> Optional[Dict[str, Any]]:
+        return await run_db(get_order_for_user, order_id, user_id)
+
+    async def get_all(self, limit: int = 100) -> List[Dict[str, Any]]:
+        return await run_db(get_all_orders, limit)
+
+    async def get_by_user(self, user_id: int, limit: int = 50, before: tuple = None) -> List[Dict[str, Any]]:
+        return await run_db(get_user_orders, user_id, limit, before)
+
+    async def get_page_by_user(self, user_id: int, before: tuple = None):
+        return await run_db(get_user_orders_page, user_id, before)
+
+    async def get_by_base_id(self, base_order_id: str) -> List[Dict[str, Any]]:
+        return await run_db(get_orders_by_base_id, base_order_id)
+
+    async def build_grouped_status_message(self, base_order_id: str, lang: str = "ru") -> str:
+        return await run_db(build_grouped_status_message, base_order_id, lang)
+
+    async def get_stats(self, days: int = 30) -> Dict[str, Any]:
+        return await run_db(get_orders_stats, days)
+
+    async def get_product_sales(self, days: int = 30, limit: int = 20) -> List[Dict[str, Any]]:
+        return await run_db(get_product_sales, days, limit)
+
+    async def get_weight_totals(self, order_id: str) -> Dict[str, Any]:
+        return await run_db(get_order_weight_totals, order_id)
+
+
+class ClientNotificationsRepository:
+    """Асинхронный доступ к уведомлениям клиентов (таблица client_notifications)"""
+
+    async def save(self, base_order_id: str, user_id: int, message_id: int):
+        return await run_db(save_client_notification, base_order_id, user_id, message_id)
+
+    async def get(self, base_order_id: str) -> Optional[Dict[str, Any]]:
+        return await run_db(get_client_notification, base_order_id)
+
+
+users_repo = UsersRepository()
+orders_repo = OrdersRepository()
+notifications_repo = ClientNotificationsRepository()
+
+
+
 # ==================== FTP ====================
 
 try:
@@ -1591,6 +4122,325 @@ def _upload_pdf_sync(order_id: str, pdf_bytes: bytes) -> tuple[bool, str]:
         return False, ""
 
 
+# ==================== КЕШ ИЗОБРАЖЕНИЙ ====================
+
+def image_nbytes(image: Image.Image) -> int:
+    """Объём декодированного изображения в памяти: ширина × высота × каналы"""
+    width, height = image.size
+    return width * height * len(image.getbands())
+
+
+class MemoryLRUCache:
+    """LRU-кеш в памяти с лимитом по суммарному объёму и сроком жизни записей
+
+    Объём записи считает sizeof(value). При переполнении вытесняются давно не
+    использованные записи; запись старше ttl считается промахом и удаляется при чтении
+    (ttl=None — записи не устаревают). Записи крупнее всего лимита не кешируются.
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float], sizeof: Callable[[Any], int] = len):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, size, stored_at)
+        self._lock = threading.Lock()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, stored_at = entry
+            if self._expired(stored_at):
+                self._remove(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                self.rejected += 1
+                return
+            self._entries[key] = (value, size, time.monotonic())
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def discard(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.monotonic() - stored_at >= self.ttl
+
+    def __contains__(self, key: str) -> bool:
+        """Есть ли неустаревшая запись (без учёта в попаданиях и без сдвига в LRU)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._expired(entry[2])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+            }
+
+
+class DiskImageStore:
+    """Исходные изображения товаров на диске: <root>/<ab>/<sha256(url)> и рядом .json с метаданными
+
+    В метаданных — URL, ETag, Last-Modified и время последней проверки на сервере.
+    Файл старше ttl перепроверяется условным запросом; 304 продлевает его без загрузки.
+    Общий объём ограничен max_bytes: вытесняются давно не читанные файлы
+    (порядок использования хранится в mtime файла, поэтому переживает перезапуск).
+    """
+
+    def __init__(self, root: str, max_bytes: int, ttl: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()  # key -> метаданные, от старых к новым
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.bytes = 0
+
+        self.hits = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.stale_served = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _write_meta(self, key: str, meta: Dict):
+        self._write(self._path(key) + ".json", json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+    def load(self):
+        """Читает индекс файлов с диска (один раз, при старте или первом обращении)"""
+        with self._lock:
+            if self._loaded:
+                return
+            found = []
+            if os.path.isdir(self.root):
+                for directory in os.scandir(self.root):
+                    if not directory.is_dir():
+                        continue
+                    for entry in os.scandir(directory.path):
+                        if not entry.name.endswith(".json"):
+                            continue
+                        key = entry.name[:-len(".json")]
+                        try:
+                            with open(entry.path, "rb") as f:
+                                meta = json.loads(f.read())
+                            stat = os.stat(self._path(key))
+                        except (OSError, ValueError):
+                            continue
+                        meta["size"] = stat.st_size
+                        found.append((stat.st_mtime, key, meta))
+
+            for _, key, meta in sorted(found, key=lambda item: item[0]):
+                self._entries[key] = meta
+                self.bytes += meta["size"]
+            self._loaded = True
+            self._enforce_budget()
+        logger.info(f"✅ Image store: {len(found)} images, {self.bytes / 1024 / 1024:.1f} MB in {self.root}")
+
+    def lookup(self, url: str) -> Optional[Dict]:
+        """Метаданные изображения (копия) или None"""
+        self.load()
+        with self._lock:
+            meta = self._entries.get(self.make_key(url))
+            return dict(meta) if meta is not None else None
+
+    def is_fresh(self, meta: Dict) -> bool:
+        return time.time() - meta.get("checked_at", 0) < self.ttl
+
+    def read(self, url: str, validated: bool = False) -> Optional[bytes]:
+        """Содержимое файла; validated=True — сервер подтвердил его актуальность (304)"""
+        key = self.make_key(url)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.discard(url)
+            return None
+
+        with self._lock:
+            meta = self._entries.get(key)
+            if meta is None:
+                return data
+            self._entries.move_to_end(key)
+            if validated:
+                meta["checked_at"] = time.time()
+                meta = dict(meta)
+                self.revalidated += 1
+            else:
+                self.hits += 1
+        if validated:
+            self._write_meta(key, meta)
+        return data
+
+    def store(self, url: str, data: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        key = self.make_key(url)
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "checked_at": time.time(),
+            "size": len(data),
+        }
+        self.load()
+        self._write(self._path(key), data)
+        self._write_meta(key, meta)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old["size"]
+            self._entries[key] = meta
+            self.bytes += len(data)
+            self.stored += 1
+            self._enforce_budget()
+
+    def discard(self, url: str) -> bool:
+        key = self.make_key(url)
+        with self._lock:
+            meta = self._entries.pop(key, None)
+            if meta is not None:
+                self.bytes -= meta["size"]
+        self._delete_files(key)
+        return meta is not None
+
+    def _delete_files(self, key: str):
+        for path in (self._path(key), self._path(key) + ".json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _enforce_budget(self):
+        """Вытесняет самые старые файлы, пока объём больше лимита (под self._lock)"""
+        while self.bytes > self.max_bytes and self._entries:
+            key, meta = self._entries.popitem(last=False)
+            self.bytes -= meta["size"]
+            self.evictions += 1
+            self._delete_files(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "stored": self.stored,
+                "stale_served": self.stale_served,
+                "evictions": self.evictions,
+            }
+
+
+image_cache = MemoryLRUCache(IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_LIFETIME, sizeof=image_nbytes)
+# Миниатюры не устаревают по времени: актуальность исходника проверяет ImagePrewarmer
+# после каждого обновления каталога, а размер ограничен лимитом LRU
+thumbnail_cache = MemoryLRUCache(THUMBNAIL_CACHE_MAX_BYTES, None)  # {url: JPEG bytes}
+disk_image_store = DiskImageStore(IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES, IMAGE_CACHE_LIFETIME)
+
+
+def is_image_data(data: bytes) -> bool:
+    """Открывается ли содержимое как изображение (проверка заголовка и структуры, без декодирования)"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+        return True
+    except Exception:
+        return False
+
+
+def decode_image(data: bytes) -> Image.Image:
+    """Декодирует изображение сразу (а не лениво при первом рисовании), чтобы знать его объём"""
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def make_pdf_thumbnail(image: Image.Image, size_mm: float = PDF_IMAGE_SIZE_MM, dpi: int = PDF_IMAGE_DPI) -> bytes:
+    """JPEG-миниатюра для ячейки PDF: не больше size_mm при dpi, в RGB
+
+    reportlab встраивает JPEG в PDF как есть, без перекодирования.
+    """
+    pixels = max(1, round(size_mm / 25.4 * dpi))
+    thumb = image.convert("RGB")
+    thumb.thumbnail((pixels, pixels), Image.LANCZOS)
+    buffer = io.BytesIO()
+    thumb.save(buffer, format="JPEG", quality=PDF_IMAGE_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
 # ==================== PDF ГЕНЕРАЦИЯ ====================
 
 def format_currency(value: int) -> str:
@@ -1618,34 +4468,153 @@ def wrap_text(text: str, max_chars: int):
     return wrapper.wrap(text)
 
 
+class ImageFetcher:
+    """Загрузка изображений товаров через общий HTTP-клиент
+
+    Одновременные запросы одного URL (из разных заказов) сливаются в одну загрузку.
+    На каждый хост — не больше per_host запросов сразу, чтобы большой заказ или
+    медленный хост не занимали весь пул соединений. Тело читается потоком с лимитом
+    размера; сетевые ошибки и 5xx повторяются с паузой и джиттером (HttpClient).
+    Под загрузкой — DiskImageStore: свежий файл отдаётся с диска, устаревший
+    перепроверяется условным запросом.
+    """
+
+    def __init__(self, client: HttpClient, store: DiskImageStore, per_host: int = IMAGE_FETCH_PER_HOST,
+                 max_bytes: int = IMAGE_MAX_DOWNLOAD_BYTES, retries: int = IMAGE_FETCH_RETRIES):
+        self.client = client
+        self.store = store
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        self.fetches = 0
+        self.deduplicated = 0
+        self.too_large = 0
+        self.failures = 0
+        self.waiter_timeouts = 0
+
+    async def fetch(self, url: str, timeout: int = 10) -> bytes:
+        """Байты изображения; при одновременных вызовах с одним URL загрузка одна"""
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(url, timeout))
+            self._inflight[url] = task
+            task.add_done_callback(functools.partial(self._forget, url))
+        else:
+            self.deduplicated += 1
+        # Загрузку мог начать вызов с другим timeout (например, прогрев с бо́льшим): каждый
+        # ожидающий ждёт не дольше своего бюджета — timeout на попытку с учётом повторов.
+        # shield: таймаут или отмена одного ожидающего не отменяет общую загрузку
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout * (self.retries + 1))
+        except asyncio.TimeoutError:
+            self.waiter_timeouts += 1
+            raise
+
+    def _forget(self, url: str, task: asyncio.Future):
+        if self._inflight.get(url) is task:
+            del self._inflight[url]
+
+    async def _get(self, url: str, headers: Optional[Dict[str, str]], timeout: int) -> HttpResponse:
+        host = url_host(url)
+        slots = self._host_slots.get(host)
+        if slots is None:
+            slots = self._host_slots[host] = asyncio.Semaphore(self.per_host)
+        async with slots:
+            self.fetches += 1
+            return await self.client.get(
+                url, headers=headers, timeout=timeout, retries=self.retries, max_bytes=self.max_bytes
+            )
+
+    async def _fetch(self, url: str, timeout: int) -> bytes:
+        meta = await asyncio.to_thread(self.store.lookup, url)
+        if meta is not None and self.store.is_fresh(meta):
+            data = await asyncio.to_thread(self.store.read, url)
+            if data is not None:
+                return data
+            meta = None
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            response = await self._get(url, headers or None, timeout)
+            if response.status == 304 and meta is not None:
+                data = await asyncio.to_thread(self.store.read, url, True)
+                if data is not None:
+                    return data
+                response = await self._get(url, None, timeout)
+            response.raise_for_status()
+            # HTML-страница ошибки с кодом 200 не должна попасть на диск как "изображение"
+            if not await asyncio.to_thread(is_image_data, response.body):
+                raise ValueError("response is not an image")
+        except HttpResponseTooLarge:
+            self.too_large += 1
+            raise
+        except Exception as e:
+            self.failures += 1
+            # Сервер недоступен — устаревший файл с диска лучше, чем заказ без фото
+            if meta is not None:
+                data = await asyncio.to_thread(self.store.read, url)
+                if data is not None:
+                    self.store.stale_served += 1
+                    logger.warning(f"Serving stale image from disk for {url}: {e}")
+                    return data
+            raise
+
+        await asyncio.to_thread(
+            self.store.store, url, response.body,
+            response.headers.get("ETag"), response.headers.get("Last-Modified")
+        )
+        return response.body
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "fetches": self.fetches,
+            "deduplicated": self.deduplicated,
+            "too_large": self.too_large,
+            "failures": self.failures,
+            "waiter_timeouts": self.waiter_timeouts,
+            "in_flight": len(self._inflight),
+            "per_host": self.per_host,
+            "max_bytes": self.max_bytes,
+        }
+
+
+image_fetcher = ImageFetcher(http_client, disk_image_store)
+
+
 async def download_image_async(url: str, timeout: int = 10) -> Optional[Image.Image]:
     """Асинхронная загрузка изображения с кешированием"""
-    global image_cache, image_cache_timestamp
-    
     # Проверяем кеш
-    if url in image_cache:
-        cache_age = (datetime.now() - image_cache_timestamp.get(url, datetime.now())).total_seconds()
-        if cache_age < IMAGE_CACHE_LIFETIME:
-            logger.debug(f"Image cache HIT: {url}")
-            return image_cache[url]
-    
+    image = image_cache.get(url)
+    if image is not None:
+        logger.debug(f"Image cache HIT: {url}")
+        return image
+
     try:
-        loop = asyncio.get_event_loop()
-        
-        def _download():
-            try:
-                response = urlopen(url, timeout=timeout)
-                image_data = response.read()
-                return Image.open(io.BytesIO(image_data))
-            except Exception as e:
-                logger.warning(f"Failed to download image from {url}: {e}")
-                return None
-        
-        image = await loop.run_in_executor(image_download_executor, _download)
-        
+        try:
+            data = await image_fetcher.fetch(url, timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Failed to download image from {url}: {e}")
+            return None
+
+        try:
+            image = await asyncio.to_thread(decode_image, data)
+        except Exception as e:
+            # Файл на диске битый — убираем, следующий запрос загрузит заново
+            logger.warning(f"Failed to decode image from {url}: {e}")
+            await asyncio.to_thread(disk_image_store.discard, url)
+            image = None
+
         if image:
-            image_cache[url] = image
-            image_cache_timestamp[url] = datetime.now()
+            image_cache.put(url, image)
             logger.debug(f"Image downloaded and cached: {url}")
         
         return image
@@ -1654,21 +4623,38 @@ async def download_image_async(url: str, timeout: int = 10) -> Optional[Image.Im
         return None
 
 
-# Оставляем старую функцию для совместимости
-def download_image(url: str, timeout: int = 10) -> Optional[Image.Image]:
-    """Синхронная версия (deprecated)"""
+async def get_pdf_thumbnail(url: str, timeout: int = 10) -> Optional[bytes]:
+    """JPEG-миниатюра товара для PDF (из кеша миниатюр или из загруженного изображения)"""
+    thumb = thumbnail_cache.get(url)
+    if thumb is not None:
+        return thumb
+
+    image = await download_image_async(url, timeout=timeout)
+    if image is None:
+        return None
+
+    try:
+        thumb = await asyncio.to_thread(make_pdf_thumbnail, image)
+    except Exception as e:
+        logger.warning(f"Failed to make thumbnail for {url}: {e}")
+        return None
+
+    thumbnail_cache.put(url, thumb)
+    return thumb
+
+
+def download_pdf_thumbnail(url: str, timeout: int = 10) -> Optional[bytes]:
+    """Синхронная версия для рабочих потоков: загрузка идёт через общий HTTP-клиент"""
     try:
-        response = urlopen(url, timeout=timeout)
-        image_data = response.read()
-        return Image.open(io.BytesIO(image_data))
-    except (URLError, HTTPError, Exception) as e:
+        return http_client.run_sync(get_pdf_thumbnail(url, timeout=timeout), timeout=timeout * 3)
+    except Exception as e:
         logger.warning(f"Failed to download image from {url}: {e}")
         return None
 
 
-async def preload_order_images(order_items: list) -> Dict[str, Image.Image]:
+async def preload_order_images(order_items: list) -> Dict[str, bytes]:
     """
-    Параллельная предзагрузка всех изображений для заказа
+    Параллельная предзагрузка всех изображений для заказа (JPEG-миниатюры для PDF)
     """
     image_urls = []
     
@@ -1682,7 +4668,7 @@ async def preload_order_images(order_items: list) -> Dict[str, Image.Image]:
     
     logger.info(f"⚡ Preloading {len(image_urls)} unique images in parallel...")
     
-    tasks = [download_image_async(url, timeout=5) for url in image_urls]
+    tasks = [get_pdf_thumbnail(url, timeout=5) for url in image_urls]
     images = await asyncio.gather(*tasks, return_exceptions=True)
     
     result = {}
@@ -1693,6 +4679,137 @@ async def preload_order_images(order_items: list) -> Dict[str, Image.Image]:
     logger.info(f"✅ Preloaded {len(result)} images successfully")
     return result
 
+
+class ImagePrewarmer:
+    """Фоновая подгрузка изображений каталога, чтобы PDF заказа не ждал сеть
+
+    Подписан на изменения каталога: для новых товаров и товаров со сменившимся фото
+    изображение загружается (ImageFetcher) и сразу превращается в миниатюру для PDF.
+    Исходник в кеш декодированных изображений не кладётся — он нужен только для
+    миниатюры, а байты остаются в DiskImageStore. Фото, которые больше не использует
+    ни один товар, удаляются из всех кешей и с диска.
+
+    После каждого обновления каталога (refresh_all) в очередь снова ставятся фото без
+    миниатюры и фото, чей файл на диске пора перепроверить: условный запрос делается
+    в фоне, и PDF заказа не ждёт сеть и спустя IMAGE_CACHE_LIFETIME.
+
+    Загрузок одновременно — не больше concurrency, чтобы не мешать заказам.
+    """
+
+    def __init__(self, catalog: CatalogCache, concurrency: int = IMAGE_PREWARM_CONCURRENCY):
+        self.catalog = catalog
+        self.concurrency = concurrency
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: set = set()
+        self._workers: List[asyncio.Task] = []
+        self._tasks: set = set()  # фоновые удаления (ссылки, чтобы задачи не собрал GC)
+
+        self.warmed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.evicted = 0
+
+    def start(self):
+        if self.concurrency <= 0 or self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self.catalog.subscribe(self.on_catalog_changes)
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, *self._tasks, return_exceptions=True)
+        self._workers = []
+
+    def enqueue(self, url: str):
+        if self._queue is None or not url or url in self._pending:
+            return
+        self._pending.add(url)
+        self._queue.put_nowait(url)
+
+    @staticmethod
+    def is_warm(url: str) -> bool:
+        """Миниатюра есть, и исходник на диске не пора перепроверять"""
+        if url not in thumbnail_cache:
+            return False
+        meta = disk_image_store.lookup(url)
+        return meta is not None and disk_image_store.is_fresh(meta)
+
+    def refresh_all(self):
+        """Ставит в очередь фото каталога без миниатюры или с устаревшим файлом на диске
+
+        Вызывается после загрузки из снимка и после каждого обновления каталога.
+        """
+        for product in list(self.catalog.products.values()):
+            if product.image and not self.is_warm(product.image):
+                self.enqueue(product.image)
+
+    def on_catalog_changes(self, changes: List[CatalogChange]):
+        in_use = {product.image for product in self.catalog.products.values()}
+        dropped = set()
+        for change in changes:
+            old_image = change.old.image if change.old is not None else ""
+            new_image = change.new.image if change.new is not None else ""
+            if new_image and (new_image != old_image or new_image not in thumbnail_cache):
+                self.enqueue(new_image)
+            if old_image and old_image != new_image and old_image not in in_use:
+                dropped.add(old_image)
+
+        if dropped:
+            task = asyncio.create_task(self._evict(dropped))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _evict(self, urls: set):
+        for url in urls:
+            thumbnail_cache.discard(url)
+            image_cache.discard(url)
+            try:
+                await asyncio.to_thread(disk_image_store.discard, url)
+            except OSError:
+                logger.exception(f"Failed to remove image {url} from disk")
+            self.evicted += 1
+        logger.info(f"🗑 Evicted {len(urls)} images removed from the catalog")
+
+    async def _worker(self):
+        while True:
+            url = await self._queue.get()
+            try:
+                if self.is_warm(url):
+                    self.skipped += 1
+                    continue
+                data = await image_fetcher.fetch(url)
+                try:
+                    thumb = await asyncio.to_thread(lambda: make_pdf_thumbnail(decode_image(data)))
+                except Exception:
+                    await asyncio.to_thread(disk_image_store.discard, url)
+                    raise
+                thumbnail_cache.put(url, thumb)
+                self.warmed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.debug(f"Image prewarm failed for {url}: {e}")
+            finally:
+                self._pending.discard(url)
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "warmed": self.warmed,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "evicted": self.evicted,
+        }
+
+
+image_prewarmer = ImagePrewarmer(catalog_cache)
+
+
 def generate_order_pdf(
     order_items: list,
     total: int,
@@ -1703,7 +4820,7 @@ def generate_order_pdf(
     category: Optional[str] = None,
     latitude: Optional[float] = None,
     longitude: Optional[float] = None,
-    preloaded_images: Optional[Dict[str, Image.Image]] = None  # ✅ НОВЫЙ ПАРАМЕТР
+    preloaded_images: Optional[Dict[str, bytes]] = None  # ✅ НОВЫЙ ПАРАМЕТР: {url: JPEG-миниатюра}
 ) -> bytes:
     """Генерирует PDF заказа с фотографиями товаров"""
     buffer = io.BytesIO()
@@ -1916,27 +5033,20 @@ def generate_order_pdf(
                # ✅ РИСУЕМ ИЗОБРАЖЕНИЕ ТОВАРА
         if image_url:
             try:
-                product_image = None
+                product_thumb = None
 
                 if preloaded_images and image_url in preloaded_images:
-                    product_image = preloaded_images[image_url]
+                    product_thumb = preloaded_images[image_url]
                     logger.debug("Using preloaded image")
                 else:
-                    product_image = download_image(image_url, timeout=5)
+                    product_thumb = download_pdf_thumbnail(image_url, timeout=5)
 
-                if product_image:
-                    # Конвертируем в RGB если необходимо
-                    if product_image.mode != "RGB":
-                        product_image = product_image.convert("RGB")
-
-                    # Создаем ImageReader из PIL Image
-                    img_buffer = io.BytesIO()
-                    product_image.save(img_buffer, format="JPEG")
-                    img_buffer.seek(0)
-                    img_reader = ImageReader(img_buffer)
+                if product_thumb:
+                    # Готовая JPEG-миниатюра: reportlab встроит её без перекодирования
+                    img_reader = ImageReader(io.BytesIO(product_thumb))
 
                     # Рисуем изображение с центрированием по вертикали
-                    img_size = 16 * mm
+                    img_size = PDF_IMAGE_SIZE_MM * mm
                     img_x = table_x + col_num_w + 1 * mm
                     img_y = row_center_y - (img_size / 2)
 
@@ -2103,6 +5213,8 @@ router = Router()
 # Добавляем middleware
 dp.message.middleware(rate_limiter)
 dp.message.middleware(WebAppTimerMiddleware())
+dp.message.middleware(UserContextMiddleware())
+dp.callback_query.middleware(UserContextMiddleware())
 
 # Регистрируем роутер
 dp.include_router(router)
@@ -2111,7 +5223,7 @@ dp.include_router(router)
 # ==================== КОМАНДЫ ====================
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, user_ctx: UserContext):
     """Команда /start с перепроверкой дилера"""
 
     user_id = message.from_user.id
@@ -2120,7 +5232,7 @@ async def cmd_start(message: Message, state: FSMContext):
     last_name = message.from_user.last_name
     
     # Регистрируем пользователя с полной информацией из Telegram
-    add_user(user_id, username, first_name, last_name)
+    await users_repo.add(user_id, username, first_name, last_name)
 
     # ===== ОБНОВЛЕНИЕ ТАЙМЕРА WEBAPP =====
     update_user_start_time(user_id)
@@ -2132,8 +5244,8 @@ async def cmd_start(message: Message, state: FSMContext):
 
     asyncio.create_task(expire_webapp_keyboard())
 
-    lang = get_user_lang(user_id)
-    profile = get_user_profile(user_id)
+    lang = user_ctx.lang
+    profile = user_ctx.profile
 
     # ===== 1. ЕСЛИ ПОЛЬЗОВАТЕЛЬ НЕ ЗАРЕГИСТРИРОВАН =====
     if not profile or not all(k in profile for k in ["phone", "city", "full_name"]):
@@ -2238,9 +5350,9 @@ async def block_expired_webapp(message: Message):
         )
 
 @router.callback_query(F.data == "register")
-async def callback_register(callback: CallbackQuery, state: FSMContext):
+async def callback_register(callback: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Начало регистрации"""
-    lang = get_user_lang(callback.from_user.id)
+    lang = user_ctx.lang
 
     if lang == "ru":
         text = "📱 Поделитесь своим номером телефона:"
@@ -2263,12 +5375,12 @@ async def callback_register(callback: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(F.data == "toggle_lang")
-async def callback_toggle_lang(callback: CallbackQuery):
+async def callback_toggle_lang(callback: CallbackQuery, user_ctx: UserContext):
     """Переключение языка"""
     user_id = callback.from_user.id
-    current_lang = get_user_lang(user_id)
+    current_lang = user_ctx.lang
     new_lang = "uz" if current_lang == "ru" else "ru"
-    set_user_lang(user_id, new_lang)
+    await users_repo.set_lang(user_id, new_lang)
 
     if new_lang == "ru":
         text = "🇷🇺 Язык изменён на русский"
@@ -2278,8 +5390,7 @@ async def callback_toggle_lang(callback: CallbackQuery):
     await callback.answer(text, show_alert=True)
 
     # Обновляем меню
-    profile = get_user_profile(user_id)
-    if not profile or not all(k in profile for k in ["phone", "city", "full_name"]):
+    if not user_ctx.is_registered:
         if new_lang == "ru":
             text = "👋 Добро пожаловать! Для начала работы необходимо зарегистрироваться."
         else:
@@ -2300,9 +5411,9 @@ async def callback_toggle_lang(callback: CallbackQuery):
 
 
 @router.message(RegistrationStates.waiting_for_phone)
-async def process_phone(message: Message, state: FSMContext):
+async def process_phone(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка номера телефона"""
-    lang = get_user_lang(message.from_user.id)
+    lang = user_ctx.lang
 
     if not message.contact:
         if lang == "ru":
@@ -2324,9 +5435,9 @@ async def process_phone(message: Message, state: FSMContext):
 
 
 @router.message(RegistrationStates.waiting_for_city)
-async def process_city(message: Message, state: FSMContext):
+async def process_city(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка города"""
-    lang = get_user_lang(message.from_user.id)
+    lang = user_ctx.lang
     city = message.text.strip()
 
     if not city:
@@ -2359,9 +5470,9 @@ async def process_city(message: Message, state: FSMContext):
 
 
 @router.message(RegistrationStates.waiting_for_location)
-async def process_location(message: Message, state: FSMContext):
+async def process_location(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка геолокации"""
-    lang = get_user_lang(message.from_user.id)
+    lang = user_ctx.lang
 
     if not message.location:
         if lang == "ru":
@@ -2385,11 +5496,11 @@ async def process_location(message: Message, state: FSMContext):
 
 
 @router.message(RegistrationStates.waiting_for_full_name)
-async def process_full_name(message: Message, state: FSMContext):
+async def process_full_name(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка полного имени + проверка дилера"""
 
     user_id = message.from_user.id
-    lang = get_user_lang(user_id)
+    lang = user_ctx.lang
     full_name = message.text.strip()
 
     # Проверка имени
@@ -2411,7 +5522,7 @@ async def process_full_name(message: Message, state: FSMContext):
         "latitude": data.get("latitude"),
         "longitude": data.get("longitude")
     }
-    set_user_profile(user_id, profile)
+    await users_repo.set_profile(user_id, profile)
 
     # 🔍 ПРОВЕРКА ДИЛЕРА ЧЕРЕЗ GOOGLE SHEETS
     dealer_status = await check_dealer_status(
@@ -2479,14 +5590,14 @@ async def process_full_name(message: Message, state: FSMContext):
 
 
 @router.message(F.content_type == ContentType.WEB_APP_DATA)
-async def handle_webapp_data(message: Message, state: FSMContext):
+async def handle_webapp_data(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка данных из WebApp + проверка дилера"""
 
     user_id = message.from_user.id
-    lang = get_user_lang(user_id)
+    lang = user_ctx.lang
 
     # ===== 1. ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ =====
-    profile = get_user_profile(user_id)
+    profile = user_ctx.profile
 
     if not profile or not profile.get("phone"):
         if lang == "ru":
@@ -2613,16 +5724,7 @@ async def handle_webapp_data(message: Message, state: FSMContext):
                 return
             
             # Формируем полный объект товара
-            enriched_item = {
-                "id": product_id,
-                "name": product.get("name", "Без названия"),
-                "price": int(product.get("price", 0)),
-                "qty": qty,
-                "image": product.get("image", ""),
-                "category": product.get("category", "unknown"),
-                "weight": float(product.get("weight", 0)),
-                "cube": float(product.get("cube", 0))
-            }
+            enriched_item = product.order_item(qty)
             
             enriched_items.append(enriched_item)
             total_price += enriched_item["price"] * qty
@@ -2633,10 +5735,13 @@ async def handle_webapp_data(message: Message, state: FSMContext):
         logger.info(f"✅ Enriched order data: {len(enriched_items)} items, total: {total_price}")
         
         # Формируем полный объект заказа
+        # Если Sheets недоступен, цены берутся из устаревшего снимка каталога — запоминаем его дату
+        catalog_as_of = catalog_cache.outdated_since()
         validated_data = {
             "items": enriched_items,
             "total": total_price,
-            "user_id": data.get("user_id", 0)
+            "user_id": data.get("user_id", 0),
+            "catalog_as_of": catalog_as_of.strftime('%d.%m.%Y %H:%M') if catalog_as_of else None
         }
         
     except Exception as e:
@@ -2689,10 +5794,15 @@ async def handle_webapp_data(message: Message, state: FSMContext):
     pdf_file = BufferedInputFile(pdf_preview, filename=f"order_preview_{temp_order_id}.pdf")
 
     if lang == "ru":
+        catalog_note = (
+            f"🕒 Цены по каталогу от {validated_data['catalog_as_of']}\n"
+            if validated_data["catalog_as_of"] else ""
+        )
         preview_text = (
             f"📋 Предпросмотр вашего заказа\n\n"
             f"💰 Сумма: {format_currency(validated_data['total'])}\n"
-            f"📦 Товаров: {len(validated_data['items'])}\n\n"
+            f"📦 Товаров: {len(validated_data['items'])}\n"
+            f"{catalog_note}\n"
             f"⚠️ ВНИМАНИЕ!\n"
             f"Внимательно проверьте заказ выше.\n"
             f"Вы несете ответственность за корректность данных.\n\n"
@@ -2700,10 +5810,15 @@ async def handle_webapp_data(message: Message, state: FSMContext):
             f"✅ Если все верно - введите ваше полное имя для подтверждения:"
         )
     else:
+        catalog_note = (
+            f"🕒 Narxlar {validated_data['catalog_as_of']} holatidagi katalog bo'yicha\n"
+            if validated_data["catalog_as_of"] else ""
+        )
         preview_text = (
             f"📋 Buyurtmangizni ko'rib chiqing\n\n"
             f"💰 Summa: {format_currency(validated_data['total'])}\n"
-            f"📦 Mahsulotlar: {len(validated_data['items'])}\n\n"
+            f"📦 Mahsulotlar: {len(validated_data['items'])}\n"
+            f"{catalog_note}\n"
             f"⚠️ DIQQAT!\n"
             f"Yuqoridagi buyurtmani diqqat bilan tekshiring.\n"
             f"Siz ma'lumotlarning to'g'riligiga javobgarsiz.\n\n"
@@ -2718,37 +5833,27 @@ async def handle_webapp_data(message: Message, state: FSMContext):
     await state.set_state(OrderSign.waiting_name)
 
 @router.message(F.text.in_(["🏠 Главный меню", "🏠 Bosh menyu"]))
-async def expired_button_as_start(message: Message, state: FSMContext):
-    await cmd_start(message, state)
+async def expired_button_as_start(message: Message, state: FSMContext, user_ctx: UserContext):
+    await cmd_start(message, state, user_ctx)
 
-@router.message(F.text.in_(["📋 Мои заказы", "📋 Mening buyurtmalarim"]))
-async def cmd_my_orders(message: Message):
-    """Просмотр заказов пользователя"""
-    user_id = message.from_user.id
-    lang = get_user_lang(user_id)
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT order_id, total, status, created_at 
-            FROM orders 
-            WHERE user_id = %s 
-            ORDER BY created_at DESC 
-            LIMIT 10
-        """, (user_id,))
-        orders = [dict(row) for row in cursor.fetchall()]
+MY_ORDERS_CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def parse_my_orders_cursor(value: str) -> datetime:
+    """created_at из курсора "Мои заказы" (старые кнопки — без микросекунд)"""
+    if len(value) == 14:
+        return datetime.strptime(value, "%Y%m%d%H%M%S")
+    return datetime.strptime(value, MY_ORDERS_CURSOR_FORMAT)
 
-    if not orders:
-        if lang == "ru":
-            await message.answer("У вас пока нет заказов.")
-        else:
-            await message.answer("Sizda hali buyurtmalar yo'q.")
-        return
 
+def build_my_orders_page(orders: List[Dict[str, Any]], lang: str, page: int,
+                         next_key: Optional[tuple]) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Текст и кнопки листания для страницы «Мои заказы»"""
     if lang == "ru":
-        text = "📋 Ваши заказы:\n\n"
+        text = "📋 Ваши заказы:\n\n" if page == 1 else f"📋 Ваши заказы (стр. {page}):\n\n"
     else:
-        text = "📋 Sizning buyurtmalaringiz:\n\n"
+        text = "📋 Sizning buyurtmalaringiz:\n\n" if page == 1 else f"📋 Sizning buyurtmalaringiz ({page}-sahifa):\n\n"
 
     status_names = {
         "pending": "⏳ Ожидает" if lang == "ru" else "⏳ Kutilmoqda",
@@ -2767,15 +5872,77 @@ async def cmd_my_orders(message: Message):
         text += f"📅 {order['created_at'].strftime('%Y-%m-%d') if isinstance(order['created_at'], datetime) else str(order['created_at'])[:10]}\n"
         text += f"📊 {status}\n\n"
 
-    await message.answer(text)
+    # Курсор следующей страницы: myorders:<номер>:<created_at с микросекундами>:<order_id>
+    # (SQLite хранит created_at с микросекундами: без них терялись бы заказы той же секунды)
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton(
+            text="⏮ В начало" if lang == "ru" else "⏮ Boshiga",
+            callback_data="myorders:1"
+        ))
+    if next_key:
+        created_at, order_id = next_key
+        buttons.append(InlineKeyboardButton(
+            text="Старее ➡️" if lang == "ru" else "Oldingilari ➡️",
+            callback_data=f"myorders:{page + 1}:{created_at.strftime(MY_ORDERS_CURSOR_FORMAT)}:{order_id}"
+        ))
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return text, kb
+
+
+@router.message(F.text.in_(["📋 Мои заказы", "📋 Mening buyurtmalarim"]))
+async def cmd_my_orders(message: Message, user_ctx: UserContext):
+    """Просмотр заказов пользователя (первая страница)"""
+    user_id = message.from_user.id
+    lang = user_ctx.lang
+
+    orders, next_key = await orders_repo.get_page_by_user(user_id)
+
+    if not orders:
+        if lang == "ru":
+            await message.answer("У вас пока нет заказов.")
+        else:
+            await message.answer("Sizda hali buyurtmalar yo'q.")
+        return
+
+    text, kb = build_my_orders_page(orders, lang, 1, next_key)
+    await message.answer(text, reply_markup=kb)
+
+
+@router.callback_query(F.data.startswith("myorders:"))
+async def callback_my_orders_page(callback: CallbackQuery, user_ctx: UserContext):
+    """Листание «Мои заказы» по ключу (created_at, order_id)"""
+    user_id = callback.from_user.id
+    lang = user_ctx.lang
+
+    parts = callback.data.split(":")
+    try:
+        page = int(parts[1])
+        before = (parse_my_orders_cursor(parts[2]), parts[3]) if len(parts) == 4 else None
+    except (IndexError, ValueError):
+        await callback.answer()
+        return
+
+    orders, next_key = await orders_repo.get_page_by_user(user_id, before)
+
+    if not orders:
+        await callback.answer("Больше заказов нет" if lang == "ru" else "Boshqa buyurtmalar yo'q")
+        return
+
+    text, kb = build_my_orders_page(orders, lang, page, next_key)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
 
 
 @router.message(F.text.in_(["⚙️ Настройки", "⚙️ Sozlamalar"]))
-async def cmd_settings(message: Message):
+async def cmd_settings(message: Message, user_ctx: UserContext):
     """Настройки пользователя"""
-    user_id = message.from_user.id
-    lang = get_user_lang(user_id)
-    profile = get_user_profile(user_id)
+    lang = user_ctx.lang
+    profile = user_ctx.profile
 
     if lang == "ru":
         location_text = ""
@@ -2824,6 +5991,12 @@ async def cmd_admin(message: Message):
         text += "• /sendall - массовая рассылка\n"
         text += "• /send - отправить сообщение пользователю\n"
         text += "• /get_pdf - получить PDF заказа\n"
+        text += "• /stats - статистика заказов\n"
+        text += "• /top_products - продажи по товарам\n"
+        text += "• /db_stats - статистика пула БД\n"
+        text += "• /slow_queries - самые медленные запросы\n"
+        text += "• /catalog_stats - кеш каталога товаров\n"
+        text += "• /image_cache - кеш изображений товаров\n"
 
     if has_permission(user_id, AdminRole.SALES):
         text += "• Одобрение/отклонение заказов\n"
@@ -2875,12 +6048,18 @@ async def callback_approve_order_confirmed(callback: CallbackQuery):
         return
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order_data = await orders_repo.get_raw(order_id)
 
     if not order_data:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
+    # Атомарно занимаем переход pending -> approved ДО рендера PDF:
+    # двойное нажатие или второй админ не запустят рендер и загрузку повторно
+    if not await orders_repo.transition(order_id, OrderStatus.APPROVED, updated_by=user_id):
+        await callback.answer("⚠️ Заказ уже обработан", show_alert=True)
+        return
+
     # ⚡ ВАЖНО: Отвечаем сразу, чтобы избежать timeout (Telegram дает только 30 сек)
     await callback.answer("⏳ Обработка заказа началась...")
 
@@ -2888,44 +6067,57 @@ async def callback_approve_order_confirmed(callback: CallbackQuery):
     order_category = order_data.get("category")
 
     # Получаем координаты клиента
-    client_profile = get_user_profile(order_data["user_id"])
+    client_profile = await users_repo.get_profile(order_data["user_id"])
     client_latitude = client_profile.get("latitude") if client_profile else None
     client_longitude = client_profile.get("longitude") if client_profile else None
 
-    # Генерируем финальный PDF
-    order_json = json.loads(order_data["order_json"])
-    client_name = order_data.get("client_name", "Клиент")
-    
-    # Проверяем, является ли заказ мультикатегорийным
-    is_multi_category = len(set(item.get("category") for item in order_json["items"])) > 1
-    
-    preloaded_images = await preload_order_images(order_json["items"])
-    
-    pdf_final = await asyncio.to_thread(
-        generate_order_pdf,
-        order_items=order_json["items"],
-        total=order_json["total"],
-        client_name=client_name,
-        admin_name=ADMIN_NAME,
-        order_id=order_id,
-        approved=True,
-        category=None if is_multi_category else get_order_category(order_json["items"]),
-        latitude=client_latitude,
-        longitude=client_longitude,
-        preloaded_images=preloaded_images
-    )
+    # Генерируем финальный PDF. Если не получилось — возвращаем заказ в pending,
+    # иначе он навсегда останется "одобренным" без PDF и без уведомления производства
+    try:
+        order_json = json.loads(order_data["order_json"])
+        client_name = order_data.get("client_name", "Клиент")
+
+        # Проверяем, является ли заказ мультикатегорийным
+        is_multi_category = len(set(item.get("category") for item in order_json["items"])) > 1
+
+        preloaded_images = await preload_order_images(order_json["items"])
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.APPROVED, pdf_final, user_id)
+        pdf_final = await asyncio.to_thread(
+            generate_order_pdf,
+            order_items=order_json["items"],
+            total=order_json["total"],
+            client_name=client_name,
+            admin_name=ADMIN_NAME,
+            order_id=order_id,
+            approved=True,
+            category=None if is_multi_category else get_order_category(order_json["items"]),
+            latitude=client_latitude,
+            longitude=client_longitude,
+            preloaded_images=preloaded_images
+        )
+
+        # Сохраняем финальный PDF (статус уже сменён выше)
+        await orders_repo.attach_final_pdf(order_id, pdf_final)
+    except Exception:
+        logger.exception(f"Order {order_id}: approval failed, reverting to pending")
+        await orders_repo.transition(order_id, OrderStatus.PENDING, expected_status=OrderStatus.APPROVED)
+        await callback.message.answer(
+            f"❌ Не удалось одобрить заказ #{order_id}: ошибка при создании PDF. "
+            f"Заказ возвращён в ожидание, попробуйте ещё раз."
+        )
+        return
 
     # Загружаем PDF
     await upload_pdf_to_hosting_async(order_id, pdf_final)
 
     # Уведомляем клиента через группированное сообщение
     client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
-    base_order_id = order_data.get("base_order_id") or order_id
-    await send_or_update_client_notification(base_order_id, client_user_id, lang)
+    try:
+        lang = await users_repo.get_lang(client_user_id)
+        base_order_id = order_data.get("base_order_id") or order_id
+        await send_or_update_client_notification(base_order_id, client_user_id, lang)
+    except Exception:
+        logger.exception(f"Order {order_id}: failed to notify client {client_user_id}")
 
     # Уведомляем соответствующий цех производства
     if order_category:
@@ -3045,18 +6237,20 @@ async def callback_reject_order_confirmed(callback: CallbackQuery):
         return
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order_data = await orders_repo.get_header(order_id)
 
     if not order_data:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.REJECTED, updated_by=user_id)
+    # Атомарно меняем статус: повторное нажатие или другой админ не запустят обработку второй раз
+    if not await orders_repo.transition(order_id, OrderStatus.REJECTED, updated_by=user_id):
+        await callback.answer("⚠️ Заказ уже обработан", show_alert=True)
+        return
 
     # Уведомляем клиента через группированное сообщение
     client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
+    lang = await users_repo.get_lang(client_user_id)
     base_order_id = order_data.get("base_order_id") or order_id
     await send_or_update_client_notification(base_order_id, client_user_id, lang)
 
@@ -3116,7 +6310,7 @@ async def callback_production_received(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order_data = await orders_repo.get_header(order_id)
 
     if not order_data:
         await callback.answer("Заказ не найден", show_alert=True)
@@ -3131,12 +6325,14 @@ async def callback_production_received(callback: CallbackQuery):
         await callback.answer(f"У вас нет прав для обработки заказов категории {category_name}", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.PRODUCTION_RECEIVED, updated_by=user_id)
+    # Атомарно меняем статус: повторное нажатие или другой админ не запустят обработку второй раз
+    if not await orders_repo.transition(order_id, OrderStatus.PRODUCTION_RECEIVED, updated_by=user_id):
+        await callback.answer("⚠️ Заказ уже обработан", show_alert=True)
+        return
 
     # Уведомляем клиента через группированное сообщение
     client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
+    lang = await users_repo.get_lang(client_user_id)
     base_order_id = order_data.get("base_order_id") or order_id
     await send_or_update_client_notification(base_order_id, client_user_id, lang)
 
@@ -3183,7 +6379,7 @@ async def callback_production_started(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order_data = await orders_repo.get_header(order_id)
 
     if not order_data:
         await callback.answer("Заказ не найден", show_alert=True)
@@ -3197,12 +6393,14 @@ async def callback_production_started(callback: CallbackQuery):
         await callback.answer(f"У вас нет прав для обработки заказов категории {category_name}", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.PRODUCTION_STARTED, updated_by=user_id)
+    # Атомарно меняем статус: повторное нажатие или другой админ не запустят обработку второй раз
+    if not await orders_repo.transition(order_id, OrderStatus.PRODUCTION_STARTED, updated_by=user_id):
+        await callback.answer("⚠️ Заказ уже обработан", show_alert=True)
+        return
 
     # Уведомляем клиента через группированное сообщение
     client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
+    lang = await users_repo.get_lang(client_user_id)
     base_order_id = order_data.get("base_order_id") or order_id
     await send_or_update_client_notification(base_order_id, client_user_id, lang)
 
@@ -3249,7 +6447,7 @@ async def callback_sent_to_warehouse(callback: CallbackQuery):
     user_id = callback.from_user.id
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order_data = await orders_repo.get_header(order_id)
 
     if not order_data:
         await callback.answer("Заказ не найден", show_alert=True)
@@ -3263,12 +6461,14 @@ async def callback_sent_to_warehouse(callback: CallbackQuery):
         await callback.answer(f"У вас нет прав для обработки заказов категории {category_name}", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.SENT_TO_WAREHOUSE, updated_by=user_id)
+    # Атомарно меняем статус: повторное нажатие или другой админ не запустят обработку второй раз
+    if not await orders_repo.transition(order_id, OrderStatus.SENT_TO_WAREHOUSE, updated_by=user_id):
+        await callback.answer("⚠️ Заказ уже обработан", show_alert=True)
+        return
 
     # Уведомляем клиента через группированное сообщение
     client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
+    lang = await users_repo.get_lang(client_user_id)
     base_order_id = order_data.get("base_order_id") or order_id
     await send_or_update_client_notification(base_order_id, client_user_id, lang)
 
@@ -3319,18 +6519,20 @@ async def callback_warehouse_received(callback: CallbackQuery):
         return
 
     order_id = callback.data.split(":")[1]
-    order_data = get_order_raw(order_id)
+    order_data = await orders_repo.get_header(order_id)
 
     if not order_data:
         await callback.answer("Заказ не найден", show_alert=True)
         return
 
-    # Обновляем статус
-    update_order_status(order_id, OrderStatus.WAREHOUSE_RECEIVED, updated_by=user_id)
+    # Атомарно меняем статус: повторное нажатие или другой админ не запустят обработку второй раз
+    if not await orders_repo.transition(order_id, OrderStatus.WAREHOUSE_RECEIVED, updated_by=user_id):
+        await callback.answer("⚠️ Заказ уже обработан", show_alert=True)
+        return
 
     # Уведомляем клиента
     client_user_id = order_data["user_id"]
-    lang = get_user_lang(client_user_id)
+    lang = await users_repo.get_lang(client_user_id)
     category = order_data.get("category")
 
     # НОВОЕ: Отправляем отдельное уведомление о готовности этой категории
@@ -3443,12 +6645,12 @@ async def cmd_send(message: Message):
 
 
 @router.message(OrderSign.waiting_name)
-async def order_signature_handler(message: Message, state: FSMContext):
+async def order_signature_handler(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработка подписи заказа"""
+    lang = user_ctx.lang
     try:
-        lang = get_user_lang(message.from_user.id)
         sign_name = message.text.strip()
-        profile_name = get_user_full_name(message.from_user.id)
+        profile_name = user_ctx.full_name
 
         if not sign_name:
             if lang == "ru":
@@ -3498,9 +6700,9 @@ async def order_signature_handler(message: Message, state: FSMContext):
         base_order_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}{message.from_user.id % 10000:04d}"
 
         # Получаем координаты клиента
-        client_profile = get_user_profile(message.from_user.id)
-        client_latitude = client_profile.get("latitude") if client_profile else None
-        client_longitude = client_profile.get("longitude") if client_profile else None
+        profile = user_ctx.profile
+        client_latitude = profile.get("latitude")
+        client_longitude = profile.get("longitude")
 
         # Группируем товары по категориям
         grouped_items = group_items_by_category(order_data["items"])
@@ -3511,10 +6713,7 @@ async def order_signature_handler(message: Message, state: FSMContext):
         for cat, items in grouped_items.items():
             logger.info(f"  - {cat} ({get_category_name(cat)}): {len(items)} items")
         
-        # Регистрируем заказ
-        rate_limiter.register_order(message.from_user.id)
-
-        # ===== ОТПРАВЛЯЕМ КЛИЕНТУ ТОЛЬКО ТЕКСТОВОЕ ПОДТВЕРЖДЕНИЕ =====
+        # ===== ТЕКСТОВОЕ ПОДТВЕРЖДЕНИЕ КЛИЕНТУ =====
         # PDF клиент уже получил при предпросмотре, повторно не отправляем
         if lang == "ru":
             user_text = (
@@ -3537,19 +6736,20 @@ async def order_signature_handler(message: Message, state: FSMContext):
                 f"Buyurtma holati haqida sizga xabar yuboriladi"
             )
 
-        await message.answer(user_text)
-
-        # Отправляем в админ-чат (группу) - отдельные PDF для каждой категории
-        profile = get_user_profile(message.from_user.id)
+        # Цены из устаревшего снимка каталога (Sheets не отвечал при оформлении)
+        catalog_note = ""
+        if order_data.get("catalog_as_of"):
+            catalog_note = f"⚠️ Цены по устаревшему каталогу от {order_data['catalog_as_of']}\n"
 
         # Формируем строку с координатами
         location_text = ""
         if client_latitude is not None and client_longitude is not None:
             location_text = f"📍 Координаты: {client_latitude:.6f}, {client_longitude:.6f}\n"
 
-        # Создаем и отправляем PDF для каждой категории
-        part_num = 1
-        for category, category_items in sorted(grouped_items.items()):
+        # Сначала готовим PDF всех частей заказа, затем сохраняем их одной транзакцией:
+        # клиент и админы узнают о заказе только после того, как он записан в БД целиком
+        sub_orders = []
+        for part_num, (category, category_items) in enumerate(sorted(grouped_items.items()), 1):
             # Формируем подномер заказа
             sub_order_id = f"{base_order_id}_{part_num}"
 
@@ -3557,9 +6757,8 @@ async def order_signature_handler(message: Message, state: FSMContext):
             category_total = sum(item.get("qty", 0) * item.get("price", 0) for item in category_items)
 
             # Генерируем PDF для этой категории
-            
             sub_preloaded = await preload_order_images(category_items)
-            
+
             pdf_category = await asyncio.to_thread(
                 generate_order_pdf,
                 order_items=category_items,
@@ -3573,17 +6772,34 @@ async def order_signature_handler(message: Message, state: FSMContext):
                 longitude=client_longitude,
                 preloaded_images=sub_preloaded
             )
-            # Сохраняем в БД
-            save_order(
-                order_id=sub_order_id,
-                client_name=final_name,
-                user_id=message.from_user.id,
-                total=category_total,
-                pdf_draft=pdf_category,
-                order_json={"items": category_items, "total": category_total},
-                category=category,
-                base_order_id=base_order_id
-            )
+            sub_orders.append({
+                "order_id": sub_order_id,
+                "total": category_total,
+                "pdf_draft": pdf_category,
+                "order_json": {"items": category_items, "total": category_total},
+                "category": category,
+            })
+
+        # Сохраняем все части одной транзакцией
+        await orders_repo.save_base(
+            base_order_id=base_order_id,
+            client_name=final_name,
+            user_id=message.from_user.id,
+            sub_orders=sub_orders
+        )
+
+        # Регистрируем заказ
+        rate_limiter.register_order(message.from_user.id)
+
+        await message.answer(user_text)
+
+        # Загружаем на хостинг и отправляем в админ-чат (группу) - отдельные PDF для каждой категории
+        for part_num, sub_order in enumerate(sub_orders, 1):
+            sub_order_id = sub_order["order_id"]
+            category = sub_order["category"]
+            category_items = sub_order["order_json"]["items"]
+            category_total = sub_order["total"]
+            pdf_category = sub_order["pdf_draft"]
 
             # Загружаем на хостинг
             await upload_pdf_to_hosting_async(sub_order_id, pdf_category)
@@ -3602,7 +6818,8 @@ async def order_signature_handler(message: Message, state: FSMContext):
                 f"💰 Сумма (этой категории): {format_currency(category_total)}\n"
                 f"💰 Общая сумма заказа: {format_currency(order_data['total'])}\n"
                 f"📦 Товаров (в этой категории): {len(category_items)}\n"
-                f"📦 Товаров (всего в заказе): {len(order_data['items'])}\n\n"
+                f"📦 Товаров (всего в заказе): {len(order_data['items'])}\n"
+                f"{catalog_note}\n"
                 f"📊 Статус: ⏳ Ожидает одобрения\n"
                 f"━━━━━━━━━━━━━━━━━━━━━━"
             )
@@ -3626,13 +6843,10 @@ async def order_signature_handler(message: Message, state: FSMContext):
             except Exception as e:
                 logger.exception(f"Failed to send order part {sub_order_id} to admin chat {ADMIN_CHAT_ID}")
 
-            part_num += 1
-
         await state.clear()
 
     except Exception as e:
         logger.exception(f"Error in order signature handler")
-        lang = get_user_lang(message.from_user.id)
         if lang == "ru":
             await message.answer("❌ Произошла ошибка при обработке заказа. Попробуйте позже.")
         else:
@@ -3642,37 +6856,56 @@ async def order_signature_handler(message: Message, state: FSMContext):
 
 @router.message(Command("orders_export"))
 async def cmd_orders_export(message: Message):
-    """Экспорт заказов (только супер-админ)"""
+    """Экспорт заказов (только супер-админ)
+
+    /orders_export [С_ДАТЫ [ПО_ДАТУ]] [статус] [gz]
+    """
     if message.from_user.id != SUPER_ADMIN_ID:
         return
 
-    orders = get_all_orders(limit=10000)
+    dates = []
+    status = None
+    compress = False
 
-    if not orders:
-        await message.answer("В базе нет заказов.")
+    for arg in message.text.split()[1:]:
+        if arg.lower() in ("gz", "gzip"):
+            compress = True
+        elif arg in STATUS_NAMES_RU:
+            status = arg
+        else:
+            try:
+                dates.append(datetime.strptime(arg, "%Y-%m-%d"))
+            except ValueError:
+                dates = None
+                break
+
+    if dates is None or len(dates) > 2:
+        await message.answer(
+            "Использование:\n"
+            "`/orders_export [С_ДАТЫ [ПО_ДАТУ]] [статус] [gz]`\n\n"
+            "Даты в формате ГГГГ-ММ-ДД, статус — например `approved`, `gz` — сжать файл.",
+            parse_mode="Markdown"
+        )
         return
 
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=";")
-    writer.writerow(["order_id", "client_name", "user_id", "total", "created_at", "status"])
-
-    for o in orders:
-        writer.writerow([
-            o["order_id"],
-            o["client_name"],
-            o["user_id"],
-            o["total"],
-            o["created_at"],
-            o["status"] or "",
-        ])
+    date_from = dates[0] if dates else None
+    date_to = dates[1] if len(dates) > 1 else None
 
-    csv_bytes = output.getvalue().encode("utf-8-sig")
-    output.close()
+    path, count = await run_db(export_orders_csv, date_from, date_to, status, compress)
+
+    try:
+        if not count:
+            await message.answer("Нет заказов по заданным условиям.")
+            return
 
-    filename = f"orders_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    file = BufferedInputFile(csv_bytes, filename=filename)
+        filename = f"orders_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        if compress:
+            filename += ".gz"
+        file = FSInputFile(path, filename=filename)
 
-    await message.answer_document(document=file, caption="Экспорт заказов (CSV)")
+        await message.answer_document(document=file, caption=f"Экспорт заказов (CSV): {count} шт.")
+    finally:
+        os.remove(path)
 
 
 @router.message(Command("users_stats"))
@@ -3681,7 +6914,7 @@ async def cmd_users_stats(message: Message):
     if message.from_user.id != SUPER_ADMIN_ID:
         return
     
-    stats = get_users_stats()
+    stats = await users_repo.get_stats()
     
     text = (
         "📊 Статистика пользователей:\n\n"
@@ -3693,6 +6926,262 @@ async def cmd_users_stats(message: Message):
     await message.answer(text)
 
 
+@router.message(Command("stats"))
+async def cmd_stats(message: Message):
+    """Сводная статистика заказов и пользователей: /stats [дней] (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    args = message.text.split()
+    days = 30
+    if len(args) > 1:
+        if not args[1].isdigit() or not 1 <= int(args[1]) <= 365:
+            await message.answer("Использование: /stats [дней], от 1 до 365")
+            return
+        days = int(args[1])
+
+    stats = await orders_repo.get_stats(days)
+
+    total_orders = sum(int(row['orders']) for row in stats['by_status'])
+    total_revenue = sum(row['revenue'] or 0 for row in stats['by_category'])
+
+    text = (
+        f"📊 Статистика за {days} дн.\n\n"
+        f"📦 Заказов: {total_orders}\n"
+        f"💰 Выручка (без отклонённых): {format_currency(total_revenue)}\n"
+    )
+
+    if stats['by_status']:
+        text += "\nПо статусам:\n"
+        for row in stats['by_status']:
+            name = STATUS_NAMES_RU.get(row['status'], row['status'])
+            text += f"{name}: {int(row['orders'])}\n"
+
+    if stats['by_category']:
+        text += "\nПо категориям:\n"
+        for row in stats['by_category']:
+            category = row['category']
+            text += (
+                f"{get_category_emoji(category)} {get_category_name(category)}: "
+                f"{int(row['orders'])} шт., {format_currency(row['revenue'])}\n"
+            )
+
+    if stats['by_day']:
+        text += "\nПо дням (заказы / выручка / новые / активные):\n"
+        for row in stats['by_day'][:7]:
+            text += (
+                f"{row['day'].strftime('%d.%m')}: {row['orders']} / {format_currency(row['revenue'])} / "
+                f"+{row['new_users']} / {row['active_users']}\n"
+            )
+
+    await message.answer(text)
+
+
+@router.message(Command("top_products"))
+async def cmd_top_products(message: Message):
+    """Продажи по товарам: /top_products [дней] (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    args = message.text.split()
+    days = 30
+    if len(args) > 1:
+        if not args[1].isdigit() or not 1 <= int(args[1]) <= 365:
+            await message.answer("Использование: /top_products [дней], от 1 до 365")
+            return
+        days = int(args[1])
+
+    sales = await orders_repo.get_product_sales(days)
+    if not sales:
+        await message.answer(f"За {days} дн. продаж нет.")
+        return
+
+    text = f"🏆 Топ товаров за {days} дн.:\n\n"
+    for i, row in enumerate(sales, 1):
+        product = await get_product_info(row['product_id'])
+        name = product.name if product else f"ID {row['product_id']}"
+        text += (
+            f"{i}. {name}\n"
+            f"   {int(row['qty'])} шт. в {row['orders']} заказах, "
+            f"{format_currency(row['revenue'])}, {float(row['weight']):.1f} кг\n"
+        )
+
+    await message.answer(text)
+
+
+@router.message(Command("db_stats"))
+async def cmd_db_stats(message: Message):
+    """Статистика пула соединений БД (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    stats = db_pool.stats()
+
+    text = (
+        f"🗄 Пул соединений БД ({db_storage.name}):\n\n"
+        f"🔌 Открыто: {stats['size']} (мин {stats['min_size']}, макс {stats['max_size']})\n"
+        f"🟢 Занято: {stats['in_use']}\n"
+        f"⚪️ Свободно: {stats['idle']}\n\n"
+        f"📥 Выдач: {stats['borrows']}\n"
+        f"🤝 Handshake'ов: {stats['handshakes']}\n"
+        f"💾 Сэкономлено handshake'ов: {stats['handshakes_saved']}\n"
+        f"♻️ Переоткрыто (простой): {stats['recycled']}\n"
+        f"❗️ Неудачных ping: {stats['failed_pings']}\n"
+        f"🗑 Сброшено сломанных: {stats['discarded']}\n"
+        f"⏱ Таймаутов выдачи: {stats['timeouts']}\n\n"
+        f"⏳ Ожидание выдачи: сред. {stats['wait_avg_ms']:.1f} мс, макс. {stats['wait_max_ms']:.1f} мс"
+    )
+
+    cache = user_context_cache.stats()
+    text += (
+        "\n\n👤 Кеш пользователей:\n"
+        f"Записей: {cache['size']} / {cache['max_size']}\n"
+        f"Попаданий: {cache['hits']}, промахов: {cache['misses']} ({cache['hit_ratio']:.0%})\n"
+        f"Вытеснено: {cache['evictions']}"
+    )
+
+    activity = activity_buffer.stats()
+    text += (
+        "\n\n🕒 Буфер активности:\n"
+        f"Ожидают записи: {activity['pending']}\n"
+        f"Отметок: {activity['recorded']}, записано строк: {activity['written']} за {activity['flushes']} сбросов\n"
+        f"Выброшено после неудачных сбросов: {activity['dropped']}"
+    )
+
+    await message.answer(text)
+
+
+@router.message(Command("catalog_stats"))
+async def cmd_catalog_stats(message: Message):
+    """Состояние кеша каталога товаров (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    stats = catalog_cache.stats()
+    loaded_at = stats['loaded_at'].strftime('%d.%m.%Y %H:%M:%S') if stats['loaded_at'] else "—"
+    age = f"{stats['age'] / 60:.0f} мин" if stats['age'] is not None else "—"
+
+    text = (
+        "📚 Кеш каталога товаров:\n\n"
+        f"📦 Товаров: {stats['size']}, категорий: {stats['categories']}\n"
+        f"🕒 Загружен: {loaded_at} ({age} назад)"
+        f"{' из снимка на диске' if stats['source'] == 'snapshot' else ''}\n"
+        f"{'🟡 Устарел' if stats['stale'] else '🟢 Актуален'}"
+        f"{', обновляется...' if stats['refreshing'] else ''}\n\n"
+        f"🔄 Обновлений: {stats['refreshes']} (без изменений: {stats['unchanged']}), ошибок: {stats['failures']}\n"
+        f"⏱ Последнее обновление: {stats['last_duration_ms']:.0f} мс, {stats['last_bytes'] / 1024:.1f} КБ\n"
+        f"♻️ Отдано устаревшим: {stats['stale_served']} раз"
+    )
+    last_changes = stats['last_changes']
+    if any(last_changes.values()):
+        text += (
+            f"\n📝 Последние изменения: +{last_changes['added']} новых, "
+            f"~{last_changes['changed']} изменено, -{last_changes['removed']} удалено"
+        )
+    if stats['last_error']:
+        text += f"\n❗️ Последняя ошибка: {stats['last_error']}"
+
+    await message.answer(text)
+
+
+@router.message(Command("image_cache"))
+async def cmd_image_cache(message: Message):
+    """Состояние кеша изображений товаров (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    def describe(title: str, stats: Dict[str, Any]) -> str:
+        usage = stats['bytes'] / stats['max_bytes'] * 100 if stats['max_bytes'] else 0
+        return (
+            f"{title}\n"
+            f"📦 Записей: {stats['entries']}\n"
+            f"💾 Память: {stats['bytes'] / 1024 / 1024:.1f} из {stats['max_bytes'] / 1024 / 1024:.0f} МБ ({usage:.0f}%)\n"
+            f"🎯 Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_ratio'] * 100:.0f}% попаданий)\n"
+            f"🗑 Вытеснено: {stats['evictions']}, устарело: {stats['expired']}, слишком больших: {stats['rejected']}\n"
+        )
+
+    text = (
+        "🖼 Кеш изображений товаров\n\n"
+        + describe("Миниатюры для PDF:", thumbnail_cache.stats())
+        + f"📐 {PDF_IMAGE_SIZE_MM} мм при {PDF_IMAGE_DPI} DPI\n\n"
+        + describe("Исходные изображения:", image_cache.stats())
+    )
+
+    disk = disk_image_store.stats()
+    usage = disk['bytes'] / disk['max_bytes'] * 100 if disk['max_bytes'] else 0
+    text += (
+        "\nНа диске:\n"
+        f"📦 Файлов: {disk['entries']}\n"
+        f"💾 Объём: {disk['bytes'] / 1024 / 1024:.1f} из {disk['max_bytes'] / 1024 / 1024:.0f} МБ ({usage:.0f}%)\n"
+        f"📂 Прочитано: {disk['hits']}, подтверждено 304: {disk['revalidated']}, загружено: {disk['stored']}\n"
+        f"🗑 Вытеснено: {disk['evictions']}, отдано устаревшими: {disk['stale_served']}\n"
+        f"\n⏳ Срок жизни / перепроверка: {IMAGE_CACHE_LIFETIME / 60:.0f} мин"
+    )
+
+    fetcher = image_fetcher.stats()
+    text += (
+        "\n\nЗагрузка:\n"
+        f"🌐 Запросов: {fetcher['fetches']}, слито одинаковых: {fetcher['deduplicated']}, "
+        f"сейчас идёт: {fetcher['in_flight']}\n"
+        f"❗️ Ошибок: {fetcher['failures']}, больше {fetcher['max_bytes'] / 1024 / 1024:.0f} МБ: {fetcher['too_large']}, "
+        f"не дождались: {fetcher['waiter_timeouts']}\n"
+        f"🚦 Не больше {fetcher['per_host']} запросов на хост"
+    )
+
+    prewarm = image_prewarmer.stats()
+    if prewarm['concurrency'] > 0:
+        text += (
+            "\n\nФоновая подгрузка:\n"
+            f"🔥 Подготовлено: {prewarm['warmed']}, уже были: {prewarm['skipped']}, ошибок: {prewarm['failed']}\n"
+            f"📥 В очереди: {prewarm['queued']}, удалено из каталога: {prewarm['evicted']}"
+        )
+    else:
+        text += "\n\nФоновая подгрузка выключена"
+
+    await message.answer(text)
+
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+@router.message(Command("slow_queries"))
+async def cmd_slow_queries(message: Message):
+    """Самые медленные запросы к БД с момента запуска: /slow_queries [N] (только супер-админ)"""
+    if message.from_user.id != SUPER_ADMIN_ID:
+        return
+
+    args = message.text.split()
+    limit = 10
+    if len(args) > 1:
+        if not args[1].isdigit() or not 1 <= int(args[1]) <= 15:
+            await message.answer("Использование: /slow_queries [N], от 1 до 15")
+            return
+        limit = int(args[1])
+
+    totals = query_stats.totals()
+    text = (
+        "🐢 Медленные запросы с момента запуска\n\n"
+        f"Выполнено: {totals['calls']} (разных запросов: {totals['statements']})\n"
+        f"Ошибок: {totals['errors']}, медленных (≥{query_stats.slow_ms} мс): {totals['slow']}\n"
+    )
+
+    # Ответ режется на несколько сообщений по границам записей (лимит Telegram — 4096 символов)
+    for i, entry in enumerate(query_stats.top(limit), 1):
+        query = entry["query"] if len(entry["query"]) <= 120 else entry["query"][:117] + "..."
+        block = (
+            f"\n{i}. {entry['site']}\n"
+            f"   макс {entry['max_ms']:.1f} мс, p95 ≤{entry['p95_ms']:.0f} мс, сред. {entry['avg_ms']:.1f} мс\n"
+            f"   вызовов {entry['calls']}, строк {entry['rows']}, ~{entry['bytes'] / 1024:.1f} КБ\n"
+            f"   {query}\n"
+        )
+        if len(text) + len(block) > TELEGRAM_MESSAGE_LIMIT:
+            await message.answer(text)
+            text = ""
+        text += block
+
+    await message.answer(text)
+
+
 @router.message(Command("sendall"))
 async def cmd_sendall(message: Message):
     """Массовая рассылка (только супер-админ)"""
@@ -3720,7 +7209,8 @@ async def cmd_sendall(message: Message):
         )
         return
 
-    user_ids = get_all_user_ids()
+    await run_db(activity_buffer.flush)  # чтобы в рассылку попали только что нажавшие /start
+    user_ids = await users_repo.get_all_ids()
     if not user_ids:
         await message.answer("Нет пользователей.")
         return
@@ -3764,10 +7254,10 @@ async def cmd_sendall(message: Message):
 
 
 @router.message(Command("get_pdf"))
-async def cmd_get_pdf(message: Message):
+async def cmd_get_pdf(message: Message, user_ctx: UserContext):
     """Получить PDF заказа"""
     user_id = message.from_user.id
-    lang = get_user_lang(user_id)
+    lang = user_ctx.lang
 
     args = message.text.split()
     if len(args) < 2:
@@ -3779,11 +7269,11 @@ async def cmd_get_pdf(message: Message):
 
     order_id = args[1].strip()
 
-    # Админы могут получать любые заказы
+    # Админы могут получать любые заказы; PDF читается только здесь, по запросу
     if user_id in ALL_ADMIN_IDS:
-        record = get_order_raw(order_id)
+        record = await orders_repo.get_header(order_id)
     else:
-        record = get_order_for_user(order_id, user_id)
+        record = await orders_repo.get_for_user(order_id, user_id)
 
     if not record:
         if lang == "ru":
@@ -3792,7 +7282,7 @@ async def cmd_get_pdf(message: Message):
             await message.answer("Buyurtma topilmadi.")
         return
 
-    pdf_bytes = record.get("pdf_final") or record.get("pdf_draft")
+    pdf_bytes = await orders_repo.get_pdf(order_id)
     if not pdf_bytes:
         if lang == "ru":
             await message.answer("PDF не доступен.")
@@ -3812,8 +7302,35 @@ async def cmd_get_pdf(message: Message):
 
 # ==================== ЗАПУСК ====================
 
+# Фоновый перенос PDF в blob store: on_shutdown останавливает его и дожидается конца пачки
+pdf_migration_stop = threading.Event()
+pdf_migration_task: Optional[asyncio.Task] = None
+# Периодическое обновление каталога (background_cache_updater); отменяется в on_shutdown
+catalog_refresh_task: Optional[asyncio.Task] = None
+# Фоновый сброс буфера активности; отменяется в on_shutdown перед последним сбросом
+activity_flush_task: Optional[asyncio.Task] = None
+
+
+def log_background_task_failure(task: asyncio.Task):
+    """Done-callback фоновой задачи: исключение, которое никто не ждёт, пишется в лог"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.get_name()}", exc_info=task.exception())
+
+
+async def cancel_background_task(task: Optional[asyncio.Task]):
+    """Отменяет фоновую задачу и дожидается её завершения"""
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
 async def on_startup(bot: Bot):
     """Действия при запуске"""
+    global pdf_migration_task, catalog_refresh_task, activity_flush_task
     logger.info("=" * 50)
     logger.info("🤖 Bot starting up...")
     logger.info(f"Bot username: {(await bot.get_me()).username}")
@@ -3822,26 +7339,57 @@ async def on_startup(bot: Bot):
     logger.info(f"Production Admins: {PRODUCTION_ADMIN_IDS}")
     logger.info(f"Warehouse Admins: {WAREHOUSE_ADMIN_IDS}")
     logger.info(f"Rate limiting: ✅")
-    logger.info(f"Database: MySQL at {DB_CONFIG['host']}:{DB_CONFIG['port']}")
+    logger.info(f"Database: {db_storage.describe()}")
+    logger.info(f"DB pool: min={db_pool.min_size}, max={db_pool.max_size}")
     logger.info(f"Async FTP: {'✅' if AIOFTP_AVAILABLE else '⚠️  Fallback to sync'}")
     logger.info("=" * 50)
 
     try:
-        init_db()
+        await run_db(init_db)
+        await run_db(db_pool.warm_up)
         logger.info("✅ Database initialized")
         
         # Миграция данных из локальных файлов в БД
-        migrate_users_from_files()
+        await run_db(migrate_users_from_files)
+
+        # Позиции старых заказов из order_json в order_items
+        await run_db(migrate_order_items)
+
+        # Сводки статистики: разовое заполнение по накопленным данным
+        await run_db(rebuild_stats_rollups)
+
+        # Перенос старых PDF в blob store идёт в фоне: до переноса PDF читаются из старых колонок
+        pdf_migration_task = asyncio.create_task(
+            run_db(migrate_order_pdfs_to_blob_store, stop_event=pdf_migration_stop),
+            name="migrate_order_pdfs_to_blob_store"
+        )
+        pdf_migration_task.add_done_callback(log_background_task_failure)
+
+        # Фоновая запись активности пользователей пачками
+        activity_flush_task = asyncio.create_task(activity_flush_loop(), name="activity_flush_loop")
+        activity_flush_task.add_done_callback(log_background_task_failure)
     except Exception as e:
         logger.exception(f"❌ Database init failed: {e}")
         raise
 
-    # ✅ Предзагружаем товары в кеш
-    try:
-        products = await fetch_products_from_sheets()
-        logger.info(f"✅ Pre-loaded {len(products)} products into cache")
-    except Exception as e:
-        logger.warning(f"⚠️ Failed to pre-load products: {e}")
+    await http_client.start()
+    await asyncio.to_thread(disk_image_store.load)
+
+    # Фото товаров подгружаются в фоне по мере изменений каталога
+    image_prewarmer.start()
+
+    # ✅ Предзагружаем товары в кеш: из снимка на диске сразу, свежие из Sheets — в фоне
+    if catalog_cache.load_snapshot():
+        image_prewarmer.refresh_all()
+        catalog_cache.start_refresh()
+    else:
+        products = await catalog_cache.refresh()
+        if products:
+            logger.info(f"✅ Pre-loaded {len(products)} products into cache")
+        else:
+            logger.warning(f"⚠️ Failed to pre-load products: {catalog_cache.last_error}")
+    catalog_refresh_task = asyncio.create_task(background_cache_updater(), name="background_cache_updater")
+    catalog_refresh_task.add_done_callback(log_background_task_failure)
 
 
 
@@ -3853,18 +7401,43 @@ async def on_shutdown(bot: Bot):
     except:
         pass
 
+    await cancel_background_task(catalog_refresh_task)
+
+    # Перенос PDF прерывается между пачками; остаток продолжится при следующем запуске
+    if pdf_migration_task is not None:
+        pdf_migration_stop.set()
+        try:
+            await pdf_migration_task
+        except Exception:
+            pass  # уже записано в лог log_background_task_failure
+
+    await cancel_background_task(activity_flush_task)
+
+    try:
+        await run_db(activity_buffer.flush)
+    except Exception:
+        logger.exception("Final activity flush failed")
+
+    db_executor.shutdown(wait=True)
+    logger.info(f"DB pool stats: {db_pool.stats()}")
+    db_pool.close()
+
+    await image_prewarmer.stop()
+    logger.info(f"HTTP client stats: {http_client.stats()}")
+    await http_client.close()
+
 async def background_cache_updater():
     """Фоновое обновление кеша товаров"""
-    await asyncio.sleep(60)  # Подождать 1 минуту после старта
-    
     while True:
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL)
         try:
-            await asyncio.sleep(1800)  # 30 минут
-            products = await fetch_products_from_sheets()
+            products = await catalog_cache.refresh()
             logger.info(f"🔄 Background cache update: {len(products)} products")
+            image_prewarmer.refresh_all()
         except Exception as e:
             logger.exception(f"❌ Background cache update failed: {e}")
 
+
 async def main():
     """Главная функция"""
     logger.info("Starting bot initialization...")